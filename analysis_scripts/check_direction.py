@@ -7,9 +7,27 @@ CAUTION: Assuming chan0 is the uppermost and
 from __future__ import print_function
 import sys
 
+import numpy as np
 
-def check_direction():
-    f = open(sys.argv[1])
+from muonic.analysis.pulse_store import is_pulse_file, read_pulse_file
+
+
+def read_binary_directions(filename):
+    events, pulses = read_pulse_file(filename)
+
+    # rising edge of the first pulse in channel 0 and 1 of each event
+    first_re = np.full((len(events), 2), np.nan)
+    for channel in [0, 1]:
+        channel_pulses = pulses[pulses["channel"] == channel]
+        event, first = np.unique(channel_pulses["event"], return_index=True)
+        first_re[event, channel] = channel_pulses["rising_edge"][first]
+
+    both = ~np.isnan(first_re).any(axis=1)
+    return (first_re[both, 1] - first_re[both, 0]).tolist()
+
+
+def read_directions(filename):
+    f = open(filename)
     directions = []
 
     for line in f.readlines():
@@ -19,6 +37,15 @@ def check_direction():
         except:
             pass
 
+    return directions
+
+
+def check_direction():
+    if is_pulse_file(sys.argv[1]):
+        directions = read_binary_directions(sys.argv[1])
+    else:
+        directions = read_directions(sys.argv[1])
+
     up = 0
     down = 0
 
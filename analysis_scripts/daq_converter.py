@@ -6,36 +6,24 @@
 # -> each channel is represented by a list of leading/falling edge
 #    tuples of the recorded pulses
 #
+# the raw file may be gzip or bzip2 compressed, it is processed
+# on all available cores
+#
 from __future__ import print_function
-import logging
-import re
 import sys
 
-from muonic.analysis.analyzer import PulseExtractor
+from muonic.analysis.reprocessing import reprocess_raw_file
 
 
 def daq_converter():
-    pe = PulseExtractor(logging.getLogger(), '')
-
-    f = open(sys.argv[1])
-
     converted_file = open("converted.txt", "w")
 
-    # match against this to supress daq garbage
-    good_pattern = re.compile("^[a-zA-Z0-9+-.,:()=$/#?!%_@*|~' ]*[\n\r]*$")
+    # status messages and daq garbage are skipped by the decoder
+    for pulses in reprocess_raw_file(sys.argv[1]):
+        converted_file.write(pulses.__repr__() + "\n")
 
-    for line in f.readlines():
-        if good_pattern.match(line) is None:
-            continue
-        try:
-            pulses = pe.extract(line)
-        except Exception as e:
-            print(line, "Failed to convert", e)
-            continue
+    converted_file.close()
 
-        if pulses is not None:
-            converted_file.write(pulses.__repr__() + "\n")
-    
 
 if __name__ == "__main__":
     daq_converter()
@@ -9,9 +9,11 @@ import sys
 import matplotlib.pylab as p
 import numpy as n
 
+from muonic.analysis.pulse_store import is_pulse_file, read_pulse_file
 
-def plot_trigger_timmdiff():
-    f = open(sys.argv[1])
+
+def read_trigger_differences(filename):
+    f = open(filename)
 
     triggers = []
     ini = True
@@ -44,6 +46,27 @@ def plot_trigger_timmdiff():
         except:
             pass
 
+    return triggers
+
+
+def read_binary_trigger_differences(filename):
+    events = read_pulse_file(filename)[0]
+
+    # the first event is skipped
+    triggers = n.diff(events["trigger_time"][1:]) / 1000000
+
+    for difference in triggers:
+        print(difference)
+
+    return triggers.tolist()
+
+
+def plot_trigger_timmdiff():
+    if is_pulse_file(sys.argv[1]):
+        triggers = read_binary_trigger_differences(sys.argv[1])
+    else:
+        triggers = read_trigger_differences(sys.argv[1])
+
     xmax = max(triggers)
     pulsebins = n.linspace(0, xmax, xmax + 1)
     # pulsebins = n.linspace(0, xmax, 1000)
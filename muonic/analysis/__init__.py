@@ -2,4 +2,10 @@
 scripts and classes used for data analysis
 """
 from .analyzer import *
-from .fit import fit, gaussian_fit
+from .coincidence import find_coincidences, get_hit_times
+from .fit import fit, gaussian_fit, lifetime_likelihood_fit, lifetime_pdf
+from .fit import LifetimeEstimator
+from .fit_scan import scan_fit_range, find_cached_scan, cache_scan
+from .histogram import Histogram
+from .rate_archive import RateArchive
+from .reprocessing import reprocess_raw_file, reprocess_pulse_file
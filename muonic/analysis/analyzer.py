@@ -6,11 +6,21 @@ edges of the pulses.
 from __future__ import print_function
 import datetime
 import os
+import re
+
+import numpy as np
 
 from muonic.util import rename_muonic_file, get_hours_from_duration
 from muonic.util import WrappedFile
+from muonic.analysis.pulse_store import BinaryPulseFile, get_event_index
+from muonic.analysis.pulse_store import get_pulse_table_filename
 
-__all__ = ["PulseExtractor", "DecayTriggerThorough", "VelocityTrigger"]
+__all__ = ["PulseExtractor", "DecayTriggerThorough", "VelocityTrigger",
+           "decode_daq_lines", "summarize_events", "summarize_pulse_records",
+           "DECAY_ACCEPTED", "DECAY_TOO_FEW_PULSES", "DECAY_VETO",
+           "DECAY_PULSE_COUNT", "DECAY_PULSE_WIDTH", "DECAY_TIME_RANGE",
+           "DECAY_REASONS", "VELOCITY_ACCEPTED", "VELOCITY_MISSING_PULSE",
+           "VELOCITY_PULSE_WIDTH", "VELOCITY_REASONS", "CHANNEL_PAIRS"]
 
 # for the pulses 
 # 8 bits give a hex number
@@ -36,6 +46,285 @@ TMC_TICK = 1.25  # nsec
 MAX_TRIGGER_WINDOW = 9960.0  # nsec for mudecay!
 DEFAULT_FREQUENCY = 25.0e6
 
+# a complete DAQ trigger line, e.g.
+# 80EE0049 80 01 00 01 38 01 3C 01 7ED20C99 190102.011 260311 A 05 0 +0051
+# used to decode a whole block of lines in one pass
+TRIGGER_LINE_PATTERN = re.compile(
+        r"^([0-9A-Fa-f]{8})" + r"[ \t]+([0-9A-Fa-f]{2})" * 8 +
+        r"[ \t]+([0-9A-Fa-f]{8})[ \t]+([0-9]{6})\.([0-9]{3})" +
+        r"(?:[ \t]+\S+){4}[ \t]+([+-]?[0-9]+)[ \t]*\r?$", re.M)
+
+# the DAQ card writes trigger lines with fixed column widths, lines
+# following this layout are decoded directly from their bytes
+TRIGGER_LINE_LENGTH = 72
+_SEPARATOR_COLUMNS = [8, 11, 14, 17, 20, 23, 26, 29, 32, 41, 52, 59, 61, 64,
+                      66]
+_HEX_COLUMNS = [i for i in range(41)
+                if i not in _SEPARATOR_COLUMNS]
+_DIGIT_COLUMNS = list(range(42, 48)) + list(range(49, 52)) + \
+                 list(range(68, 72))
+_TOKEN_COLUMNS = list(range(53, 59)) + [60, 62, 63, 65]
+
+# decoded trigger lines, the gps time is given in seconds since day start
+DAQ_LINE_DTYPE = np.dtype([
+    ("trigger_count", np.uint32),
+    ("re0", np.uint8), ("fe0", np.uint8),
+    ("re1", np.uint8), ("fe1", np.uint8),
+    ("re2", np.uint8), ("fe2", np.uint8),
+    ("re3", np.uint8), ("fe3", np.uint8),
+    ("one_pps", np.uint32),
+    ("gps_time", np.float64),
+    ("correction", np.int32)
+])
+
+EDGE_FIELDS = ["re0", "fe0", "re1", "fe1", "re2", "fe2", "re3", "fe3"]
+
+# version of decode_daq_lines, increase it if the decoded values change,
+# so cached decoded files are not used anymore
+DECODER_VERSION = 1
+
+# lookup tables for ascii characters
+_HEX_DIGITS = np.zeros(256, dtype=np.int64)
+_IS_HEX = np.zeros(256, dtype=bool)
+for _value, _digit in enumerate("0123456789abcdef"):
+    _HEX_DIGITS[ord(_digit)] = _HEX_DIGITS[ord(_digit.upper())] = _value
+    _IS_HEX[ord(_digit)] = _IS_HEX[ord(_digit.upper())] = True
+_IS_DIGIT = np.zeros(256, dtype=bool)
+_IS_DIGIT[ord("0"):ord("9") + 1] = True
+_IS_SPACE = np.zeros(256, dtype=bool)
+_IS_SPACE[[ord(c) for c in " \t\n\r\x0b\x0c"]] = True
+
+# counters of the DAQ card are 32 bit wide
+COUNTER_OFFSET = int(0xFFFFFFFF)
+
+# columnar summary of extracted events used by the batch triggers. For
+# each of the four channels the number of pulses and the edges of the
+# first and the last pulse are stored, NaN if the channel has no pulse
+EVENT_SUMMARY_DTYPE = np.dtype([
+    ("trigger_time", np.float64),
+    ("pulse_count", np.int32, (4,)),
+    ("first_rising_edge", np.float64, (4,)),
+    ("first_falling_edge", np.float64, (4,)),
+    ("last_rising_edge", np.float64, (4,)),
+    ("last_falling_edge", np.float64, (4,))
+])
+
+# reason codes of DecayTriggerThorough.trigger_batch
+DECAY_ACCEPTED = 0
+DECAY_TOO_FEW_PULSES = 1
+DECAY_VETO = 2
+DECAY_PULSE_COUNT = 3
+DECAY_PULSE_WIDTH = 4
+DECAY_TIME_RANGE = 5
+
+DECAY_REASONS = {
+    DECAY_ACCEPTED: "accepted",
+    DECAY_TOO_FEW_PULSES: "too few pulses",
+    DECAY_VETO: "pulse in veto channel",
+    DECAY_PULSE_COUNT: "wrong number of pulses",
+    DECAY_PULSE_WIDTH: "pulse width out of range",
+    DECAY_TIME_RANGE: "decay time out of range"
+}
+
+# reason codes of VelocityTrigger.trigger_batch
+VELOCITY_ACCEPTED = 0
+VELOCITY_MISSING_PULSE = 1
+VELOCITY_PULSE_WIDTH = 2
+
+VELOCITY_REASONS = {
+    VELOCITY_ACCEPTED: "accepted",
+    VELOCITY_MISSING_PULSE: "no pulse in one of the channels",
+    VELOCITY_PULSE_WIDTH: "pulse width difference out of range"
+}
+
+# all combinations of upper and lower channel, the channel indices count
+# the trigger time as index 0 as for VelocityTrigger.trigger
+CHANNEL_PAIRS = [(upper, lower) for upper in range(1, 5)
+                 for lower in range(upper + 1, 5)]
+
+# PulseExtractor attributes needed to continue at an arbitrary message
+COUNTER_STATE = ["ini", "trigger_count", "last_trigger_count",
+                 "last_one_pps", "prev_last_one_pps", "last_time",
+                 "passed_one_pps", "last_one_pps_poll",
+                 "calculated_frequency"]
+
+
+def _hex_value(digits):
+    """
+    Combine rows of hex digit values to integers
+
+    :param digits: hex digit values, one number per row
+    :type digits: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    width = digits.shape[1]
+    return digits.dot(16 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+
+
+def _decode_fixed_width(rows):
+    """
+    Decode trigger lines in the fixed column layout of the DAQ card.
+
+    :param rows: one line per row, TRIGGER_LINE_LENGTH bytes each
+    :type rows: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    data = np.zeros(len(rows), dtype=DAQ_LINE_DTYPE)
+    hex_digits = _HEX_DIGITS[rows[:, :41]]
+    digits = rows.astype(np.int64) - ord("0")
+
+    data["trigger_count"] = _hex_value(hex_digits[:, 0:8])
+    for index, name in enumerate(EDGE_FIELDS):
+        column = 9 + 3 * index
+        data[name] = _hex_value(hex_digits[:, column:column + 2])
+    data["one_pps"] = _hex_value(hex_digits[:, 33:41])
+
+    # hhmmss.sss
+    secs_since_day_start = ((digits[:, 42] * 10 + digits[:, 43]) * 3600 +
+                            (digits[:, 44] * 10 + digits[:, 45]) * 60 +
+                            digits[:, 46] * 10 + digits[:, 47])
+    milliseconds = digits[:, 49] * 100 + digits[:, 50] * 10 + digits[:, 51]
+    data["gps_time"] = secs_since_day_start + milliseconds / 1000.0
+
+    data["correction"] = (digits[:, 68] * 1000 + digits[:, 69] * 100 +
+                          digits[:, 70] * 10 + digits[:, 71])
+    data["correction"][rows[:, 67] == ord("-")] *= -1
+
+    return data
+
+
+def _decode_fields(fields):
+    """
+    Decode trigger lines which have already been split into the
+    groups of TRIGGER_LINE_PATTERN.
+
+    :param fields: one line per row, 13 fields each
+    :type fields: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    data = np.zeros(len(fields), dtype=DAQ_LINE_DTYPE)
+
+    def hex_column(index, width):
+        raw = fields[:, index].astype("S%d" % width)
+        return _hex_value(_HEX_DIGITS[raw.view(np.uint8).reshape(-1, width)])
+
+    data["trigger_count"] = hex_column(0, 8)
+    for index, name in enumerate(EDGE_FIELDS):
+        data[name] = hex_column(index + 1, 2)
+    data["one_pps"] = hex_column(9, 8)
+
+    hms = fields[:, 10].astype(np.int64)
+    data["gps_time"] = ((hms // 10000) * 3600 + (hms // 100 % 100) * 60 +
+                        hms % 100) + fields[:, 11].astype(np.int64) / 1000.0
+    data["correction"] = fields[:, 12].astype(np.int64)
+
+    return data
+
+
+def decode_daq_lines(buffer, return_offsets=False):
+    """
+    Decode a block of DAQ messages into a structured array with one
+    record per trigger line (see DAQ_LINE_DTYPE). Status messages and
+    malformed lines are skipped. If return_offsets is True, the byte
+    offsets of the decoded lines within the buffer are returned as well.
+
+    :param buffer: DAQ messages separated by newlines or list of messages
+    :type buffer: str or bytes or list of str
+    :param return_offsets: return the offsets of the lines
+    :type return_offsets: bool
+    :returns: numpy.ndarray or tuple of numpy.ndarray
+    """
+    if not isinstance(buffer, (str, bytes)):
+        buffer = "\n".join(buffer)
+    if isinstance(buffer, str):
+        buffer = buffer.encode("ascii", "replace")
+
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    newlines = np.flatnonzero(raw == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(raw)]))
+
+    # strip carriage returns
+    has_cr = ends > starts
+    has_cr[has_cr] = raw[ends[has_cr] - 1] == ord("\r")
+    ends -= has_cr
+
+    # lines in the layout of the DAQ card
+    fixed = np.flatnonzero(ends - starts == TRIGGER_LINE_LENGTH)
+    rows = raw[starts[fixed, np.newaxis] +
+               np.arange(TRIGGER_LINE_LENGTH)]
+    valid = ((rows[:, _SEPARATOR_COLUMNS] == ord(" ")).all(axis=1) &
+             _IS_HEX[rows[:, _HEX_COLUMNS]].all(axis=1) &
+             _IS_DIGIT[rows[:, _DIGIT_COLUMNS]].all(axis=1) &
+             ~_IS_SPACE[rows[:, _TOKEN_COLUMNS]].any(axis=1) &
+             (rows[:, 48] == ord(".")) &
+             ((rows[:, 67] == ord("+")) | (rows[:, 67] == ord("-"))))
+    data = _decode_fixed_width(rows[valid])
+    line_numbers = fixed[valid]
+
+    # everything else, mostly status messages, has to be matched
+    # against the pattern
+    others = np.ones(len(starts), dtype=bool)
+    others[line_numbers] = False
+    others &= ends - starts > 0
+
+    matches = []
+    matched_lines = []
+    for line_number in np.flatnonzero(others).tolist():
+        match = TRIGGER_LINE_PATTERN.match(
+                buffer[starts[line_number]:ends[line_number]].decode(
+                        "ascii", "replace"))
+        if match is not None:
+            matches.append(match.groups())
+            matched_lines.append(line_number)
+
+    if matches:
+        data = np.concatenate((data, _decode_fields(np.array(matches))))
+        line_numbers = np.concatenate((line_numbers, matched_lines))
+        order = np.argsort(line_numbers, kind="mergesort")
+        data = data[order]
+        line_numbers = line_numbers[order]
+
+    if return_offsets:
+        return data, starts[line_numbers]
+    return data
+
+
+def _correct_rollover(values, last_value):
+    """
+    Correct a sequence of 32 bit counter values for rollover the same
+    way PulseExtractor does it line by line: a value smaller than the
+    previous, already corrected value is shifted by COUNTER_OFFSET.
+
+    :param values: raw counter values
+    :type values: numpy.ndarray
+    :param last_value: corrected counter value preceding the sequence
+    :type last_value: int
+    :returns: numpy.ndarray
+    """
+    values = values.astype(np.int64)
+    shifted = np.zeros(len(values), dtype=bool)
+
+    # smaller than the unshifted and the shifted previous value
+    below = np.empty(len(values), dtype=bool)
+    below_shifted = np.empty(len(values), dtype=bool)
+    below[:1] = below_shifted[:1] = values[:1] < last_value
+    below[1:] = values[1:] < values[:-1]
+    below_shifted[1:] = values[1:] < values[:-1] + COUNTER_OFFSET
+
+    start = 0
+    while start < len(values):
+        hits = np.flatnonzero(below[start:])
+        if not len(hits):
+            break
+        start += hits[0]
+        misses = np.flatnonzero(~below_shifted[start + 1:])
+        stop = start + 1 + misses[0] if len(misses) else len(values)
+        shifted[start:stop] = True
+        start = stop
+
+    return values + shifted * COUNTER_OFFSET
+
 
 class PulseExtractor:
     """
@@ -47,11 +336,17 @@ class PulseExtractor:
     :type logger: logging.Logger
     :param filename: filename of the pulse file
     :type filename: str
+    :param binary: write the pulse file in the binary format
+    :type binary: bool
     """
 
-    def __init__(self, logger, filename):
+    def __init__(self, logger, filename, binary=False):
         self.logger = logger
-        self.pulse_file = WrappedFile(filename)
+        self.binary = binary
+        if binary:
+            self.pulse_file = BinaryPulseFile(filename)
+        else:
+            self.pulse_file = WrappedFile(filename)
         self._write_pulses = False
 
         # start time and duration
@@ -70,7 +365,7 @@ class PulseExtractor:
         self.last_one_pps = 0
         self.last_trigger_time = 0
         self.trigger_count = 0
-        self.last_time = 0
+        self.last_time = None
 
         # store the actual value of the trigger counter
         # to correct trigger counter rollover
@@ -112,6 +407,20 @@ class PulseExtractor:
         else:
             self._write_pulses = False
 
+    def _write_events(self, events):
+        """
+        Write extracted pulses to the pulse file.
+
+        :param events: extracted pulses
+        :type events: list of tuples
+        :returns: None
+        """
+        if self.binary:
+            self.pulse_file.write_events(events)
+        else:
+            self.pulse_file.write("".join([repr(pulses) + "\n"
+                                           for pulses in events]))
+
     def finish(self):
         """
         Cleanup, close and rename pulse file
@@ -134,9 +443,32 @@ class PulseExtractor:
                                          self.measurement_duration))
                 rename_muonic_file(self.measurement_duration,
                                    self.pulse_file.get_filename())
+                if self.binary:
+                    rename_muonic_file(self.measurement_duration,
+                                       get_pulse_table_filename(
+                                           self.pulse_file.get_filename()))
             except (OSError, IOError):
                 pass
 
+    def _decode_edges(self, line):
+        """
+        Get the tmc times of the leading and falling edges of a DAQ
+        message in the order re0, fe0, ..., re3, fe3. Edges which are
+        not flagged as valid are None.
+
+        :param line: DQ message split on whitespaces
+        :type line: list
+        :returns: list
+        """
+        edges = []
+        for field in line[1:9]:
+            edge = int(field, 16)
+            if edge & BIT5:
+                edges.append((edge & BIT0_4) * TMC_TICK)
+            else:
+                edges.append(None)
+        return edges
+
     def _calculate_edges(self, line, counter_diff=0):
         """
         get the leading and falling edges of the pulses
@@ -149,24 +481,26 @@ class PulseExtractor:
         :type counter_diff: int
         :return: None
         """
-        
-        rising_edges = {
-            "ch0": int(line[1], 16), "ch1": int(line[3], 16),
-            "ch2": int(line[5], 16), "ch3": int(line[7], 16)
-        }
-        falling_edges = {
-            "ch0": int(line[2], 16), "ch1": int(line[4], 16),
-            "ch2": int(line[6], 16), "ch3": int(line[8], 16)
-        }
+        self._add_edges(self._decode_edges(line), counter_diff)
 
-        for ch in ["ch0", "ch1", "ch2", "ch3"]:
-            re = rising_edges[ch]
-            fe = falling_edges[ch]
+    def _add_edges(self, edges, counter_diff=0):
+        """
+        Add decoded leading and falling edges to the current event
 
-            if re & BIT5:
-                self.re[ch].append(counter_diff + (re & BIT0_4) * TMC_TICK)
-            if fe & BIT5:
-                self.fe[ch].append(counter_diff + (fe & BIT0_4) * TMC_TICK)
+        :param edges: edges as returned by _decode_edges
+        :type edges: list
+        :param counter_diff: counter difference
+        :type counter_diff: int
+        :return: None
+        """
+        for index, ch in enumerate(["ch0", "ch1", "ch2", "ch3"]):
+            rising = edges[2 * index]
+            falling = edges[2 * index + 1]
+
+            if rising is not None:
+                self.re[ch].append(counter_diff + rising)
+            if falling is not None:
+                self.fe[ch].append(counter_diff + falling)
 
     def _order_and_clean_pulses(self):
         """
@@ -181,16 +515,16 @@ class PulseExtractor:
         pulses = {"ch0": [], "ch1": [], "ch2": [], "ch3": []}
 
         for ch in ["ch0", "ch1", "ch2", "ch3"]:
-            for index, re in enumerate(self.last_re[ch]):
+            for index, rising in enumerate(self.last_re[ch]):
                 # add the virtual falling edge if necessary
                 try:
-                    fe = self.last_fe[ch][index]
-                    if fe < re:
-                        fe = MAX_TRIGGER_WINDOW
+                    falling = self.last_fe[ch][index]
+                    if falling < rising:
+                        falling = MAX_TRIGGER_WINDOW
                 except IndexError:
-                    fe = MAX_TRIGGER_WINDOW
+                    falling = MAX_TRIGGER_WINDOW
                     
-                pulses[ch].append((re, fe))
+                pulses[ch].append((rising, falling))
                 
             pulses[ch] = sorted(pulses[ch])
 
@@ -202,16 +536,12 @@ class PulseExtractor:
             #         self.pulses[ch] = (i[0],MAX_TRIGGER_WINDOW)
         return pulses
 
-    def _get_evt_time(self, time, correction, trigger_count, one_pps):
+    def _get_gps_time(self, time):
         """
-        Get the absolute event time in seconds since day start
-        If gps is not available, only relative event time based on counts
-        is returned
+        Get the gps time of a DAQ message in seconds since day start
 
-        :param time: event time
-        :param correction:
-        :param trigger_count:
-        :param one_pps:
+        :param time: gps time field, hhmmss.sss
+        :type time: str
         :returns: float
         """
         time_fields = time.split(".")
@@ -221,12 +551,38 @@ class PulseExtractor:
                                 int(t[2:4]) * 60 + int(t[4:6]))
 
         # FIXME: Why time_fields[1] / 1000?
-        gps_time = float(secs_since_day_start + int(time_fields[1]) / 1000.0 +
-                         int(correction) / 1000.0)
+        return secs_since_day_start + int(time_fields[1]) / 1000.0
+
+    def _get_line_time(self, gps_time, correction, trigger_count, one_pps):
+        """
+        Get the absolute event time in seconds since day start from
+        the already decoded gps time
+
+        :param gps_time: gps time in seconds since day start
+        :type gps_time: float
+        :param correction: gps time correction in milliseconds
+        :type correction: int
+        :param trigger_count:
+        :param one_pps:
+        :returns: float
+        """
+        return (gps_time + correction / 1000.0 +
+                float((trigger_count - one_pps) / self.calculated_frequency))
 
-        line_time = gps_time + float((trigger_count - one_pps) /
-                                     self.calculated_frequency)
-        return line_time
+    def _get_evt_time(self, time, correction, trigger_count, one_pps):
+        """
+        Get the absolute event time in seconds since day start
+        If gps is not available, only relative event time based on counts
+        is returned
+
+        :param time: event time
+        :param correction:
+        :param trigger_count:
+        :param one_pps:
+        :returns: float
+        """
+        return self._get_line_time(self._get_gps_time(time), int(correction),
+                                   trigger_count, one_pps)
 
     def extract(self, line):
         """
@@ -242,9 +598,312 @@ class PulseExtractor:
         """
         line = line.split()
 
-        one_pps = int(line[9], 16)
-        trigger_count = int(line[0], 16)
-        time = line[10]
+        return self._extract(int(line[0], 16), int(line[9], 16),
+                             self._get_gps_time(line[10]), int(line[15]),
+                             int(line[1], 16) & BIT7,
+                             self._decode_edges(line))
+
+    def extract_batch(self, lines):
+        """
+        Analyze a block of subsequent lines at once. Returns the
+        sets of pulses of all triggers found in the block, i.e. the
+        results of extract which are not None, in the same order.
+
+        Status messages and malformed lines are skipped.
+
+        :param lines: DAQ messages
+        :type lines: list of str or str
+        :returns: list of tuples
+        """
+        return self.extract_array(decode_daq_lines(lines))
+
+    def extract_array(self, data):
+        """
+        Analyze a block of DAQ messages which have already been decoded
+        by decode_daq_lines. Returns the sets of pulses of all triggers
+        found in the block, identical to what subsequent calls of extract
+        would have returned.
+
+        :param data: decoded DAQ messages
+        :type data: numpy.ndarray
+        :returns: list of tuples
+        """
+        events, start = self._extract_initial(data)
+
+        data = data[start:]
+
+        if not len(data):
+            return events
+
+        raw_edges = np.column_stack([data[name] for name in EDGE_FIELDS] +
+                                    [np.zeros(len(data), dtype=np.uint8)])
+        edge_times = (raw_edges & BIT0_4) * TMC_TICK
+        triggers = (data["re0"] & BIT7) != 0
+
+        line_time, counter_diff = self._process_counters(data)
+        counter_diff[triggers] = 0
+
+        # group the edges by the trigger they belong to, event 0 is the
+        # event which is still open from the previous call
+        trigger_lines = np.flatnonzero(triggers)
+        event = np.cumsum(triggers)
+        n_triggers = len(trigger_lines)
+        trigger_times = [self.last_trigger_time] + \
+            line_time[trigger_lines].tolist()
+
+        pulses = []
+        open_re = dict()
+        open_fe = dict()
+        last_re = dict()
+        last_fe = dict()
+
+        for index, ch in enumerate(["ch0", "ch1", "ch2", "ch3"]):
+            times = dict()
+            edge_events = dict()
+            for edge in ["re", "fe"]:
+                column = 2 * index + (edge == "fe")
+                lines = np.flatnonzero(raw_edges[:, column] & BIT5)
+                previous = getattr(self, edge)[ch]
+                edge_events[edge] = np.concatenate(
+                        (np.zeros(len(previous), dtype=np.int64),
+                         event[lines]))
+                times[edge] = np.concatenate(
+                        (previous, counter_diff[lines] +
+                         edge_times[lines, column]))
+
+            # bounds of the events within the edge lists
+            bounds = dict()
+            for edge in ["re", "fe"]:
+                bounds[edge] = np.searchsorted(edge_events[edge],
+                                               np.arange(n_triggers + 2))
+
+            # pair the n-th rising edge with the n-th falling edge
+            # of an event, add virtual falling edges if necessary
+            rank_re = (np.arange(len(edge_events["re"])) -
+                       bounds["re"][edge_events["re"]])
+            rank_fe = (np.arange(len(edge_events["fe"])) -
+                       bounds["fe"][edge_events["fe"]])
+            max_rank = max(len(edge_events["re"]), len(edge_events["fe"])) + 1
+            key_re = edge_events["re"] * max_rank + rank_re
+            key_fe = edge_events["fe"] * max_rank + rank_fe
+
+            match = np.searchsorted(key_fe, key_re)
+            match[match == len(key_fe)] = 0
+            fe = np.full(len(key_re), MAX_TRIGGER_WINDOW)
+            if len(key_fe):
+                matched = ((key_fe[match] == key_re) &
+                           ~(times["fe"][match] < times["re"]))
+                fe[matched] = times["fe"][match[matched]]
+
+            order = np.lexsort((fe, times["re"], edge_events["re"]))
+            channel_pulses = list(zip(times["re"][order].tolist(),
+                                      fe[order].tolist()))
+
+            bounds_re = bounds["re"].tolist()
+            bounds_fe = bounds["fe"].tolist()
+            pulses.append([channel_pulses[bounds_re[i]:bounds_re[i + 1]]
+                           for i in range(n_triggers)])
+
+            re_list = times["re"].tolist()
+            fe_list = times["fe"].tolist()
+            open_re[ch] = re_list[bounds_re[n_triggers]:]
+            open_fe[ch] = fe_list[bounds_fe[n_triggers]:]
+            if n_triggers:
+                last_re[ch] = re_list[bounds_re[n_triggers - 1]:
+                                      bounds_re[n_triggers]]
+                last_fe[ch] = fe_list[bounds_fe[n_triggers - 1]:
+                                      bounds_fe[n_triggers]]
+
+        extracted_pulses = list(zip(trigger_times[:n_triggers], *pulses))
+
+        if self._write_pulses and extracted_pulses:
+            self._write_events(extracted_pulses)
+
+        # store the state for the next call
+        self.re = open_re
+        self.fe = open_fe
+        if n_triggers:
+            self.last_re = last_re
+            self.last_fe = last_fe
+            self.last_trigger_time = trigger_times[-1]
+
+        return events + extracted_pulses
+
+    def skip_array(self, data):
+        """
+        Advance the trigger and 1PPS counter state over a block of
+        decoded DAQ messages without extracting any pulses. Afterwards,
+        get_counter_state returns the state extract_array would have
+        left behind.
+
+        :param data: decoded DAQ messages
+        :type data: numpy.ndarray
+        :returns: None
+        """
+        events, start = self._extract_initial(data)
+
+        if start < len(data):
+            self._process_counters(data[start:])
+
+    def get_line_times(self, data):
+        """
+        Get the times of decoded DAQ messages following the messages
+        processed so far, in seconds since day start. The counter state
+        is not changed.
+
+        :param data: decoded DAQ messages
+        :type data: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        if not len(data):
+            return np.zeros(0)
+
+        state = self.get_counter_state()
+        try:
+            return self._process_counters(data)[0]
+        finally:
+            self.set_counter_state(state)
+
+    def get_counter_state(self):
+        """
+        Get the trigger and 1PPS counter state needed to continue
+        the extraction at the next DAQ message, e.g. in another
+        PulseExtractor
+
+        :returns: dict
+        """
+        return dict((name, getattr(self, name)) for name in COUNTER_STATE)
+
+    def set_counter_state(self, state):
+        """
+        Restore a state returned by get_counter_state. Pulses of events
+        which are still open are not part of the state.
+
+        :param state: counter state
+        :type state: dict
+        :returns: None
+        """
+        for name in COUNTER_STATE:
+            setattr(self, name, state[name])
+
+    def _extract_initial(self, data):
+        """
+        Process decoded DAQ messages line by line as long as no trigger
+        has been seen, the counters are not reliable before. Returns the
+        extracted pulses and the number of messages processed.
+
+        :param data: decoded DAQ messages
+        :type data: numpy.ndarray
+        :returns: list of tuples, int
+        """
+        events = []
+
+        start = 0
+        while self.ini and start < len(data):
+            row = data[start]
+            edges = []
+            for name in EDGE_FIELDS:
+                edge = int(row[name])
+                if edge & BIT5:
+                    edges.append(float((edge & BIT0_4) * TMC_TICK))
+                else:
+                    edges.append(None)
+
+            extracted_pulses = self._extract(
+                    int(row["trigger_count"]), int(row["one_pps"]),
+                    float(row["gps_time"]), int(row["correction"]),
+                    int(row["re0"]) & BIT7, edges)
+            if extracted_pulses is not None:
+                events.append(extracted_pulses)
+            start += 1
+
+        return events, start
+
+    def _process_counters(self, data):
+        """
+        Correct the trigger and 1PPS counters of decoded DAQ messages
+        for rollover, recalculate the DAQ frequency and store the
+        counter state. Returns the time of each message and the counter
+        difference to the preceding message in ns.
+
+        :param data: decoded DAQ messages
+        :type data: numpy.ndarray
+        :returns: numpy.ndarray, numpy.ndarray
+        """
+        trigger_count = _correct_rollover(data["trigger_count"],
+                                          self.last_trigger_count)
+        one_pps = _correct_rollover(data["one_pps"], self.last_one_pps)
+        gps_time = data["gps_time"]
+
+        previous_one_pps = np.concatenate(([self.last_one_pps],
+                                           one_pps[:-1]))
+        previous_time = np.concatenate(([self.last_time], gps_time[:-1]))
+        previous_trigger_count = np.concatenate(([self.last_trigger_count],
+                                                 trigger_count[:-1]))
+
+        # every fifth change of the one_pps counter the frequency
+        # is recalculated
+        switches = np.flatnonzero(data["one_pps"] != previous_one_pps)
+        polls = switches[(self.passed_one_pps + 1 +
+                          np.arange(len(switches))) % 5 == 0]
+        frequencies = np.diff(np.concatenate(
+                ([self.last_one_pps_poll], one_pps[polls]))) / 5.0
+        frequencies[~((0.5 * frequencies < DEFAULT_FREQUENCY) &
+                      (DEFAULT_FREQUENCY < 1.5 * frequencies))] = \
+            DEFAULT_FREQUENCY
+
+        poll_index = np.full(len(data), -1)
+        poll_index[polls] = np.arange(len(polls))
+        poll_index = np.maximum.accumulate(poll_index)
+        frequency = np.concatenate(([self.calculated_frequency],
+                                    frequencies))[poll_index + 1]
+
+        # correcting for delayed one_pps switch
+        reference_one_pps = one_pps.copy()
+        delayed = np.zeros(len(data), dtype=bool)
+        delayed[switches] = gps_time[switches] == previous_time[switches]
+        reference_one_pps[delayed] = previous_one_pps[delayed]
+
+        line_time = (gps_time + data["correction"] / 1000.0 +
+                     (trigger_count - reference_one_pps) / frequency)
+
+        counter_diff = trigger_count - previous_trigger_count
+        counter_diff[counter_diff > COUNTER_OFFSET] -= COUNTER_OFFSET
+        counter_diff = counter_diff / frequency * 1e9
+
+        # store the state for the next call
+        self.trigger_count = self.last_trigger_count = \
+            int(trigger_count[-1])
+        self.prev_last_one_pps = int(previous_one_pps[-1])
+        self.last_one_pps = int(one_pps[-1])
+        self.last_time = float(gps_time[-1])
+        self.passed_one_pps = (self.passed_one_pps + len(switches)) % 5
+        if len(polls):
+            self.last_one_pps_poll = int(one_pps[polls[-1]])
+            self.calculated_frequency = float(frequencies[-1])
+
+        return line_time, counter_diff
+
+    def _extract(self, trigger_count, one_pps, gps_time, correction,
+                 trigger, edges):
+        """
+        Process one decoded DAQ message, see extract
+
+        :param trigger_count: trigger counter
+        :type trigger_count: int
+        :param one_pps: 1PPS counter
+        :type one_pps: int
+        :param gps_time: gps time in seconds since day start
+        :type gps_time: float
+        :param correction: gps time correction in milliseconds
+        :type correction: int
+        :param trigger: trigger flag
+        :type trigger: int
+        :param edges: edges as returned by _decode_edges
+        :type edges: list
+        :returns: tuple or None
+        """
+        raw_one_pps = one_pps
 
         # correct for trigger count rollover
         if trigger_count < self.last_trigger_count:
@@ -272,25 +931,25 @@ class PulseExtractor:
                         DEFAULT_FREQUENCY < 1.5 * self.calculated_frequency):
                     self.calculated_frequency = DEFAULT_FREQUENCY
 
-            if time == self.last_time:
+            if gps_time == self.last_time:
                 # correcting for delayed one_pps switch
-                line_time = self._get_evt_time(line[10], line[15],
-                                               trigger_count,
-                                               self.last_one_pps)
+                line_time = self._get_line_time(gps_time, correction,
+                                                trigger_count,
+                                                self.last_one_pps)
             else:
-                line_time = self._get_evt_time(line[10], line[15],
-                                               trigger_count, one_pps)
+                line_time = self._get_line_time(gps_time, correction,
+                                                trigger_count, one_pps)
         else:
-            line_time = self._get_evt_time(line[10], line[15],
-                                           trigger_count, one_pps)
+            line_time = self._get_line_time(gps_time, correction,
+                                            trigger_count, one_pps)
 
         # storing the last two one_pps switches
         self.prev_last_one_pps = self.last_one_pps
         self.last_one_pps = one_pps
 
-        self.last_time = time
+        self.last_time = gps_time
 
-        if int(line[1], 16) & BIT7:  # a trigger flag!
+        if trigger:  # a trigger flag!
             self.ini = False
              
             # a new trigger! we have to evaluate the
@@ -303,7 +962,7 @@ class PulseExtractor:
                                 pulses["ch1"], pulses["ch2"], pulses["ch3"])
 
             if self._write_pulses:
-                self.pulse_file.write(repr(extracted_pulses) + '\n')
+                self._write_events([extracted_pulses])
 
             # as the pulses for the last event are done,
             # reinitialize data structures
@@ -313,7 +972,7 @@ class PulseExtractor:
             self.fe = {"ch0": [], "ch1": [], "ch2": [], "ch3": []}
 
             # calculate edges of the new pulses
-            self._calculate_edges(line)
+            self._add_edges(edges)
             self.last_trigger_count = trigger_count
         
             return extracted_pulses
@@ -321,7 +980,7 @@ class PulseExtractor:
             # we do have a previous trigger and are now
             # adding more pulses to the event
             if self.ini:
-                self.last_one_pps = int(line[9], 16)
+                self.last_one_pps = raw_one_pps
             else:
                 counter_diff = (self.trigger_count - self.last_trigger_count)
                 # print(counter_diff, counter_diff > int(0xffffffff))
@@ -331,12 +990,98 @@ class PulseExtractor:
         
                 counter_diff /= self.calculated_frequency
 
-                self._calculate_edges(line, counter_diff=counter_diff * 1e9)
+                self._add_edges(edges, counter_diff=counter_diff * 1e9)
 
         # end of if trigger flag
         self.last_trigger_count = trigger_count
 
 
+def _empty_event_summary(event_count):
+    """
+    Get a summary of event_count events without any pulses
+
+    :param event_count: number of events
+    :type event_count: int
+    :returns: numpy.ndarray
+    """
+    summary = np.zeros(event_count, dtype=EVENT_SUMMARY_DTYPE)
+    for name in EVENT_SUMMARY_DTYPE.names[2:]:
+        summary[name] = np.nan
+    return summary
+
+
+def summarize_events(events):
+    """
+    Get the columnar summary of events as returned by
+    PulseExtractor.extract, which the batch triggers operate on.
+
+    :param events: extracted events
+    :type events: list of tuples
+    :returns: numpy.ndarray
+    """
+    summary = _empty_event_summary(len(events))
+    trigger_time = summary["trigger_time"]
+    pulse_count = summary["pulse_count"]
+    first_re = summary["first_rising_edge"]
+    first_fe = summary["first_falling_edge"]
+    last_re = summary["last_rising_edge"]
+    last_fe = summary["last_falling_edge"]
+
+    for index, event in enumerate(events):
+        trigger_time[index] = event[0]
+        for channel, pulses in enumerate(event[1:5]):
+            if pulses:
+                pulse_count[index, channel] = len(pulses)
+                first_re[index, channel], first_fe[index, channel] = \
+                    pulses[0]
+                last_re[index, channel], last_fe[index, channel] = \
+                    pulses[-1]
+
+    return summary
+
+
+def summarize_pulse_records(events, pulses):
+    """
+    Get the columnar summary of the events stored in a binary pulse file,
+    which the batch triggers operate on. Note that the edges are stored
+    with single precision in these files.
+
+    :param events: events as returned by
+                   muonic.analysis.pulse_store.read_pulse_file
+    :type events: numpy.ndarray
+    :param pulses: pulses of the events
+    :type pulses: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    summary = _empty_event_summary(len(events))
+    summary["trigger_time"] = events["trigger_time"]
+
+    if not len(pulses):
+        return summary
+
+    event = get_event_index(events)
+    channel = pulses["channel"].astype(np.int64)
+    rising_edge = pulses["rising_edge"].astype(np.float64)
+    falling_edge = pulses["falling_edge"].astype(np.float64)
+
+    # the pulses of a channel keep their order within the event
+    key = event * 4 + channel
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    first = order[np.flatnonzero(np.diff(key, prepend=-1))]
+    last = order[np.flatnonzero(np.diff(key, append=key[-1:] + 1))]
+
+    summary["pulse_count"] = np.bincount(
+            key, minlength=len(summary) * 4).reshape(-1, 4)
+    for name, pulse, edges in [("first_rising_edge", first, rising_edge),
+                               ("first_falling_edge", first, falling_edge),
+                               ("last_rising_edge", last, rising_edge),
+                               ("last_falling_edge", last, falling_edge)]:
+        summary[name][event[pulse], channel[pulse]] = edges[pulse]
+
+    return summary
+
+
 class VelocityTrigger:
     """
     A velocity "trigger", so that czts can be defined
@@ -383,6 +1128,62 @@ class VelocityTrigger:
             return pulses[lower_channel][0][0] - pulses[upper_channel][0][0]
         return None
 
+    def trigger_batch(self, events, upper_channel=1, lower_channel=2,
+                      pairs=None):
+        """
+        Trigger on a batch of events at once. Makes the same decisions as
+        trigger, but operates on the columnar summary of the events as
+        returned by summarize_events or summarize_pulse_records.
+
+        Returns the flight times t(lower_channel) - t(upper_channel), NaN
+        for rejected events, and the codes of the reasons for the
+        decisions, see VELOCITY_REASONS.
+
+        If a list of (upper_channel, lower_channel) pairs is given, e.g.
+        CHANNEL_PAIRS, all pairs are evaluated at once and both arrays get
+        one column per pair.
+
+        :param events: summary of the events
+        :type events: numpy.ndarray
+        :param upper_channel: index of the upper channel
+        :type upper_channel: int
+        :param lower_channel: index of the lower channel
+        :type lower_channel: int
+        :param pairs: pairs of upper and lower channel indices
+        :type pairs: list of tuple
+        :returns: tuple of numpy.ndarray
+        """
+        if pairs is None:
+            upper = np.array([upper_channel - 1])
+            lower = np.array([lower_channel - 1])
+        else:
+            upper, lower = np.array(pairs, dtype=np.int64).reshape(-1, 2).T
+            upper = upper - 1
+            lower = lower - 1
+
+        rising_edge = events["first_rising_edge"]
+        pulse_width = events["first_falling_edge"] - rising_edge
+        has_pulse = events["pulse_count"] > 0
+
+        with np.errstate(invalid="ignore"):
+            width_difference = pulse_width[:, upper] - pulse_width[:, lower]
+            pulse_width_ok = ((width_difference >= -15.) &
+                              (width_difference <= 45.))
+
+        reasons = np.select(
+                [~(has_pulse[:, upper] & has_pulse[:, lower]),
+                 ~pulse_width_ok],
+                [VELOCITY_MISSING_PULSE, VELOCITY_PULSE_WIDTH],
+                VELOCITY_ACCEPTED).astype(np.uint8)
+
+        # always use rising edge since fe might be virtual
+        flight_times = rising_edge[:, lower] - rising_edge[:, upper]
+        flight_times[reasons != VELOCITY_ACCEPTED] = np.nan
+
+        if pairs is None:
+            return flight_times[:, 0], reasons[:, 0]
+        return flight_times, reasons
+
 
 class DecayTriggerThorough:
     """
@@ -503,6 +1304,88 @@ class DecayTriggerThorough:
                           (repr(pulses1), repr(pulses2), repr(pulses3)))
         return None
 
+    def trigger_batch(self, events, single_channel=2, double_channel=3,
+                      veto_channel=4, min_decay_time=0,
+                      min_single_pulse_width=0, max_single_pulse_width=12000,
+                      min_double_pulse_width=0, max_double_pulse_width=12000):
+        """
+        Trigger on a batch of events at once. Takes the same arguments as
+        trigger and makes the same decisions, but operates on the columnar
+        summary of the events as returned by summarize_events or
+        summarize_pulse_records. The channel indices count the trigger
+        time as index 0 as in trigger.
+
+        Returns the decay times, NaN for rejected events, and the codes
+        of the reasons for the decisions, see DECAY_REASONS.
+
+        :param events: summary of the events
+        :type events: numpy.ndarray
+        :param single_channel: channel index
+        :type single_channel: int
+        :param double_channel: channel index
+        :type double_channel: int
+        :param veto_channel: channel index
+        :type veto_channel: int
+        :param min_decay_time: minimum decay time
+        :type min_decay_time: int
+        :param min_single_pulse_width: minimum single pulse width
+        :type min_single_pulse_width: int
+        :param max_single_pulse_width: maximum single pulse width
+        :type max_single_pulse_width: int
+        :param min_double_pulse_width: minimum double pulse width
+        :type min_double_pulse_width: int
+        :param max_double_pulse_width: maximum double pulse width
+        :type max_double_pulse_width: int
+        :returns: tuple of numpy.ndarray
+        """
+        single = single_channel - 1
+        double = double_channel - 1
+
+        pulse_count = events["pulse_count"]
+        pulses1 = pulse_count[:, single]
+        pulses2 = pulse_count[:, double]
+        pulses3 = pulse_count[:, veto_channel - 1]
+
+        # muon might have entered the second channel, then we do not
+        # want to have more than one hit in the first one
+        if single_channel == double_channel:
+            pulse_count_ok = (pulses2 >= 2) & (pulses1 >= 2)
+        else:
+            pulse_count_ok = (pulses2 >= 2) & (pulses1 == 1)
+
+        with np.errstate(invalid="ignore"):
+            single_pulse_width = (events["first_falling_edge"][:, single] -
+                                  events["first_rising_edge"][:, single])
+            double_pulse_width = (events["last_falling_edge"][:, double] -
+                                  events["last_rising_edge"][:, double])
+            pulse_width_ok = ((min_single_pulse_width < single_pulse_width) &
+                              (single_pulse_width < max_single_pulse_width) &
+                              (min_double_pulse_width < double_pulse_width) &
+                              (double_pulse_width < max_double_pulse_width))
+
+            # subtract rising edges, falling edges might be virtual
+            decay_times = (events["last_rising_edge"][:, double] -
+                           events["first_rising_edge"][:, double])
+
+            # there is an artifact at the end of the trigger window
+            time_ok = ((decay_times > min_decay_time) &
+                       (decay_times < self.trigger_window - 1000))
+
+        # the first failing check determines the reason
+        reasons = np.select(
+                [pulses1 + pulses2 < 2, pulses3 > 0, ~pulse_count_ok,
+                 ~pulse_width_ok, ~time_ok],
+                [DECAY_TOO_FEW_PULSES, DECAY_VETO, DECAY_PULSE_COUNT,
+                 DECAY_PULSE_WIDTH, DECAY_TIME_RANGE],
+                DECAY_ACCEPTED).astype(np.uint8)
+
+        decay_times[reasons != DECAY_ACCEPTED] = np.nan
+
+        self.logger.debug("Found %d decays in %d events" %
+                          (np.count_nonzero(reasons == DECAY_ACCEPTED),
+                           len(reasons)))
+        return decay_times, reasons
+
 
 if __name__ == '__main__':
     import sys 
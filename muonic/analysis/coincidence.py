@@ -0,0 +1,273 @@
+"""
+Coincidences of the hits of several channels.
+
+The sorted hit times of the channels are merged into one time ordered
+stream. A coincidence gate opens with a hit and contains all hits up to
+the coincidence window after it, the next gate opens with the first hit
+after the gate closed. Gates are found with array operations: hits more
+than one window apart always belong to different gates, groups of hits
+longer than one window are split by following the chain of gates, see
+_follow_gates.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from muonic.analysis.pulse_store import count_day_wraps, get_event_index
+
+__all__ = ["find_coincidences", "merge_hits", "get_hit_times",
+           "get_coincidence_dtype"]
+
+# the channel masks are stored in a signed 64 bit integer
+MAX_CHANNELS = 63
+
+# the chain of gates is followed 2 ** JUMP_LEVELS gates at a time
+JUMP_LEVELS = 6
+
+
+def get_coincidence_dtype(channels):
+    """
+    Get the dtype of the coincidences of the given number of channels:
+    the time of the first hit ('time'), the time between the first and
+    the last hit ('span'), the bit mask of the hit channels
+    ('channel_mask'), the number of hit channels ('multiplicity'), the
+    number of hits ('hits') and the first hit time of each channel, NaN
+    if the channel was not hit ('channel_times').
+
+    :param channels: number of channels
+    :type channels: int
+    :returns: numpy.dtype
+    """
+    return np.dtype([
+        ("time", np.float64),
+        ("span", np.float64),
+        ("channel_mask", np.int64),
+        ("multiplicity", np.int32),
+        ("hits", np.int32),
+        ("channel_times", np.float64, (channels,))
+    ])
+
+
+def merge_hits(hit_times):
+    """
+    Merge the sorted hit times of the channels into one time ordered
+    stream. Returns the hit times and the channel of each hit. Hits at
+    the same time are ordered by channel.
+
+    :param hit_times: sorted hit times, one array per channel
+    :type hit_times: list of numpy.ndarray
+    :returns: tuple of numpy.ndarray
+    :raises: ValueError
+    """
+    times = [np.asarray(channel_times, dtype=np.float64).ravel()
+             for channel_times in hit_times]
+
+    for channel, channel_times in enumerate(times):
+        if np.any(channel_times[1:] < channel_times[:-1]):
+            raise ValueError("hit times of channel %d are not sorted" %
+                             channel)
+
+    if not times:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+
+    merged = np.concatenate(times)
+    channels = np.repeat(np.arange(len(times), dtype=np.int64),
+                         [len(channel_times) for channel_times in times])
+
+    # a stable sort merges the sorted runs and keeps the channel order
+    order = np.argsort(merged, kind="mergesort")
+    return merged[order], channels[order]
+
+
+def _follow_gates(times, window):
+    """
+    Get the index of the hit opening each coincidence gate, if the first
+    hit opens the first gate. The hit opening the gate after each hit is
+    found for all hits at once. The chain of gates is then followed
+    2 ** JUMP_LEVELS gates at a time, the gates in between are filled in
+    with array operations.
+
+    :param times: time ordered hit times
+    :type times: numpy.ndarray
+    :param window: coincidence window
+    :type window: float
+    :returns: numpy.ndarray
+    """
+    count = len(times)
+
+    # the next gate opens with the first hit after the window, the hit
+    # after the last one points to itself
+    following = np.empty(count + 1, dtype=np.int64)
+    following[:count] = np.searchsorted(times, times + window, side="right")
+    following[count] = count
+
+    jump = following
+    for _ in range(JUMP_LEVELS):
+        jump = jump[jump]
+
+    anchors = []
+    start = 0
+    while start < count:
+        anchors.append(start)
+        start = jump[start]
+
+    gates = [np.array(anchors, dtype=np.int64)]
+    for _ in range(2 ** JUMP_LEVELS - 1):
+        gates.append(following[gates[-1]])
+
+    # the gates following each anchor are ordered, the chain ends with
+    # the hit after the last one
+    gates = np.stack(gates, axis=1).ravel()
+    return gates[gates < count]
+
+
+def _get_gate_starts(times, window):
+    """
+    Get the index of the hit opening each coincidence gate.
+
+    :param times: time ordered hit times
+    :type times: numpy.ndarray
+    :param window: coincidence window
+    :type window: float
+    :returns: numpy.ndarray
+    """
+    # hits more than one window after the previous hit open a gate, the
+    # window is added like in _follow_gates to round the same way
+    group_start = np.ones(len(times), dtype=bool)
+    group_start[1:] = times[1:] > times[:-1] + window
+    group_starts = np.flatnonzero(group_start)
+    group_stops = np.append(group_starts[1:], len(times))
+
+    # groups longer than one window contain more than one gate
+    long_groups = np.flatnonzero(times[group_stops - 1] >
+                                 times[group_starts] + window)
+    if not len(long_groups):
+        return group_starts
+
+    # the gates of a group end before the next group, so the gates of
+    # all long groups are found by following one chain over their hits
+    lengths = group_stops[long_groups] - group_starts[long_groups]
+    offsets = np.cumsum(lengths) - lengths
+    hits = (np.arange(lengths.sum()) +
+            np.repeat(group_starts[long_groups] - offsets, lengths))
+
+    group_start[hits[_follow_gates(times[hits], window)]] = True
+    return np.flatnonzero(group_start)
+
+
+def find_coincidences(hit_times, window, multiplicity=2, combinations=None):
+    """
+    Find the coincidences of hits in the given channels within the
+    coincidence window. A coincidence needs hits in at least multiplicity
+    different channels and, if combinations are given, hits in all
+    channels of at least one of the combinations.
+
+    The hit times of each channel have to be sorted, the window is in
+    the unit of the hit times. Channels are numbered by their position
+    in hit_times. Returns a structured array with the dtype of
+    get_coincidence_dtype.
+
+    :param hit_times: sorted hit times, one array per channel
+    :type hit_times: list of numpy.ndarray
+    :param window: coincidence window
+    :type window: float
+    :param multiplicity: minimum number of hit channels
+    :type multiplicity: int
+    :param combinations: channel combinations, e.g. ((0, 2), (1, 3))
+    :type combinations: list of tuple
+    :returns: numpy.ndarray
+    :raises: ValueError
+    """
+    channel_count = len(hit_times)
+
+    if channel_count > MAX_CHANNELS:
+        raise ValueError("at most %d channels are supported" %
+                         MAX_CHANNELS)
+    if window < 0:
+        raise ValueError("the coincidence window must not be negative")
+
+    combination_masks = None
+    if combinations is not None:
+        combination_masks = np.zeros(len(combinations), dtype=np.int64)
+        for index, combination in enumerate(combinations):
+            for channel in combination:
+                if not 0 <= channel < channel_count:
+                    raise ValueError("unknown channel %s" % channel)
+                combination_masks[index] |= 1 << channel
+
+    times, channels = merge_hits(hit_times)
+    dtype = get_coincidence_dtype(channel_count)
+
+    if not len(times):
+        return np.zeros(0, dtype=dtype)
+
+    starts = _get_gate_starts(times, window)
+    stops = np.append(starts[1:], len(times))
+
+    channel_masks = np.bitwise_or.reduceat(
+            np.left_shift(np.int64(1), channels), starts)
+
+    multiplicities = np.zeros(len(starts), dtype=np.int32)
+    for channel in range(channel_count):
+        multiplicities += (channel_masks >> channel) & 1
+
+    accepted = multiplicities >= multiplicity
+    if combination_masks is not None:
+        accepted &= np.any((channel_masks[:, np.newaxis] &
+                            combination_masks) == combination_masks, axis=1)
+
+    starts = starts[accepted]
+    stops = stops[accepted]
+
+    coincidences = np.zeros(len(starts), dtype=dtype)
+    coincidences["time"] = times[starts]
+    coincidences["span"] = times[stops - 1] - times[starts]
+    coincidences["channel_mask"] = channel_masks[accepted]
+    coincidences["multiplicity"] = multiplicities[accepted]
+    coincidences["hits"] = stops - starts
+
+    for channel in range(channel_count):
+        # the first hit of the channel at or after the start of the gate
+        hit_index = np.flatnonzero(channels == channel)
+        first_hit = np.searchsorted(hit_index, starts)
+        has_hit = first_hit < len(hit_index)
+        has_hit[has_hit] = hit_index[first_hit[has_hit]] < stops[has_hit]
+
+        channel_times = np.full(len(starts), np.nan)
+        channel_times[has_hit] = times[hit_index[first_hit[has_hit]]]
+        coincidences["channel_times"][:, channel] = channel_times
+
+    return coincidences
+
+
+def get_hit_times(events, pulses, channels=4, min_pulse_width=0.):
+    """
+    Get the sorted hit times of each channel from the events and pulses
+    of a binary pulse file in the order of the file. A hit is the rising
+    edge of a pulse, in seconds since the start of the day of the first
+    event. The trigger times are times of day, a midnight is passed when
+    they decrease by more than DAY_WRAP.
+
+    :param events: events of a pulse file
+    :type events: numpy.ndarray
+    :param pulses: pulses of the events
+    :type pulses: numpy.ndarray
+    :param channels: number of channels
+    :type channels: int
+    :param min_pulse_width: minimum pulse width in ns
+    :type min_pulse_width: float
+    :returns: list of numpy.ndarray
+    """
+    trigger_time = np.array(events["trigger_time"], dtype=np.float64)
+    trigger_time += count_day_wraps(trigger_time) * 86400.
+
+    channel = pulses["channel"]
+    width = pulses["falling_edge"] - pulses["rising_edge"]
+    valid = width >= min_pulse_width
+
+    event = get_event_index(events)[valid]
+    times = (trigger_time[event] +
+             pulses["rising_edge"][valid].astype(np.float64) * 1e-9)
+    channel = channel[valid]
+
+    return [np.sort(times[channel == index]) for index in range(channels)]
@@ -3,24 +3,62 @@ Script for performing a fit to a histogramm of recorded
 time differences for the use with QNet
 """
 from __future__ import print_function
+import logging
 import sys
 
 from matplotlib import pylab
 import numpy
 import scipy.optimize as optimize
 
+# the unbinned fit of more decay times starts from a fit to every
+# SUBSAMPLE_STRIDE-th decay time
+SUBSAMPLE_SIZE = 200000
+SUBSAMPLE_STRIDE = 16
 
-def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
+
+def exponential_decay(p, x):
+    """
+    Exponential decay with a constant background
+
+    :param p: amplitude, lifetime and background
+    :type p: list
+    :param x: decay times
+    :type x: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    return p[0] * numpy.exp(-x / p[1]) + p[2]
+
+
+def gaussian(p, x):
+    """
+    Gaussian with a given area
+
+    :param p: area, width and mean
+    :type p: list
+    :param x: values
+    :type x: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    return (p[0] * (1 / (p[1] * numpy.sqrt(2 * numpy.pi))) *
+            numpy.exp(-0.5 * (((x - p[2]) / p[1]) ** 2)))
+
+
+def fit(bincontent=None, binning=(0, 10, 21), fitrange=None, logger=None):
     """
     Fit function
 
     :param bincontent:
     :param binning:
     :param fitrange:
+    :param logger: logger object
+    :type logger: logging.Logger
     :returns:
     """
-    def decay(p, x):
-        return p[0] * numpy.exp(-x / p[1]) + p[2]
+    if logger is None:
+        logger = logging.getLogger()
+
+    # module level, so the results can be sent between processes
+    decay = exponential_decay
     
     def error(p, x, y):
         return decay(p, x) - y
@@ -85,7 +123,7 @@ def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
         # this is then used for the mudecay window in muonic.
         # we have to adjust the bins to the values of the used histogram.
         if len(bincontent) == 0:
-            print("WARNING: Empty bins.")
+            logger.warning("Empty bins.")
             return None
     
         bins = numpy.linspace(binning[0], binning[1], binning[2])
@@ -96,14 +134,14 @@ def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
             if fitrange[1] > binning[1]:
                 fitrange = (fitrange[0], binning[1])
 
-            bin_mask = [(bin_centers <= fitrange[1]) &
-                        (bin_centers >= fitrange[0])]
+            bin_mask = ((bin_centers <= fitrange[1]) &
+                        (bin_centers >= fitrange[0]))
             bin_centers_ = numpy.asarray([x for x in bin_centers
                                           if fitrange[0] <= x <= fitrange[1]])
 
             if len(bin_centers_) < 3:
-                print("WARNING: fit range too small. " +
-                      "Skipping fitting. Try with larger fit range.")
+                logger.warning("Fit range too small. " +
+                               "Skipping fitting. Try with larger fit range.")
                 return None
             else:
                 bin_centers = bin_centers_
@@ -144,8 +182,8 @@ def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
         p = output[0]
         covar = output[1]
         
-        print("Fit parameters:", p)
-        print("Covariance matrix:", covar)
+        logger.info("Fit parameters: %s" % p)
+        logger.info("Covariance matrix: %s" % covar)
         
         chisquare = 0.
         deviations = error(p, cut_bincenters, cut_bincontent)
@@ -170,24 +208,500 @@ def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
                 decay, p, covar, chisquare, nbins)
      
 
-def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None):
+def lifetime_pdf(p, x, fitrange):
+    """
+    Probability density of an exponential decay plus a flat background,
+    normalized within the fit range
+
+    :param p: lifetime and background fraction
+    :type p: list
+    :param x: decay times
+    :type x: numpy.ndarray
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :returns: numpy.ndarray
+    """
+    lower, upper = fitrange
+    norm = p[0] * (numpy.exp(-lower / p[0]) - numpy.exp(-upper / p[0]))
+    return ((1. - p[1]) * numpy.exp(-numpy.asarray(x) / p[0]) / norm +
+            p[1] / (upper - lower))
+
+
+def _lifetime_likelihood(times, p, fitrange, likelihood=True, buffer=None,
+                         weights=None):
+    """
+    Log-likelihood of the decay times with its gradient and Hessian
+    with respect to the lifetime and the background fraction. The
+    log-likelihood is None unless requested. If weights are given, each
+    decay time counts as many decays.
+
+    Allocating the temporary arrays is expensive for many decay times,
+    pass a buffer of shape (3, len(times)) to reuse it between calls.
+
+    :param times: decay times within the fit range
+    :type times: numpy.ndarray
+    :param p: lifetime and background fraction
+    :type p: numpy.ndarray
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :param likelihood: calculate the log-likelihood
+    :type likelihood: bool
+    :param buffer: memory for the temporary arrays
+    :type buffer: numpy.ndarray
+    :param weights: number of decays of each decay time
+    :type weights: numpy.ndarray
+    :returns: tuple
+    """
+    tau, background = p
+    lower, upper = fitrange
+    flat = 1. / (upper - lower)
+
+    # normalization of the exponential and the first and second
+    # derivative of its logarithm
+    exp_lower = numpy.exp(-lower / tau)
+    exp_upper = numpy.exp(-upper / tau)
+    norm = tau * (exp_lower - exp_upper)
+    k_1 = ((exp_lower - exp_upper) +
+           (lower * exp_lower - upper * exp_upper) / tau) / norm
+    k_2 = ((lower ** 2 * exp_lower - upper ** 2 * exp_upper) /
+           tau ** 3 / norm - k_1 ** 2)
+
+    # with u = exp(-t / tau) the signal density is g = u / norm and the
+    # total density f = d / norm with d = (1 - background) * u +
+    # background * flat * norm. Everything is expressed by the moments
+    # of w = g / f, w * t and r = 1 / d
+    if buffer is None:
+        buffer = numpy.empty((3, len(times)))
+    w, wt, r = buffer
+    numpy.multiply(times, -1. / tau, out=w)
+    numpy.exp(w, out=w)
+    numpy.multiply(w, 1. - background, out=r)
+    r += background * flat * norm
+    log_likelihood = None
+    if likelihood:
+        if weights is None:
+            log_likelihood = (numpy.log(r).sum() -
+                              len(times) * numpy.log(norm))
+        else:
+            log_likelihood = (weights.dot(numpy.log(r)) -
+                              weights.sum() * numpy.log(norm))
+    numpy.reciprocal(r, out=r)
+    w *= r
+    numpy.multiply(w, times, out=wt)
+
+    if weights is None:
+        weighted_w, weighted_wt, weighted_r = w, wt, r
+    else:
+        weighted_w, weighted_wt, weighted_r = w * weights, wt * weights, \
+            r * weights
+
+    sum_w = weighted_w.sum()
+    sum_wt = weighted_wt.sum()
+    sum_wtt = weighted_wt.dot(times)
+    sum_w2 = weighted_w.dot(w)
+    sum_w2t = weighted_wt.dot(w)
+    sum_w2tt = weighted_wt.dot(wt)
+    sum_q = norm * weighted_r.sum()
+    sum_q2 = norm ** 2 * weighted_r.dot(r)
+    sum_wq = norm * weighted_w.dot(r)
+    sum_wqt = norm * weighted_wt.dot(r)
+
+    # d log g / d tau = h = t / tau^2 - k_1 and dh / d tau =
+    # -2 t / tau^3 - k_2, so all sums reduce to the moments above
+    sum_wh = sum_wt / tau ** 2 - k_1 * sum_w
+    sum_whh = (sum_wtt / tau ** 4 - 2 * k_1 * sum_wt / tau ** 2 +
+               k_1 ** 2 * sum_w)
+    sum_w2hh = (sum_w2tt / tau ** 4 - 2 * k_1 * sum_w2t / tau ** 2 +
+                k_1 ** 2 * sum_w2)
+    sum_wdh = -2 * sum_wt / tau ** 3 - k_2 * sum_w
+    sum_wqh = sum_wqt / tau ** 2 - k_1 * sum_wq
+    sum_w2h = sum_w2t / tau ** 2 - k_1 * sum_w2
+
+    gradient = numpy.array([(1. - background) * sum_wh,
+                            flat * sum_q - sum_w])
+
+    h_tt = ((1. - background) * (sum_whh + sum_wdh) -
+            (1. - background) ** 2 * sum_w2hh)
+    h_tb = -sum_wh - (1. - background) * (flat * sum_wqh - sum_w2h)
+    h_bb = -(flat ** 2 * sum_q2 - 2 * flat * sum_wq + sum_w2)
+    hessian = numpy.array([[h_tt, h_tb], [h_tb, h_bb]])
+
+    return log_likelihood, gradient, hessian
+
+
+def _clip_lifetime_parameters(p):
+    """
+    Keep the background fraction within [0, 1)
+
+    :param p: lifetime and background fraction
+    :type p: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    p[1] = min(max(p[1], 0.), 1. - 1e-9)
+    return p
+
+
+def _maximize_lifetime_likelihood(times, p, fitrange, max_iterations,
+                                  tolerance, weights=None):
+    """
+    Maximize the likelihood with damped Newton steps, the step is
+    halved until the likelihood increases.
+
+    :param times: decay times within the fit range
+    :type times: numpy.ndarray
+    :param p: start values of the lifetime and the background fraction
+    :type p: numpy.ndarray
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :param max_iterations: maximum number of Newton steps
+    :type max_iterations: int
+    :param tolerance: step size relative to the uncertainty to stop at
+    :type tolerance: float
+    :param weights: number of decays of each decay time
+    :type weights: numpy.ndarray
+    :returns: tuple
+    """
+    buffer = numpy.empty((3, len(times)))
+    log_likelihood, gradient, hessian = _lifetime_likelihood(
+            times, p, fitrange, buffer=buffer, weights=weights)
+
+    for _ in range(max_iterations):
+        try:
+            step = numpy.linalg.solve(hessian, -gradient)
+        except numpy.linalg.LinAlgError:
+            break
+
+        # go uphill if the likelihood is not concave here
+        concave = numpy.all(numpy.linalg.eigvalsh(hessian) < 0)
+        if not concave or gradient.dot(step) <= 0:
+            step = gradient / numpy.abs(numpy.diag(hessian)).clip(1e-300)
+        elif numpy.all(numpy.abs(step) <= tolerance *
+                       numpy.sqrt(numpy.diag(numpy.linalg.inv(-hessian)))):
+            return _clip_lifetime_parameters(p + step), gradient, hessian
+
+        scale = 1.
+        while scale > 1e-10:
+            p_new = _clip_lifetime_parameters(p + scale * step)
+            if p_new[0] > 0:
+                result = _lifetime_likelihood(times, p_new, fitrange,
+                                              buffer=buffer, weights=weights)
+                if result[0] >= log_likelihood:
+                    break
+            scale /= 2.
+        else:
+            break
+
+        p = p_new
+        log_likelihood, gradient, hessian = result
+
+    return p, gradient, hessian
+
+
+def _fit_lifetime(times, p0, fitrange, max_iterations, tolerance):
+    """
+    Maximize the likelihood of many decay times. The start values are
+    taken from a fit to every SUBSAMPLE_STRIDE-th decay time, so only
+    few Newton steps are done on all of them.
+
+    :param times: decay times within the fit range
+    :type times: numpy.ndarray
+    :param p0: start values of the lifetime and the background fraction
+    :type p0: numpy.ndarray
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :param max_iterations: maximum number of Newton steps
+    :type max_iterations: int
+    :param tolerance: step size relative to the uncertainty to stop at
+    :type tolerance: float
+    :returns: tuple
+    """
+    if len(times) < SUBSAMPLE_SIZE:
+        return _maximize_lifetime_likelihood(times, p0, fitrange,
+                                             max_iterations, tolerance)
+
+    p, gradient, hessian = _fit_lifetime(times[::SUBSAMPLE_STRIDE], p0,
+                                         fitrange, max_iterations,
+                                         tolerance)
+
+    # plain Newton steps as long as they converge, the start values
+    # are already close to the maximum
+    buffer = numpy.empty((3, len(times)))
+    previous_step = None
+    for _ in range(max_iterations):
+        p = _clip_lifetime_parameters(p)
+        log_likelihood, gradient, hessian = _lifetime_likelihood(
+                times, p, fitrange, likelihood=False, buffer=buffer)
+        try:
+            step = numpy.linalg.solve(hessian, -gradient)
+            errors = numpy.sqrt(numpy.diag(numpy.linalg.inv(-hessian)))
+        except (numpy.linalg.LinAlgError, FloatingPointError):
+            break
+
+        step_size = numpy.abs(step / errors).max()
+        if not numpy.isfinite(step_size) or (previous_step is not None and
+                                             step_size > previous_step):
+            break
+
+        # Newton steps converge quadratically, so the next step would be
+        # about step_size ** 3 / previous_step ** 2
+        if step_size <= tolerance or (
+                previous_step is not None and
+                step_size ** 3 <= tolerance * previous_step ** 2):
+            return _clip_lifetime_parameters(p + step), gradient, hessian
+
+        previous_step = step_size
+        p = p + step
+
+    return _maximize_lifetime_likelihood(times, p, fitrange,
+                                         max_iterations, tolerance)
+
+
+def lifetime_likelihood_fit(decay_times, fitrange=(1.5, 10.), p0=None,
+                            max_iterations=50, tolerance=1e-2, logger=None):
+    """
+    Unbinned maximum likelihood fit of an exponential decay plus a flat
+    background to the decay times within the fit range. The likelihood
+    is maximized with Newton steps using its analytic gradient and
+    Hessian, the covariance matrix is the inverse of the negative
+    Hessian at the maximum.
+
+    Returns the lifetime and background fraction, their covariance
+    matrix and the number of decay times within the fit range or None
+    if the fit failed.
+
+    :param decay_times: decay times
+    :type decay_times: numpy.ndarray
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :param p0: start values of the lifetime and the background fraction
+    :type p0: list
+    :param max_iterations: maximum number of Newton steps
+    :type max_iterations: int
+    :param tolerance: stop if the Newton step is smaller than tolerance
+                      times the uncertainty of the parameters
+    :type tolerance: float
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: tuple or None
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    times = numpy.asarray(decay_times, dtype=numpy.float64)
+    times = times[(times >= fitrange[0]) & (times <= fitrange[1])]
+
+    if len(times) < 3:
+        logger.warning("Too few decays in fit range. Skipping fitting.")
+        return None
+
+    if p0 is None:
+        # the mean of an exponential shifted to the lower limit
+        p0 = [max(times.mean() - fitrange[0],
+                  1e-3 * (fitrange[1] - fitrange[0])), 0.1]
+
+    p, gradient, hessian = _fit_lifetime(
+            times, numpy.array(p0, dtype=numpy.float64), fitrange,
+            max_iterations, tolerance)
+
+    try:
+        covar = numpy.linalg.inv(-hessian)
+    except numpy.linalg.LinAlgError:
+        covar = None
+
+    if not numpy.all(numpy.isfinite(p)) or p[0] <= 0:
+        logger.warning("Fit did not converge.")
+        return None
+
+    logger.info("Fit parameters: %s" % p)
+    logger.info("Covariance matrix: %s" % covar)
+
+    return p, covar, len(times)
+
+
+class LifetimeEstimator(object):
+    """
+    Estimates the muon lifetime while the decays come in. The decay
+    times within the fit range are accumulated in many narrow bins, each
+    bin keeps the number of decays and the sum of their decay times. So
+    adding a decay takes constant time, and the unbinned likelihood of
+    lifetime_likelihood_fit is evaluated at the mean decay time of the
+    bins, weighted with their counts. The fit starts from the previous
+    result, so an update usually takes one or two Newton steps over the
+    bins, independent of the number of decays.
+
+    :param fitrange: lower and upper limit of the decay times
+    :type fitrange: tuple
+    :param bins: number of bins
+    :type bins: int
+    :param min_decays: minimum number of decays within the fit range
+                       to estimate the lifetime
+    :type min_decays: int
+    """
+
+    def __init__(self, fitrange=(1.5, 10.), bins=1000, min_decays=20):
+        self.fitrange = tuple(fitrange)
+        self.bins = bins
+        self.min_decays = min_decays
+        self._bin_width = (self.fitrange[1] - self.fitrange[0]) / bins
+        self.counts = numpy.zeros(bins)
+        self.sums = numpy.zeros(bins)
+        self.decay_count = 0
+        self.p = None
+        self.covar = None
+        self._changed = False
+
+    def _get_bin(self, decay_time):
+        """
+        Get the bin of a decay time, None if it is outside of the fit
+        range
+
+        :param decay_time: decay time
+        :type decay_time: float
+        :returns: int or None
+        """
+        if not self.fitrange[0] <= decay_time <= self.fitrange[1]:
+            return None
+        return min(int((decay_time - self.fitrange[0]) / self._bin_width),
+                   self.bins - 1)
+
+    def add(self, decay_time):
+        """
+        Add a decay time.
+
+        :param decay_time: decay time
+        :type decay_time: float
+        :returns: None
+        """
+        index = self._get_bin(decay_time)
+        if index is not None:
+            self.counts[index] += 1
+            self.sums[index] += decay_time
+            self.decay_count += 1
+            self._changed = True
+
+    def extend(self, decay_times):
+        """
+        Add many decay times at once.
+
+        :param decay_times: decay times
+        :type decay_times: list or numpy.ndarray
+        :returns: None
+        """
+        decay_times = numpy.asarray(decay_times, dtype=numpy.float64)
+        decay_times = decay_times[(decay_times >= self.fitrange[0]) &
+                                  (decay_times <= self.fitrange[1])]
+        if not len(decay_times):
+            return
+
+        indices = numpy.minimum(((decay_times - self.fitrange[0]) /
+                                 self._bin_width).astype(numpy.int64),
+                                self.bins - 1)
+        self.counts += numpy.bincount(indices, minlength=self.bins)
+        self.sums += numpy.bincount(indices, decay_times,
+                                    minlength=self.bins)
+        self.decay_count += len(decay_times)
+        self._changed = True
+
+    def update(self, max_iterations=50, tolerance=1e-2):
+        """
+        Update the estimate with the decays added since the last
+        update. Returns the lifetime and background fraction and their
+        covariance matrix, None if there are not enough decays yet.
+
+        :param max_iterations: maximum number of Newton steps
+        :type max_iterations: int
+        :param tolerance: stop if the Newton step is smaller than tolerance
+                          times the uncertainty of the parameters
+        :type tolerance: float
+        :returns: tuple or None
+        """
+        if self.decay_count < self.min_decays:
+            return None
+        if not self._changed:
+            return self.p, self.covar
+
+        filled = numpy.flatnonzero(self.counts)
+        weights = self.counts[filled]
+        times = self.sums[filled] / weights
+
+        p0 = self.p
+        if p0 is None:
+            p0 = [max(self.sums.sum() / self.decay_count - self.fitrange[0],
+                      self._bin_width), 0.1]
+
+        p, gradient, hessian = _maximize_lifetime_likelihood(
+                times, numpy.array(p0, dtype=numpy.float64), self.fitrange,
+                max_iterations, tolerance, weights=weights)
+
+        if not numpy.all(numpy.isfinite(p)) or p[0] <= 0:
+            return None
+
+        try:
+            self.covar = numpy.linalg.inv(-hessian)
+        except numpy.linalg.LinAlgError:
+            self.covar = None
+        self.p = p
+        self._changed = False
+        return self.p, self.covar
+
+    @property
+    def lifetime(self):
+        """
+        The lifetime of the last update, None if not available
+
+        :returns: float or None
+        """
+        return None if self.p is None else self.p[0]
+
+    @property
+    def lifetime_error(self):
+        """
+        The uncertainty of the lifetime of the last update, None if not
+        available
+
+        :returns: float or None
+        """
+        if self.covar is None:
+            return None
+        return numpy.sqrt(numpy.absolute(self.covar[0][0]))
+
+    def reset(self):
+        """
+        Remove all decays.
+
+        :returns: None
+        """
+        self.counts[:] = 0
+        self.sums[:] = 0
+        self.decay_count = 0
+        self.p = None
+        self.covar = None
+        self._changed = False
+
+
+def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None,
+                 logger=None):
     """
     Guassian fit function
 
     :param bincontent:
     :param binning:
     :param fitrange:
+    :param logger: logger object
+    :type logger: logging.Logger
     :returns:
     """
-    def gauss(p, x):
-        return (p[0] * (1 / (p[1] * numpy.sqrt(2 * numpy.pi))) *
-                numpy.exp(-0.5 * (((x - p[2]) / p[1]) ** 2)))
+    if logger is None:
+        logger = logging.getLogger()
+
+    # module level, so the results can be sent between processes
+    gauss = gaussian
     
     def error(p, x, y):
         return gauss(p, x) - y
     
     if len(bincontent) == 0:
-        print("WARNING: Empty bins.")
+        logger.warning("Empty bins.")
         return None
     
     # this is then used for the mudecay window in muonic.
@@ -201,13 +715,13 @@ def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None):
             fitrange = (binning[0], fitrange[1])
         if fitrange[1] > binning[1]:
             fitrange = (fitrange[0], binning[1])
-        bin_mask = [(bin_centers <= fitrange[1]) &
-                    (bin_centers >= fitrange[0])]
+        bin_mask = ((bin_centers <= fitrange[1]) &
+                    (bin_centers >= fitrange[0]))
         bin_centers_ = numpy.asarray([x for x in bin_centers
                                       if fitrange[0] <= x <= fitrange[1]])
         if len(bin_centers_) < 3:
-            print("WARNING: fit range too small. " +
-                  "Skipping fitting. Try with larger fit range.")
+            logger.warning("Fit range too small. " +
+                           "Skipping fitting. Try with larger fit range.")
             return None
         else:
             bin_centers = bin_centers_
@@ -255,8 +769,8 @@ def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None):
     p = output[0]
     covar = output[1]
     
-    print("Fit parameters:", p)
-    print("Covariance matrix:", covar)
+    logger.info("Fit parameters: %s" % p)
+    logger.info("Covariance matrix: %s" % covar)
     
     chisquare = 0.
     deviations = error(p, cut_bincenters, cut_bincontent)
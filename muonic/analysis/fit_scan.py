@@ -0,0 +1,336 @@
+"""
+Scans of the fit range of the lifetime and velocity fits.
+
+The histogram is fitted for a grid of lower limits of the fit range. For
+each fit range the fit is repeated on bootstrap resamples of the
+histogram, which gives confidence bands of the fitted value. The fit
+ranges are distributed over a process pool. Results are cached by the
+content of the histogram and the scan settings, so repeating a scan
+returns immediately.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import hashlib
+import logging
+import multiprocessing as mp
+import warnings
+
+import numpy as np
+
+from muonic.analysis.fit import fit, gaussian_fit
+
+__all__ = ["scan_fit_range", "find_cached_scan", "cache_scan",
+           "get_scan_key", "clear_scan_cache"]
+
+# fit function and index of the fitted value in its parameters
+FIT_FUNCTIONS = {
+    "lifetime": (fit, 1),
+    "velocity": (gaussian_fit, 2)
+}
+
+# number of scans kept in the cache
+CACHE_SIZE = 32
+
+_scan_cache = OrderedDict()
+
+# logger of the fits of a scan, which discards their messages
+_fit_logger = logging.Logger("fit_scan")
+_fit_logger.addHandler(logging.NullHandler())
+
+
+def _fit_value(kind, bincontent, binning, fitrange):
+    """
+    Fit the histogram and get the fitted value and its error, NaN if the
+    fit failed. The warnings and log messages of the fit functions are
+    suppressed.
+
+    :param kind: 'lifetime' or 'velocity'
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: start, stop and number of bin edges
+    :type binning: tuple
+    :param fitrange: lower and upper limit of the fit
+    :type fitrange: tuple
+    :returns: tuple of float
+    """
+    fit_function, index = FIT_FUNCTIONS[kind]
+
+    try:
+        with warnings.catch_warnings(), np.errstate(all="ignore"):
+            warnings.simplefilter("ignore")
+            result = fit_function(bincontent, binning=binning,
+                                  fitrange=fitrange, logger=_fit_logger)
+    except (ValueError, TypeError, IndexError, np.linalg.LinAlgError):
+        result = None
+
+    if result is None:
+        return np.nan, np.nan
+
+    p, covar = result[4], result[5]
+    error = np.nan
+    if covar is not None:
+        error = np.sqrt(np.absolute(covar[index][index]))
+    return p[index], error
+
+
+def _scan_fit_range(args):
+    """
+    Fit a histogram and its bootstrap resamples for one fit range
+
+    :param args: kind, bin contents, binning, fit range, number of
+                 bootstrap resamples and random seed
+    :type args: tuple
+    :returns: tuple
+    """
+    kind, bincontent, binning, fitrange, bootstrap, seed = args
+
+    value, error = _fit_value(kind, bincontent, binning, fitrange)
+
+    # resample the histogram as if the events were drawn again
+    random_state = np.random.RandomState(seed)
+    total = int(bincontent.sum())
+    probabilities = bincontent / float(total)
+    bootstrap_values = np.full(bootstrap, np.nan)
+
+    for index in range(bootstrap):
+        resample = random_state.multinomial(total, probabilities)
+        bootstrap_values[index] = _fit_value(
+                kind, resample.astype(np.float64), binning, fitrange)[0]
+
+    return value, error, bootstrap_values
+
+
+def get_scan_key(kind, bincontent, binning, lower_limits, upper_limit,
+                 bootstrap, confidence, seed):
+    """
+    Get the hash of the histogram content and the scan settings, under
+    which the scan is cached.
+
+    :param kind: 'lifetime' or 'velocity'
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: start, stop and number of bin edges
+    :type binning: tuple
+    :param lower_limits: lower limits of the fit range
+    :type lower_limits: numpy.ndarray
+    :param upper_limit: upper limit of the fit range
+    :type upper_limit: float
+    :param bootstrap: number of bootstrap resamples
+    :type bootstrap: int
+    :param confidence: confidence level of the bands
+    :type confidence: float
+    :param seed: random seed
+    :type seed: int
+    :returns: str
+    """
+    key = hashlib.sha1()
+    key.update(repr((kind, tuple(binning), float(upper_limit),
+                     int(bootstrap), float(confidence),
+                     seed)).encode("ascii"))
+    key.update(np.ascontiguousarray(bincontent,
+                                    dtype=np.float64).tobytes())
+    key.update(np.ascontiguousarray(lower_limits,
+                                    dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def clear_scan_cache():
+    """
+    Remove all cached scans.
+
+    :returns: None
+    """
+    _scan_cache.clear()
+
+
+def cache_scan(scan):
+    """
+    Store a scan under its key in the cache, e.g. a scan which was
+    made in another process.
+
+    :param scan: scan as returned by scan_fit_range
+    :type scan: dict
+    :returns: None
+    """
+    _scan_cache.pop(scan["key"], None)
+    _scan_cache[scan["key"]] = scan
+    while len(_scan_cache) > CACHE_SIZE:
+        _scan_cache.popitem(last=False)
+
+
+def _prepare_scan(kind, bincontent, binning, upper_limit, lower_limits,
+                  bootstrap, confidence, seed):
+    """
+    Check the scan settings and get the bin contents, the lower limits
+    and the cache key of the scan.
+
+    :param kind: 'lifetime' or 'velocity'
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: start, stop and number of bin edges
+    :type binning: tuple
+    :param upper_limit: upper limit of the fit range
+    :type upper_limit: float
+    :param lower_limits: lower limits of the fit range or None
+    :type lower_limits: list or numpy.ndarray
+    :param bootstrap: number of bootstrap resamples
+    :type bootstrap: int
+    :param confidence: confidence level of the bands
+    :type confidence: float
+    :param seed: random seed
+    :type seed: int
+    :returns: tuple
+    :raises: ValueError
+    """
+    if kind not in FIT_FUNCTIONS:
+        raise ValueError("unknown fit '%s'" % kind)
+
+    bincontent = np.asarray(bincontent, dtype=np.float64)
+    if bincontent.sum() <= 0:
+        raise ValueError("the histogram is empty")
+
+    if lower_limits is None:
+        edges = np.linspace(binning[0], binning[1], binning[2])
+        lower_limits = edges[edges <= upper_limit -
+                             3 * (edges[1] - edges[0])]
+    lower_limits = np.asarray(lower_limits, dtype=np.float64)
+
+    key = get_scan_key(kind, bincontent, binning, lower_limits,
+                       upper_limit, bootstrap, confidence, seed)
+    return bincontent, lower_limits, key
+
+
+def find_cached_scan(kind, bincontent, binning, upper_limit,
+                     lower_limits=None, bootstrap=100, confidence=0.68,
+                     seed=0):
+    """
+    Get the cached scan for the histogram and the scan settings without
+    scanning. Returns None if the scan is not cached. The parameters are
+    the ones of scan_fit_range.
+
+    :param kind: 'lifetime' or 'velocity'
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: start, stop and number of bin edges
+    :type binning: tuple
+    :param upper_limit: upper limit of the fit range
+    :type upper_limit: float
+    :param lower_limits: lower limits of the fit range
+    :type lower_limits: list or numpy.ndarray
+    :param bootstrap: number of bootstrap resamples per fit range
+    :type bootstrap: int
+    :param confidence: confidence level of the bands
+    :type confidence: float
+    :param seed: random seed of the resamples
+    :type seed: int
+    :returns: dict or None
+    :raises: ValueError
+    """
+    key = _prepare_scan(kind, bincontent, binning, upper_limit,
+                        lower_limits, bootstrap, confidence, seed)[2]
+    if key not in _scan_cache:
+        return None
+    _scan_cache[key] = _scan_cache.pop(key)
+    return _scan_cache[key]
+
+
+def scan_fit_range(kind, bincontent, binning, upper_limit, lower_limits=None,
+                   bootstrap=100, confidence=0.68, processes=None, seed=0,
+                   logger=None):
+    """
+    Fit a histogram for a grid of lower limits of the fit range and get
+    the stability of the fitted value, the lifetime for kind 'lifetime'
+    and the mean flight time for kind 'velocity'.
+
+    Returns a dict with the cache key ('key'), the lower limits
+    ('lower_limits'), the fitted
+    values and their fit errors ('values', 'errors'), the median and the
+    confidence band of the bootstrap resamples ('median', 'lower_band',
+    'upper_band') and all bootstrap values ('bootstrap'). Failed fits
+    give NaN. The returned arrays are shared with the cache and must not
+    be modified.
+
+    :param kind: 'lifetime' or 'velocity'
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: start, stop and number of bin edges
+    :type binning: tuple
+    :param upper_limit: upper limit of the fit range
+    :type upper_limit: float
+    :param lower_limits: lower limits of the fit range, defaults to the
+                         bin edges leaving at least three bins to fit
+    :type lower_limits: list or numpy.ndarray
+    :param bootstrap: number of bootstrap resamples per fit range
+    :type bootstrap: int
+    :param confidence: confidence level of the bands
+    :type confidence: float
+    :param processes: number of worker processes, defaults to the
+                      number of cores
+    :type processes: int
+    :param seed: random seed of the resamples
+    :type seed: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: dict
+    :raises: ValueError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    bincontent, lower_limits, key = _prepare_scan(
+            kind, bincontent, binning, upper_limit, lower_limits,
+            bootstrap, confidence, seed)
+    if key in _scan_cache:
+        logger.debug("Using cached fit range scan %s" % key)
+        _scan_cache[key] = _scan_cache.pop(key)
+        return _scan_cache[key]
+
+    tasks = [(kind, bincontent, tuple(binning), (lower, upper_limit),
+              bootstrap, seed + index)
+             for index, lower in enumerate(lower_limits.tolist())]
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    if processes > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(_scan_fit_range, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_scan_fit_range(task) for task in tasks]
+
+    values, errors, bootstrap_values = zip(*results)
+    bootstrap_values = np.array(bootstrap_values).reshape(len(tasks),
+                                                          bootstrap)
+
+    # percentiles of the successful resamples
+    band = [50. * (1. - confidence), 50., 50. * (1. + confidence)]
+    percentiles = np.full((len(tasks), 3), np.nan)
+    for index, row in enumerate(bootstrap_values):
+        row = row[np.isfinite(row)]
+        if len(row):
+            percentiles[index] = np.percentile(row, band)
+
+    scan = {"key": key,
+            "lower_limits": lower_limits,
+            "upper_limit": upper_limit,
+            "values": np.array(values),
+            "errors": np.array(errors),
+            "median": percentiles[:, 1],
+            "lower_band": percentiles[:, 0],
+            "upper_band": percentiles[:, 2],
+            "bootstrap": bootstrap_values}
+
+    cache_scan(scan)
+
+    logger.debug("Scanned %d fit ranges with %d resamples each" %
+                 (len(tasks), bootstrap))
+    return scan
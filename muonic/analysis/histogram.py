@@ -0,0 +1,85 @@
+"""
+Incrementally filled histogram
+"""
+from __future__ import print_function
+
+import numpy as np
+
+__all__ = ["Histogram"]
+
+
+class Histogram(object):
+    """
+    Histogram with fixed binning which is filled with blocks of values.
+    Bins include their lower edge, the last bin also its upper edge, like
+    numpy.histogram. Values outside of the binning are counted as under-
+    and overflow, NaN values are ignored.
+
+    :param binning: bin edges
+    :type binning: list or tuple or numpy.ndarray
+    :raises: ValueError
+    """
+
+    def __init__(self, binning):
+        self.binning = np.asarray(binning, dtype=np.float64)
+
+        if len(self.binning) < 2 or np.any(np.diff(self.binning) <= 0):
+            raise ValueError("bin edges have to increase monotonically")
+
+        self.counts = np.zeros(len(self.binning) - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    @property
+    def bin_centers(self):
+        """
+        The centers of the bins
+
+        :returns: numpy.ndarray
+        """
+        return (self.binning[1:] + self.binning[:-1]) / 2.
+
+    @property
+    def errors(self):
+        """
+        The statistical errors of the bin contents
+
+        :returns: numpy.ndarray
+        """
+        return np.sqrt(self.counts)
+
+    def fill(self, values):
+        """
+        Add values to the histogram. Returns the indices of the bins
+        which changed.
+
+        :param values: the values
+        :type values: list or numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+
+        bins = np.searchsorted(self.binning, values, side="right") - 1
+        bins[values == self.binning[-1]] = len(self.counts) - 1
+
+        below = bins < 0
+        above = bins >= len(self.counts)
+        self.underflow += int(below.sum())
+        self.overflow += int(above.sum())
+
+        added = np.bincount(bins[~below & ~above],
+                            minlength=len(self.counts))
+        self.counts += added
+
+        return np.flatnonzero(added)
+
+    def reset(self):
+        """
+        Clear all bins
+
+        :returns: None
+        """
+        self.counts[:] = 0
+        self.underflow = 0
+        self.overflow = 0
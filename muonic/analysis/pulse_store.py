@@ -0,0 +1,331 @@
+"""
+Compact binary storage for extracted pulses.
+
+A binary pulse file is stored as two tables of fixed size, aligned
+records, each file starting with a fixed width header. The pulse file
+itself holds the event table, one record per trigger: the trigger time,
+the index of the first pulse of the event in the pulse table and the
+number of its pulses. The pulse table is kept in a sidecar file next to
+it, one record per pulse: the index of its event, the channel and the
+rising and falling edge of the pulse (in ns relative to the trigger,
+single precision). Events are numbered in the order of the file, since
+distinct events may share a trigger time. The pulses of an event are
+written before the event, and records are only ever appended, so a
+file can be read while it is still being written.
+"""
+from __future__ import print_function
+import os
+
+import numpy as np
+
+from muonic.util import WrappedFile
+
+__all__ = ["BinaryPulseFile", "read_pulse_file", "is_pulse_file",
+           "get_pulse_table_filename", "slice_events", "get_event_index",
+           "count_day_wraps"]
+
+MAGIC = b"\x89MUONICP"
+PULSE_TABLE_MAGIC = b"\x89MUONICQ"
+VERSION = 3
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u2"),
+    ("record_size", "<u2"),
+    ("reserved", "V12")
+])
+
+EVENT_DTYPE = np.dtype([
+    ("trigger_time", "<f8"),
+    ("first_pulse", "<u4"),
+    ("pulse_count", "<u4")
+])
+
+PULSE_DTYPE = np.dtype([
+    ("event", "<u4"),
+    ("channel", "u1"),
+    ("reserved", "V3"),
+    ("rising_edge", "<f4"),
+    ("falling_edge", "<f4")
+])
+
+# a trigger time of day smaller by more than this than the previous one
+# belongs to the next day
+DAY_WRAP = 43200.
+
+
+def get_pulse_table_filename(filename):
+    """
+    Get the filename of the sidecar pulse table of a binary pulse file
+
+    :param filename: the pulse file
+    :type filename: str
+    :returns: str
+    """
+    return filename + ".pulses"
+
+
+class _TableFile(WrappedFile):
+    """
+    Writer of one table of a binary pulse file
+
+    :param filename: the filename
+    :type filename: str
+    :param magic: the magic bytes of the table
+    :type magic: bytes
+    :param dtype: the record type of the table
+    :type dtype: numpy.dtype
+    """
+
+    def __init__(self, filename, magic, dtype):
+        WrappedFile.__init__(self, filename)
+        self.magic = magic
+        self.dtype = dtype
+
+    def open(self, mode='w', size=None):
+        """
+        Open file in binary mode and track it. A header is written
+        if the file is empty. When appending, records after the first
+        size records are cut off.
+
+        :param mode: the file mode
+        :type mode: str
+        :param size: number of records to keep when appending
+        :type size: int
+        :returns: None
+        """
+        length = HEADER_DTYPE.itemsize + (size or 0) * self.dtype.itemsize
+        if (mode[0] == 'a' and size is not None and
+                os.path.exists(self.get_filename()) and
+                os.path.getsize(self.get_filename()) > length):
+            with open(self.get_filename(), 'r+b') as f:
+                f.truncate(length)
+
+        WrappedFile.open(self, mode.replace('b', '') + 'b')
+
+        if self._file.tell() == 0:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header["magic"] = self.magic
+            header["version"] = VERSION
+            header["record_size"] = self.dtype.itemsize
+            self._file.write(header.tobytes())
+        return self
+
+    def write_records(self, records):
+        """
+        Append records to the file.
+
+        :param records: records of the table
+        :type records: list of tuples
+        :returns: None
+        """
+        if records:
+            self._file.write(np.array(records, dtype=self.dtype).tobytes())
+
+
+class BinaryPulseFile(_TableFile):
+    """
+    Pulse file writer for the binary format. Can be used in place of the
+    text pulse file of muonic.analysis.PulseExtractor. The pulse table is
+    written to the file returned by get_pulse_table_filename.
+
+    :param filename: the filename
+    :type filename: str
+    :raises: ValueError
+    """
+
+    def __init__(self, filename):
+        _TableFile.__init__(self, filename, MAGIC, EVENT_DTYPE)
+        self.pulse_table = _TableFile(get_pulse_table_filename(filename),
+                                      PULSE_TABLE_MAGIC, PULSE_DTYPE)
+        self.event_count = 0
+        self.pulse_count = 0
+
+    def open(self, mode='w'):
+        """
+        Open the event and the pulse table in binary mode and track them.
+        Headers are written if the file is empty, otherwise the events
+        and pulses are appended after the complete events of the file.
+
+        :param mode: the file mode
+        :type mode: str
+        :raises: IOError
+        :returns: None
+        """
+        event_count = 0
+        pulse_count = 0
+
+        if (mode[0] == 'a' and os.path.exists(self.get_filename()) and
+                os.path.getsize(self.get_filename()) > 0):
+            events, pulses = read_pulse_file(self.get_filename())
+            event_count = len(events)
+            pulse_count = len(pulses)
+
+        self.pulse_table.open(mode, pulse_count)
+        _TableFile.open(self, mode, event_count)
+        self.event_count = event_count
+        self.pulse_count = pulse_count
+        return self
+
+    def close(self):
+        """
+        Close the event and the pulse table and un-track them.
+
+        :raises: IOError
+        :returns: None
+        """
+        if not self.pulse_table.closed:
+            self.pulse_table.close()
+        _TableFile.close(self)
+
+    def write_events(self, events):
+        """
+        Append extracted pulses to the file.
+
+        :param events: events as returned by PulseExtractor.extract
+        :type events: list of tuples
+        :returns: None
+        """
+        event_records = []
+        pulse_records = []
+
+        for event in events:
+            first_pulse = self.pulse_count
+
+            for channel, pulses in enumerate(event[1:]):
+                for rising_edge, falling_edge in pulses:
+                    pulse_records.append((self.event_count, channel, b"",
+                                          rising_edge, falling_edge))
+                    self.pulse_count += 1
+
+            event_records.append((event[0], first_pulse,
+                                  self.pulse_count - first_pulse))
+            self.event_count += 1
+
+        # pulses first, so a reader only sees events whose pulses exist
+        self.pulse_table.write_records(pulse_records)
+        self.write_records(event_records)
+
+
+def is_pulse_file(filename):
+    """
+    Returns True if the file is a binary pulse file, False otherwise.
+
+    :param filename: the filename
+    :type filename: str
+    :returns: bool
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _read_table(filename, magic, dtype):
+    """
+    Memory map the records of one table of a binary pulse file. An
+    incomplete record at the end of the file is ignored.
+
+    :param filename: the filename
+    :type filename: str
+    :param magic: the magic bytes of the table
+    :type magic: bytes
+    :param dtype: the record type of the table
+    :type dtype: numpy.dtype
+    :raises: IOError
+    :returns: numpy.ndarray
+    """
+    header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+
+    if len(header) == 0 or header["magic"][0] != magic:
+        raise IOError("'%s' is not a binary pulse file" % filename)
+    if (header["version"][0] != VERSION or
+            header["record_size"][0] != dtype.itemsize):
+        raise IOError("unsupported pulse file version %d" %
+                      header["version"][0])
+
+    count = ((os.path.getsize(filename) - HEADER_DTYPE.itemsize) //
+             dtype.itemsize)
+
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode='r',
+                     offset=HEADER_DTYPE.itemsize, shape=(count,))
+
+
+def read_pulse_file(filename):
+    """
+    Memory map the event and the pulse table of a binary pulse file.
+    Incomplete records and events at the end of the file, e.g. if it is
+    still being written, are ignored, so the pulses are the ones of the
+    events.
+
+    Raises IOError if the file is not a binary pulse file or its pulse
+    table is missing.
+
+    :param filename: the filename
+    :type filename: str
+    :raises: IOError
+    :returns: tuple of numpy.ndarray (events, pulses)
+    """
+    events = _read_table(filename, MAGIC, EVENT_DTYPE)
+    pulses = _read_table(get_pulse_table_filename(filename),
+                         PULSE_TABLE_MAGIC, PULSE_DTYPE)
+
+    end = events["first_pulse"] + events["pulse_count"]
+    complete = np.searchsorted(end, len(pulses), side='right')
+    events = events[:complete]
+    return events, pulses[:int(end[complete - 1]) if complete else 0]
+
+
+def slice_events(events, pulses, start, stop):
+    """
+    Get a range of events and their pulses.
+
+    :param events: events of a pulse file
+    :type events: numpy.ndarray
+    :param pulses: pulse table of the file
+    :type pulses: numpy.ndarray
+    :param start: index of the first event
+    :type start: int
+    :param stop: index after the last event
+    :type stop: int
+    :returns: tuple of numpy.ndarray (events, pulses)
+    """
+    events = events[start:stop]
+    if len(events) == 0:
+        return events, pulses[:0]
+
+    begin = int(events["first_pulse"][0])
+    end = int(events["first_pulse"][-1]) + int(events["pulse_count"][-1])
+    return events, pulses[begin:end]
+
+
+def get_event_index(events):
+    """
+    Get the index within events of the event each of their pulses
+    belongs to. The pulses of an event are stored consecutively, in the
+    order of the events.
+
+    :param events: events of a pulse file
+    :type events: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    return np.repeat(np.arange(len(events)), events["pulse_count"])
+
+
+def count_day_wraps(times, last_time=None):
+    """
+    Get the number of midnights passed up to each trigger time of day,
+    e.g. of the events of a pulse file in the order of the file.
+
+    :param times: times of day in seconds
+    :type times: numpy.ndarray
+    :param last_time: time of day preceding the times or None
+    :type last_time: float
+    :returns: numpy.ndarray
+    """
+    previous = np.empty(len(times))
+    previous[1:] = times[:-1]
+    if len(times):
+        previous[0] = times[0] if last_time is None else last_time
+    return np.cumsum(times < previous - DAY_WRAP)
@@ -0,0 +1,293 @@
+"""
+Multi-resolution archive of the measured rates.
+
+The rates are consolidated into tiles of fixed duration at several
+resolutions, each tile holds the minimum, the mean weighted by the
+measurement time and the maximum of the rates of the four channels and
+the trigger. Each resolution keeps a fixed number of tiles, so the memory
+used does not grow with the duration of the measurement. Queries pick the
+finest resolution which covers the requested time range with a limited
+number of tiles.
+"""
+from __future__ import print_function
+import logging
+import os
+
+import numpy as np
+
+from muonic.util import RingBuffer
+
+__all__ = ["RateArchive"]
+
+# tile duration in seconds and number of tiles kept
+RESOLUTIONS = [(1, 3600), (60, 2880), (3600, 2160), (86400, 3650)]
+
+# four channels and trigger
+CHANNELS = 5
+
+# columns of a tile: start time, measurement time, minimum, mean and
+# maximum rate per channel
+_START = 0
+_DURATION = 1
+_MIN = slice(2, 2 + CHANNELS)
+_MEAN = slice(2 + CHANNELS, 2 + 2 * CHANNELS)
+_MAX = slice(2 + 2 * CHANNELS, 2 + 3 * CHANNELS)
+_COLUMNS = 2 + 3 * CHANNELS
+
+
+class _ArchiveLevel(object):
+    """
+    Tiles of one resolution
+
+    :param resolution: tile duration in seconds
+    :type resolution: float
+    :param capacity: number of tiles kept
+    :type capacity: int
+    """
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.tiles = RingBuffer(capacity, _COLUMNS)
+
+        # the tile which is currently filled, rates are summed up in the
+        # mean columns until the tile is complete
+        self.current = None
+
+    def add(self, timestamp, rates, duration):
+        """
+        Add rates measured up to timestamp.
+
+        :param timestamp: end of the measurement in seconds since epoch
+        :type timestamp: float
+        :param rates: rates of the channels and the trigger
+        :type rates: numpy.ndarray
+        :param duration: measurement time in seconds
+        :type duration: float
+        :returns: None
+        """
+        start = timestamp // self.resolution * self.resolution
+
+        if self.current is None or start > self.current[_START]:
+            self.flush()
+            self.current = np.zeros(_COLUMNS)
+            self.current[_START] = start
+            self.current[_MIN] = rates
+            self.current[_MAX] = rates
+        else:
+            self.current[_MIN] = np.minimum(self.current[_MIN], rates)
+            self.current[_MAX] = np.maximum(self.current[_MAX], rates)
+
+        self.current[_DURATION] += duration
+        self.current[_MEAN] += rates * duration
+
+    def _get_current(self):
+        """
+        Get the current tile with the mean rates
+
+        :returns: numpy.ndarray
+        """
+        tile = self.current.copy()
+        if tile[_DURATION] > 0:
+            tile[_MEAN] /= tile[_DURATION]
+        return tile
+
+    def flush(self):
+        """
+        Move the current tile to the completed ones.
+
+        :returns: None
+        """
+        if self.current is not None:
+            self.tiles.append(self._get_current())
+            self.current = None
+
+    def get(self):
+        """
+        Get all tiles including the current one.
+
+        :returns: numpy.ndarray
+        """
+        if self.current is None:
+            return self.tiles.get()
+        return np.concatenate((self.tiles.get(),
+                               self._get_current()[np.newaxis]))
+
+    def first_time(self):
+        """
+        Start time of the oldest tile, None if empty.
+
+        :returns: float or None
+        """
+        if len(self.tiles):
+            return self.tiles.get()[0, _START]
+        if self.current is not None:
+            return self.current[_START]
+        return None
+
+
+class RateArchive(object):
+    """
+    Archive of the rates at multiple resolutions, optionally stored in a
+    file. An existing file is loaded.
+
+    :param filename: the file to store the archive in
+    :type filename: str
+    :param resolutions: tile duration in seconds and number of tiles kept
+                        for each resolution, from fine to coarse
+    :type resolutions: list of tuple
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, filename=None, resolutions=RESOLUTIONS, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.filename = filename
+        self.resolutions = [tuple(resolution) for resolution in resolutions]
+        self.levels = [_ArchiveLevel(resolution, capacity)
+                       for resolution, capacity in self.resolutions]
+        self.first_time = None
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def add(self, timestamp, rates, duration=1.):
+        """
+        Add the rates of the channels and the trigger measured up to
+        timestamp.
+
+        :param timestamp: end of the measurement in seconds since epoch
+        :type timestamp: float
+        :param rates: rates of the four channels and the trigger
+        :type rates: list of float
+        :param duration: measurement time in seconds
+        :type duration: float
+        :returns: None
+        """
+        rates = np.asarray(rates, dtype=np.float64)[:CHANNELS]
+
+        if self.first_time is None:
+            self.first_time = timestamp
+
+        for level in self.levels:
+            level.add(timestamp, rates, duration)
+
+    def time_range(self):
+        """
+        Get the start of the oldest and the newest tile, None if the
+        archive is empty.
+
+        :returns: tuple of float or None
+        """
+        if self.first_time is None:
+            return None
+        return (self.first_time,
+                self.levels[0].current[_START] if self.levels[0].current
+                is not None else self.levels[0].get()[-1, _START])
+
+    def get(self, start=None, stop=None, max_points=1000):
+        """
+        Get the tiles between start and stop in the finest resolution
+        which has tiles back to start and needs at most max_points tiles.
+        Falls back to the coarsest resolution.
+
+        Returns the resolution, the start times of the tiles and the
+        minimum, mean and maximum rates of the tiles, one column per
+        channel and the trigger.
+
+        :param start: start time in seconds since epoch
+        :type start: float
+        :param stop: stop time in seconds since epoch
+        :type stop: float
+        :param max_points: maximum number of tiles
+        :type max_points: int
+        :returns: tuple
+        """
+        time_range = self.time_range()
+        if time_range is None:
+            empty = np.zeros((0, CHANNELS))
+            return (self.resolutions[0][0], np.zeros(0), empty, empty,
+                    empty)
+
+        if start is None:
+            start = time_range[0]
+        if stop is None:
+            stop = time_range[1]
+
+        level = self.levels[-1]
+        for candidate in self.levels:
+            first_time = candidate.first_time()
+            if ((stop - start) / candidate.resolution <= max_points and
+                    (first_time <= max(start, self.first_time))):
+                level = candidate
+                break
+
+        tiles = level.get()
+        times = tiles[:, _START]
+        selected = slice(
+                max(np.searchsorted(times, start, side="right") - 1, 0),
+                np.searchsorted(times, stop, side="right"))
+        tiles = tiles[selected]
+
+        return (level.resolution, tiles[:, _START], tiles[:, _MIN],
+                tiles[:, _MEAN], tiles[:, _MAX])
+
+    def save(self):
+        """
+        Store the archive in its file. The file is replaced at once,
+        so it is always complete.
+
+        :returns: None
+        """
+        if self.filename is None:
+            return
+
+        arrays = {"resolutions": np.array(self.resolutions),
+                  "first_time": np.array([np.nan if self.first_time is None
+                                          else self.first_time])}
+        for index, level in enumerate(self.levels):
+            arrays["tiles%d" % index] = level.tiles.get()
+            arrays["current%d" % index] = (
+                    np.zeros((0, _COLUMNS)) if level.current is None
+                    else level.current[np.newaxis])
+
+        temporary = self.filename + ".tmp"
+        with open(temporary, "wb") as archive_file:
+            np.savez(archive_file, **arrays)
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(temporary, self.filename)
+
+    def load(self):
+        """
+        Load the archive from its file. Files with other resolutions or
+        which cannot be read are ignored.
+
+        :returns: None
+        """
+        try:
+            with np.load(self.filename) as arrays:
+                if (arrays["resolutions"].tolist() !=
+                        [list(resolution) for resolution in
+                         self.resolutions]):
+                    self.logger.warning("Rate archive %s has other " %
+                                        self.filename +
+                                        "resolutions, ignoring it")
+                    return
+
+                for index, level in enumerate(self.levels):
+                    level.tiles.clear()
+                    for tile in arrays["tiles%d" % index]:
+                        level.tiles.append(tile)
+                    current = arrays["current%d" % index]
+                    level.current = current[0].copy() if len(current) \
+                        else None
+
+                first_time = float(arrays["first_time"][0])
+                self.first_time = None if np.isnan(first_time) \
+                    else first_time
+        except (IOError, KeyError, ValueError) as e:
+            self.logger.warning("Could not load rate archive %s: %s" %
+                                (self.filename, e))
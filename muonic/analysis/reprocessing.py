@@ -0,0 +1,443 @@
+"""
+Reprocessing of recorded RAW and binary pulse files on multiple cores.
+
+The RAW file is split into chunks which start at lines with the trigger
+flag set. The chunks are decoded in a process pool. The trigger and 1PPS
+counter state each chunk starts with is then derived in order, which only
+needs the decoded counters. Finally the chunks are handed back to the pool
+together with their start state, where the pulses are extracted and
+optionally a trigger is run on them. The results are yielded in the
+order of the file and are identical to reading the file line by line
+with a single PulseExtractor.
+
+The decoded lines are stored in the decode cache, so reprocessing the
+same file again skips reading and decoding the text.
+
+Binary pulse files already hold the extracted pulses. They are split
+into chunks of whole events, which the workers read from the memory
+mapped file and run the trigger on.
+"""
+from __future__ import print_function
+from collections import deque
+from io import BytesIO
+import logging
+import multiprocessing as mp
+
+import numpy as np
+
+from muonic.analysis.analyzer import BIT7, TRIGGER_LINE_PATTERN
+from muonic.analysis.analyzer import PulseExtractor, decode_daq_lines
+from muonic.analysis.analyzer import summarize_events
+from muonic.analysis.analyzer import summarize_pulse_records
+from muonic.analysis.pulse_store import get_event_index, read_pulse_file
+from muonic.analysis.pulse_store import slice_events
+from muonic.io import read_line_blocks
+from muonic.io.decode_cache import get_decode_cache
+
+__all__ = ["reprocess_raw_file", "reprocess_pulse_file"]
+
+# number of lines per chunk
+CHUNK_SIZE = 200000
+
+# number of pulse file events per chunk
+PULSE_CHUNK_SIZE = 200000
+
+
+def _is_trigger_line(line):
+    """
+    Returns True if the line is a DAQ message with the trigger flag set
+
+    :param line: line of the RAW file
+    :type line: bytes
+    :returns: bool
+    """
+    match = TRIGGER_LINE_PATTERN.match(line.decode("ascii", "replace"))
+    return match is not None and bool(int(match.group(2), 16) & BIT7)
+
+
+def _read_chunks(blocks, chunk_size):
+    """
+    Join blocks of lines into chunks of about chunk_size lines. All
+    chunks but the first start with a line with the trigger flag set.
+
+    :param blocks: blocks of complete lines
+    :type blocks: iterable of bytes
+    :param chunk_size: minimum number of lines per chunk
+    :type chunk_size: int
+    :returns: generator of bytes
+    """
+    lines = []
+
+    for block in blocks:
+        lines += BytesIO(block).readlines()
+
+        if len(lines) < chunk_size:
+            continue
+
+        # split at the last trigger
+        for index in range(len(lines) - 1, 0, -1):
+            if _is_trigger_line(lines[index]):
+                yield b"".join(lines[:index])
+                lines = lines[index:]
+                break
+
+    if lines:
+        yield b"".join(lines)
+
+
+def _decode_chunks(chunks, pool, max_pending):
+    """
+    Decode chunks of lines in a process pool. Yields the decoded chunks
+    in order.
+
+    :param chunks: chunks of lines
+    :type chunks: iterable of bytes
+    :param pool: process pool
+    :type pool: multiprocessing.Pool
+    :param max_pending: maximum number of chunks decoded at once
+    :type max_pending: int
+    :returns: generator of numpy.ndarray
+    """
+    decoding = deque()
+    chunks = iter(chunks)
+
+    while True:
+        for chunk in chunks:
+            decoding.append(pool.apply_async(decode_daq_lines, (chunk,)))
+            if len(decoding) >= max_pending:
+                break
+
+        if not decoding:
+            break
+
+        yield decoding.popleft().get()
+
+
+def _split_decoded(data, chunk_size):
+    """
+    Split decoded lines into chunks of at least chunk_size lines. All
+    chunks but the first start with a line with the trigger flag set.
+
+    :param data: decoded DAQ messages
+    :type data: numpy.ndarray
+    :param chunk_size: minimum number of lines per chunk
+    :type chunk_size: int
+    :returns: generator of numpy.ndarray
+    """
+    start = 0
+
+    while start < len(data):
+        stop = start + chunk_size
+
+        # split at the next trigger
+        while stop < len(data):
+            triggers = np.flatnonzero(
+                    data["re0"][stop:stop + chunk_size] & BIT7)
+            if len(triggers):
+                stop += int(triggers[0])
+                break
+            stop += chunk_size
+
+        yield np.array(data[start:stop])
+        start = stop
+
+
+def _process_chunk(data, closing_data, state, trigger, trigger_kwargs):
+    """
+    Extract the pulses of a chunk and run the trigger on them
+
+    :param data: decoded DAQ messages of the chunk
+    :type data: numpy.ndarray
+    :param closing_data: first message of the next chunk, which closes
+                         the last event of the chunk
+    :type closing_data: numpy.ndarray
+    :param state: counter state at the start of the chunk
+    :type state: dict
+    :param trigger: trigger class or None
+    :type trigger: class
+    :param trigger_kwargs: keyword arguments of the trigger method
+    :type trigger_kwargs: dict
+    :returns: list
+    """
+    logger = logging.getLogger()
+
+    pulse_extractor = PulseExtractor(logger, "")
+    pulse_extractor.set_counter_state(state)
+
+    events = pulse_extractor.extract_array(
+            np.concatenate((data, closing_data)))
+
+    # the first trigger of the chunk closes the last event of the
+    # previous chunk
+    if not state["ini"]:
+        events = events[1:]
+
+    if trigger is None:
+        return events
+    return _run_trigger(events, trigger, trigger_kwargs)
+
+
+def _run_trigger(events, trigger, trigger_kwargs, summary=None):
+    """
+    Run a trigger on extracted events
+
+    :param events: extracted pulses of the events
+    :type events: list
+    :param trigger: trigger class
+    :type trigger: class
+    :param trigger_kwargs: keyword arguments of the trigger method
+    :type trigger_kwargs: dict
+    :param summary: columnar summary of the events, see summarize_events
+    :type summary: numpy.ndarray
+    :returns: list
+    """
+    logger = logging.getLogger()
+    trigger = trigger(logger)
+    results = []
+
+    # run the trigger on all events at once if it supports it, rejected
+    # events get NaN. If the trigger evaluates several channel pairs,
+    # events are kept if any pair fired
+    if hasattr(trigger, "trigger_batch"):
+        if summary is None:
+            summary = summarize_events(events)
+        values, reasons = trigger.trigger_batch(summary, **trigger_kwargs)
+        accepted = ~np.isnan(values)
+        if accepted.ndim > 1:
+            accepted = accepted.any(axis=1)
+        for index in np.flatnonzero(accepted).tolist():
+            results.append((events[index], values[index].tolist()))
+        return results
+
+    for pulses in events:
+        result = trigger.trigger(pulses, **trigger_kwargs)
+        if result is not None:
+            results.append((pulses, result))
+    return results
+
+
+def reprocess_raw_file(filename, trigger=None, trigger_kwargs=None,
+                       processes=None, chunk_size=CHUNK_SIZE, cache=None,
+                       logger=None):
+    """
+    Extract the pulses of a (compressed) RAW file using a process pool.
+    Yields the extracted pulses of all events in the order of the file.
+    If a trigger class is given (DecayTriggerThorough or VelocityTrigger),
+    yields tuples of the pulses and the trigger result for every event
+    the trigger fired on instead. If VelocityTrigger gets several channel
+    pairs, the result is the list of flight times of all pairs, NaN for
+    the pairs which did not fire.
+
+    :param filename: RAW file, may be gzip, bzip2 or xz compressed
+    :type filename: str
+    :param trigger: trigger class or None
+    :type trigger: class
+    :param trigger_kwargs: keyword arguments passed to the trigger method
+    :type trigger_kwargs: dict
+    :param processes: number of worker processes, defaults to the
+                      number of cores
+    :type processes: int
+    :param chunk_size: minimum number of lines per chunk
+    :type chunk_size: int
+    :param cache: decode cache, defaults to the cache in the data
+                  directory, False disables caching
+    :type cache: muonic.io.decode_cache.DecodeCache or bool
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: generator
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if trigger_kwargs is None:
+        trigger_kwargs = dict()
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    if cache is None:
+        cache = get_decode_cache(logger)
+
+    cached = cache.load(filename) if cache else None
+
+    # keeps the state of the counters at the chunk boundaries
+    counter_tracker = PulseExtractor(logger, "")
+
+    pool = mp.Pool(processes)
+    max_pending = 2 * processes
+    cache_file = None
+
+    try:
+        if cached is not None:
+            decoded = _split_decoded(cached, chunk_size)
+        else:
+            # the compressed file is decompressed with the same pool
+            blocks = read_line_blocks(filename, chunk_size * 80, processes,
+                                      pool=pool, logger=logger)
+            decoded = _decode_chunks(_read_chunks(blocks, chunk_size), pool,
+                                     max_pending)
+            if cache:
+                try:
+                    cache_file = cache.create(filename)
+                except (IOError, OSError) as e:
+                    logger.warning("Could not create decoded cache of " +
+                                   "%s: %s" % (filename, e))
+
+        extracting = deque()
+        previous = None
+        chunk_count = 0
+
+        for data in decoded:
+            if cache_file is not None:
+                cache_file.write_lines(data)
+
+            state = counter_tracker.get_counter_state()
+            counter_tracker.skip_array(data)
+            chunk_count += 1
+
+            if previous is not None:
+                extracting.append(pool.apply_async(
+                        _process_chunk, (previous[0], data[:1],
+                                         previous[1], trigger,
+                                         trigger_kwargs)))
+            previous = (data, state)
+
+            while extracting and (len(extracting) > max_pending or
+                                  extracting[0].ready()):
+                for result in extracting.popleft().get():
+                    yield result
+
+        if previous is not None:
+            extracting.append(pool.apply_async(
+                    _process_chunk, (previous[0], previous[0][:0],
+                                     previous[1], trigger,
+                                     trigger_kwargs)))
+
+        if cache_file is not None:
+            cache.commit(filename, cache_file)
+            cache_file = None
+
+        while extracting:
+            for result in extracting.popleft().get():
+                yield result
+
+        logger.debug("Reprocessed %d chunks of %s" % (chunk_count,
+                                                      filename))
+    finally:
+        if cache_file is not None:
+            cache.discard(cache_file)
+        pool.terminate()
+        pool.join()
+
+
+def _get_events(events, pulses):
+    """
+    Get the events of a pulse file in the format of PulseExtractor.extract
+
+    :param events: events of a pulse file
+    :type events: numpy.ndarray
+    :param pulses: pulses of the events
+    :type pulses: numpy.ndarray
+    :returns: list
+    """
+    extracted = [(trigger_time, [], [], [], [])
+                 for trigger_time in events["trigger_time"].tolist()]
+
+    for event, channel, rising_edge, falling_edge in zip(
+            get_event_index(events).tolist(), pulses["channel"].tolist(),
+            pulses["rising_edge"].tolist(), pulses["falling_edge"].tolist()):
+        extracted[event][channel + 1].append((rising_edge, falling_edge))
+    return extracted
+
+
+def _process_events(filename, start, stop, trigger, trigger_kwargs):
+    """
+    Get the events of a chunk of a pulse file and run the trigger on them
+
+    :param filename: binary pulse file
+    :type filename: str
+    :param start: first event of the chunk
+    :type start: int
+    :param stop: event after the chunk
+    :type stop: int
+    :param trigger: trigger class or None
+    :type trigger: class
+    :param trigger_kwargs: keyword arguments of the trigger method
+    :type trigger_kwargs: dict
+    :returns: list
+    """
+    events, pulses = read_pulse_file(filename)
+    events, pulses = slice_events(events, pulses, start, stop)
+    events = np.array(events)
+    pulses = np.array(pulses)
+    extracted = _get_events(events, pulses)
+
+    if trigger is None:
+        return extracted
+    return _run_trigger(extracted, trigger, trigger_kwargs,
+                        summarize_pulse_records(events, pulses))
+
+
+def reprocess_pulse_file(filename, trigger=None, trigger_kwargs=None,
+                         processes=None, chunk_size=PULSE_CHUNK_SIZE,
+                         logger=None):
+    """
+    Get the events of a binary pulse file using a process pool, see
+    reprocess_raw_file. Yields the pulses of all events in the order of
+    the file, or tuples of the pulses and the trigger result for every
+    event the trigger fired on if a trigger class is given. Note that
+    the edges are stored with single precision in these files.
+
+    :param filename: binary pulse file
+    :type filename: str
+    :param trigger: trigger class or None
+    :type trigger: class
+    :param trigger_kwargs: keyword arguments passed to the trigger method
+    :type trigger_kwargs: dict
+    :param processes: number of worker processes, defaults to the
+                      number of cores
+    :type processes: int
+    :param chunk_size: number of events per chunk
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :raises: IOError
+    :returns: generator
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if trigger_kwargs is None:
+        trigger_kwargs = dict()
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    event_count = len(read_pulse_file(filename)[0])
+    bounds = list(range(0, event_count, chunk_size)) + [event_count]
+
+    pool = mp.Pool(processes)
+    max_pending = 2 * processes
+
+    try:
+        extracting = deque()
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            extracting.append(pool.apply_async(
+                    _process_events, (filename, start, stop, trigger,
+                                      trigger_kwargs)))
+
+            while extracting and (len(extracting) > max_pending or
+                                  extracting[0].ready()):
+                for result in extracting.popleft().get():
+                    yield result
+
+        while extracting:
+            for result in extracting.popleft().get():
+                yield result
+
+        logger.debug("Reprocessed %d chunks of %s" % (len(bounds) - 1,
+                                                      filename))
+    finally:
+        pool.terminate()
+        pool.join()
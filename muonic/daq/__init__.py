@@ -3,8 +3,16 @@ Provide a connection to the QNet DAQ cards via python-serial. For software
 testing and development, (very) dumb DAQ card simulator is available.
 """
 from .exceptions import DAQIOError, DAQMissingDependencyError
+from .ringbuffer import SharedRingBuffer
 from .simulation import DAQSimulationConnection, DAQSimulationServer
 from .connection import DAQConnection, DAQServer
-from .provider import DAQClient, DAQProvider
+from .provider import DAQClient, DAQProvider, DAQStreamClient
 
-__all__ = ["exceptions", "simulation", "connection", "provider"]
+try:
+    from .aio import AsyncDAQProvider, AsyncDAQServer
+except (ImportError, SyntaxError):
+    # asyncio is only available for Python 3
+    pass
+
+__all__ = ["exceptions", "ringbuffer", "generator", "simulation",
+           "connection", "provider"]
@@ -0,0 +1,491 @@
+"""
+Provides an asyncio based DAQ server and provider. A single event loop
+multiplexes the serial input, the commands sent to the card and any number
+of network clients. Requires Python 3.
+"""
+import asyncio
+from collections import deque
+import logging
+import queue
+import threading
+import time
+
+from muonic.daq import DAQIOError
+from muonic.daq.connection import find_serial_port
+from muonic.daq.provider import BaseDAQProvider
+from muonic.daq.simulation import DAQSimulation
+
+
+class AsyncDAQServer(object):
+    """
+    asyncio based DAQ server
+
+    DAQ lines are sent to all connected TCP clients, one line per message
+    terminated by a line break. Lines received from clients are forwarded
+    to the card as commands. muonic connects to the server with a
+    DAQStreamClient. Every client has its own bounded queue, if a
+    client does not keep up, lines are dropped for this client only
+    instead of stalling the card.
+
+    If port is None, no TCP server is started and the lines are only
+    passed to the listeners. Commands are queued until the server is
+    running and the DAQ is connected. If the server fails, the error is
+    stored in error and put raises DAQIOError.
+
+    :param address: address to listen on
+    :type address: str
+    :param port: TCP port to listen on
+    :type port: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param sim: enables DAQ simulation if set to True
+    :type sim: bool
+    :param serial_port: serial port to use instead of the detected one
+    :type serial_port: serial.Serial
+    """
+
+    # maximum number of queued blocks of lines per client
+    MAX_CLIENT_QUEUE_SIZE = 1000
+
+    def __init__(self, address='127.0.0.1', port=5558, logger=None,
+                 sim=False, serial_port=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.address = address
+        self.port = port
+        self.sim = sim
+        self.serial_port = serial_port
+        self.running = False
+        self._stop_requested = threading.Event()
+
+        self.loop = None
+        self.error = None
+        self.listeners = []
+        self._clients = dict()
+        self._client_queues = dict()
+        # commands are queued from any thread, the event wakes up the
+        # writer within the event loop
+        self._commands = queue.Queue()
+        self._commands_queued = None
+        self._remainder = b""
+
+    def add_listener(self, listener):
+        """
+        Register a callable which gets each block of lines read from the
+        DAQ. Called from within the event loop.
+
+        :param listener: callable taking a list of str
+        :type listener: callable
+        :returns: None
+        """
+        self.listeners.append(listener)
+
+    def put(self, command):
+        """
+        Send a command to the DAQ, can be called from any thread. The
+        command is queued and sent as soon as the DAQ is connected.
+
+        Raises DAQIOError if the server failed.
+
+        :param command: command
+        :type command: str
+        :returns: None
+        :raises: DAQIOError
+        """
+        if self.error is not None:
+            raise DAQIOError("DAQ server failed: %s" % self.error)
+
+        self._commands.put(command)
+
+        loop, commands_queued = self.loop, self._commands_queued
+        if loop is not None and commands_queued is not None:
+            try:
+                loop.call_soon_threadsafe(commands_queued.set)
+            except RuntimeError:
+                # the event loop is closed
+                pass
+
+    def run(self):
+        """
+        Runs the server until stop is called.
+
+        :returns: None
+        """
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """
+        Stops the server, can be called from any thread, also before it
+        is running.
+
+        :returns: None
+        """
+        self._stop_requested.set()
+        self.running = False
+
+    async def serve(self):
+        """
+        Runs the server. An error is stored in error before it is raised.
+
+        :returns: None
+        """
+        try:
+            await self._serve()
+        except Exception as e:
+            self.error = e
+            self.logger.error("DAQ server failed: %s" % e)
+            raise
+        finally:
+            self.running = False
+            self._commands_queued = None
+            self.loop = None
+
+    async def _serve(self):
+        """
+        Connect the DAQ and serve it until stop is called.
+
+        :returns: None
+        """
+        self._commands_queued = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+
+        if self.sim:
+            self.serial_port = DAQSimulation(self.logger)
+            reader = self.loop.create_task(self._read_simulation())
+        else:
+            if self.serial_port is None:
+                # the detection blocks until the card is connected
+                self.serial_port = await self.loop.run_in_executor(
+                        None, find_serial_port, self.logger)
+            reader = self.loop.create_task(self._read_serial())
+
+        writer = self.loop.create_task(self._write())
+
+        server = None
+        try:
+            if self.port is not None:
+                server = await asyncio.start_server(self._serve_client,
+                                                    self.address, self.port)
+                self.logger.info("Serving DAQ on %s:%d" % (self.address,
+                                                          self.port))
+
+            while not self._stop_requested.is_set():
+                await asyncio.sleep(0.1)
+        finally:
+            reader.cancel()
+            writer.cancel()
+            if server is not None:
+                server.close()
+                # closing the connections lets the client handlers finish
+                handlers = [handler for handler, client_writer
+                            in self._clients.values()]
+                for handler, client_writer in self._clients.values():
+                    client_writer.close()
+                await asyncio.gather(*handlers, return_exceptions=True)
+                await server.wait_closed()
+
+    def _dispatch(self, lines):
+        """
+        Pass a block of lines to the listeners and queue it for all
+        clients.
+
+        :param lines: lines read from the DAQ
+        :type lines: list of str
+        :returns: None
+        """
+        if not lines:
+            return
+
+        for listener in self.listeners:
+            listener(lines)
+
+        for address, client_queue in self._client_queues.items():
+            try:
+                client_queue.put_nowait(lines)
+            except asyncio.QueueFull:
+                self.logger.warning("Client %s is too slow, dropping %d " %
+                                    (address, len(lines)) + "lines")
+
+    def _split_lines(self, data):
+        """
+        Split data read from the serial port into lines. An incomplete
+        last line is kept until the next call.
+
+        :param data: data read from the serial port
+        :type data: bytes
+        :returns: list of str
+        """
+        lines = (self._remainder + data).split(b"\n")
+        self._remainder = lines.pop()
+        return [line.strip().decode("ascii", "replace") for line in lines]
+
+    async def _read_serial(self):
+        """
+        Read everything available whenever the serial port becomes
+        readable. Falls back to blocking reads in a worker thread if the
+        port cannot be watched by the event loop.
+
+        :returns: None
+        """
+        readable = asyncio.Event()
+
+        try:
+            self.loop.add_reader(self.serial_port.fileno(), readable.set)
+        except (AttributeError, NotImplementedError):
+            await self._read_serial_blocking()
+            return
+
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+
+                waiting = self.serial_port.inWaiting()
+                if waiting:
+                    self._dispatch(self._split_lines(
+                            self.serial_port.read(waiting)))
+        finally:
+            self.loop.remove_reader(self.serial_port.fileno())
+
+    async def _read_serial_blocking(self):
+        """
+        Read from the serial port with blocking reads in a worker thread.
+
+        :returns: None
+        """
+        def read():
+            data = self.serial_port.read(1)
+            waiting = self.serial_port.inWaiting()
+            if waiting:
+                data += self.serial_port.read(waiting)
+            return data
+
+        while True:
+            self._dispatch(self._split_lines(
+                    await self.loop.run_in_executor(None, read)))
+
+    async def _read_simulation(self):
+        """
+        Read from the DAQ simulation, which blocks, in a worker thread.
+
+        :returns: None
+        """
+        def read():
+            lines = []
+            while self.serial_port.in_waiting():
+                lines.append(self.serial_port.readline().strip())
+            return lines
+
+        while True:
+            self._dispatch(await self.loop.run_in_executor(None, read))
+            await asyncio.sleep(0.02)
+
+    async def _write(self):
+        """
+        Send queued commands to the DAQ.
+
+        :returns: None
+        """
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                self._commands_queued.clear()
+                # a command may have been queued before the event was
+                # cleared
+                if self._commands.empty():
+                    await self._commands_queued.wait()
+                continue
+
+            self.logger.debug("Sending command '%s' to the DAQ" % command)
+            if self.sim:
+                self.serial_port.write(str(command) + "\r")
+            else:
+                self.serial_port.write((str(command) + "\r").encode("ascii"))
+
+    async def _serve_client(self, reader, writer):
+        """
+        Send DAQ lines to a client and forward its commands to the DAQ.
+
+        :param reader: stream reader of the client connection
+        :type reader: asyncio.StreamReader
+        :param writer: stream writer of the client connection
+        :type writer: asyncio.StreamWriter
+        :returns: None
+        """
+        address = writer.get_extra_info("peername")
+        client_queue = asyncio.Queue(self.MAX_CLIENT_QUEUE_SIZE)
+        self._client_queues[address] = client_queue
+        self._clients[address] = (asyncio.current_task(), writer)
+        self.logger.info("Client %s connected" % (address,))
+
+        async def send():
+            while True:
+                lines = await client_queue.get()
+                writer.write("".join([line + "\n" for line in lines]).encode(
+                        "ascii", "replace"))
+                await writer.drain()
+
+        sender = self.loop.create_task(send())
+
+        try:
+            while True:
+                command = await reader.readline()
+                if not command:
+                    break
+                command = command.decode("ascii", "replace").strip()
+                if command:
+                    self.put(command)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._client_queues[address]
+            del self._clients[address]
+            sender.cancel()
+            writer.close()
+            self.logger.info("Client %s disconnected" % (address,))
+
+
+class AsyncDAQProvider(BaseDAQProvider):
+    """
+    DAQ provider running an AsyncDAQServer in a background thread instead
+    of reader and writer processes. If a port is given, the DAQ is served
+    to network clients at the same time.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param sim: enables DAQ simulation if set to True
+    :type sim: bool
+    :param address: address to serve the DAQ on
+    :type address: str
+    :param port: TCP port to serve the DAQ on, None to not serve it
+    :type port: int
+    """
+
+    # maximum number of lines waiting to be read, further lines are
+    # dropped and counted in dropped_count
+    MAX_QUEUE_SIZE = 500000
+
+    def __init__(self, logger=None, sim=False, address='127.0.0.1',
+                 port=None):
+        BaseDAQProvider.__init__(self, logger)
+        self.dropped_count = 0
+        self._dropping = False
+        self._lines = deque()
+        self._data_event = threading.Event()
+
+        self.server = AsyncDAQServer(address, port, self.logger, sim)
+        self.server.add_listener(self._receive)
+
+        self.server_thread = threading.Thread(target=self.server.run,
+                                              name="tASYNCDAQ")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def _receive(self, lines):
+        """
+        Store lines received from the server. Lines which do not fit
+        into the queue are dropped.
+
+        :param lines: lines read from the DAQ
+        :type lines: list of str
+        :returns: None
+        """
+        free = self.MAX_QUEUE_SIZE - len(self._lines)
+        if free < len(lines):
+            self.dropped_count += len(lines) - max(free, 0)
+            if not self._dropping:
+                self.logger.warning("Lines are not read fast enough, " +
+                                    "dropping lines")
+            self._dropping = True
+            lines = lines[:max(free, 0)]
+        elif self._dropping:
+            self.logger.warning("Dropped %d lines in total" %
+                                self.dropped_count)
+            self._dropping = False
+
+        self._lines.extend(lines)
+        self._data_event.set()
+
+    def get(self, *args):
+        """
+        Get something from the DAQ.
+
+        Raises DAQIOError if no data is available.
+
+        :param args: ignored, for compatibility with DAQProvider
+        :type args: list
+        :returns: str or None -- next line read from the DAQ
+        :raises: DAQIOError
+        """
+        try:
+            line = self._lines.popleft()
+        except IndexError:
+            raise DAQIOError("Queue is empty")
+
+        return self._validate_line(line)
+
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Get up to max_items validated lines from the DAQ. Invalid lines
+        are dropped and counted in garbage_count.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds,
+                        forever if None
+        :type timeout: float
+        :returns: list of str
+        """
+        if timeout is None or timeout > 0:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._lines:
+                self._data_event.clear()
+                if self._lines:
+                    break
+                if deadline is None:
+                    self._data_event.wait()
+                elif not self._data_event.wait(deadline - time.time()):
+                    break
+
+        lines = []
+        try:
+            while max_items is None or len(lines) < max_items:
+                lines.append(self._lines.popleft())
+        except IndexError:
+            pass
+
+        return self._validate_lines(lines)
+
+    def put(self, *args):
+        """
+        Send information to the DAQ.
+
+        :param args: command as first argument
+        :type args: list
+        :returns: None
+        """
+        self.server.put(args[0])
+
+    def data_available(self):
+        """
+        Tests if data is available from the DAQ.
+
+        :returns: int
+        """
+        return len(self._lines)
+
+    def stop(self):
+        """
+        Stops the server thread.
+
+        :returns: None
+        """
+        self.server.stop()
+        self.server_thread.join()
+
+
+if __name__ == "__main__":
+    AsyncDAQServer(port=5558, logger=logging.getLogger()).run()
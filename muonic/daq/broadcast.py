@@ -0,0 +1,98 @@
+"""
+Provides the sockets to broadcast the lines of one DAQ card to many clients
+over zmq PUB/SUB and to receive their commands over a REQ/REP channel.
+"""
+from __future__ import print_function
+import struct
+
+try:
+    import zmq
+except ImportError:
+    # DAQMissingDependencyError will be raised when trying to use zmq
+    pass
+
+from muonic.daq import DAQMissingDependencyError
+
+# sequence number sent as first frame of every published line
+SEQUENCE = struct.Struct("!Q")
+
+
+def pack_sequence(sequence):
+    """
+    Encode a sequence number for sending.
+
+    :param sequence: sequence number
+    :type sequence: int
+    :returns: bytes
+    """
+    return SEQUENCE.pack(sequence)
+
+
+def unpack_sequence(data):
+    """
+    Decode a received sequence number.
+
+    :param data: encoded sequence number
+    :type data: bytes
+    :returns: int
+    """
+    return SEQUENCE.unpack(data)[0]
+
+
+class DAQPublisher(object):
+    """
+    Publishes DAQ lines with consecutive sequence numbers on a PUB socket
+    and receives commands for the card on a REP socket.
+
+    Raises DAQMissingDependencyError if zmq is not installed.
+
+    :param address: address to listen on
+    :type address: str
+    :param port: TCP port to publish the DAQ lines on
+    :type port: int
+    :param command_port: TCP port to receive commands on
+    :type command_port: int
+    :raises: DAQMissingDependencyError
+    """
+
+    def __init__(self, address='127.0.0.1', port=5556, command_port=5557):
+        try:
+            context = zmq.Context()
+        except NameError:
+            raise DAQMissingDependencyError("no zmq installed...")
+
+        self.socket = context.socket(zmq.PUB)
+        self.socket.bind("tcp://%s:%d" % (address, port))
+        self.command_socket = context.socket(zmq.REP)
+        self.command_socket.bind("tcp://%s:%d" % (address, command_port))
+        self.sequence = 0
+
+    def publish(self, line):
+        """
+        Publish a line read from the DAQ.
+
+        :param line: DAQ line
+        :type line: str or bytes
+        :returns: None
+        """
+        if not isinstance(line, bytes):
+            line = line.encode("ascii", "replace")
+
+        self.socket.send_multipart([pack_sequence(self.sequence), line])
+        self.sequence += 1
+
+    def receive_command(self, timeout=0):
+        """
+        Receive a command and acknowledge it. Waits up to timeout
+        milliseconds. Returns None if no command was received.
+
+        :param timeout: time to wait in milliseconds
+        :type timeout: int
+        :returns: str or None
+        """
+        if not self.command_socket.poll(timeout):
+            return None
+
+        command = self.command_socket.recv_string()
+        self.command_socket.send_string("OK")
+        return command
@@ -19,6 +19,63 @@ except ImportError:
     pass
 
 from muonic.daq import DAQMissingDependencyError
+from muonic.daq.broadcast import DAQPublisher
+from muonic.daq.ringbuffer import put_lines
+
+
+def find_serial_port(logger=None):
+    """
+    Check out which device (/dev/tty) is used for DAQ communication and
+    connect to it. Retries until the connection succeeds.
+
+    Raises OSError if binary 'which_tty_daq' cannot be found.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: serial.Serial -- serial connection port
+    :raises: OSError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    connected = False
+    serial_port = None
+
+    def get_dev_path(script):
+        tty = subprocess.Popen(
+                [script], stdout=subprocess.PIPE).communicate()[0]
+        return "/dev/%s" % tty.rstrip('\n')
+
+    while not connected:
+        try:
+            dev = get_dev_path("which_tty_daq")
+        except OSError:
+            # try using package script ../../bin/which_tty_daq
+            which_tty_daq = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir,
+                                 os.pardir, 'bin', 'which_tty_daq'))
+
+            if not os.path.exists(which_tty_daq):
+                raise OSError("Can not find binary which_tty_daq")
+
+            dev = get_dev_path(which_tty_daq)
+
+        logger.info("Daq found at %s", dev)
+        logger.info("trying to connect...")
+
+        try:
+            serial_port = serial.Serial(port=dev, baudrate=115200,
+                                        bytesize=8, parity='N', stopbits=1,
+                                        timeout=0.5, xonxoff=True)
+            connected = True
+        except serial.SerialException as e:
+            logger.error(e)
+            logger.error("Waiting 5 seconds")
+            sleep(5)
+
+    logger.info("Successfully connected to serial port")
+
+    return serial_port
 
 
 class BaseDAQConnection(with_metaclass(abc.ABCMeta, object)):
@@ -29,20 +86,32 @@ class BaseDAQConnection(with_metaclass(abc.ABCMeta, object)):
 
     :param logger: logger object
     :type logger: logging.Logger
+    :param serial_port: serial port to use instead of the detected one
+    :type serial_port: serial.Serial
+    :param polling: poll the serial port with adaptive sleeps instead of
+                    blocking until data arrives
+    :type polling: bool
     :raises: SystemError
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, serial_port=None, polling=False):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
         self.running = 1
+        self.polling = polling
 
-        try:
-            self.serial_port = self.get_serial_port()
-        except serial.SerialException as e:
-            self.logger.fatal("SerialException thrown! Value: %s" % e.message)
-            raise SystemError(e)
+        # incomplete line of the last chunk read
+        self._remainder = b""
+
+        if serial_port is None:
+            try:
+                serial_port = self.get_serial_port()
+            except serial.SerialException as e:
+                self.logger.fatal("SerialException thrown! Value: %s" %
+                                  e.message)
+                raise SystemError(e)
+        self.serial_port = serial_port
 
     def get_serial_port(self):
         """
@@ -53,44 +122,45 @@ class BaseDAQConnection(with_metaclass(abc.ABCMeta, object)):
         :returns: serial.Serial -- serial connection port
         :raises: OSError
         """
-        connected = False
-        serial_port = None
+        return find_serial_port(self.logger)
 
-        def get_dev_path(script):
-            tty = subprocess.Popen(
-                    [script], stdout=subprocess.PIPE).communicate()[0]
-            return "/dev/%s" % tty.rstrip('\n')
+    def read_lines(self):
+        """
+        Wait until data arrives on the serial port, at most for the timeout
+        of the port, and read everything available in one chunk. Returns
+        the complete lines read so far with line breaks stripped.
 
-        while not connected:
-            try:
-                dev = get_dev_path("which_tty_daq")
-            except OSError:
-                # try using package script ../../bin/which_tty_daq
-                which_tty_daq = os.path.abspath(
-                        os.path.join(os.path.dirname(__file__), os.pardir,
-                                     os.pardir, 'bin', 'which_tty_daq'))
+        :returns: list of str
+        """
+        data = self.serial_port.read(1)
 
-                if not os.path.exists(which_tty_daq):
-                    raise OSError("Can not find binary which_tty_daq")
+        if not data:
+            return []
 
-                dev = get_dev_path(which_tty_daq)
+        waiting = self.serial_port.inWaiting()
+        if waiting:
+            data += self.serial_port.read(waiting)
 
-            self.logger.info("Daq found at %s", dev)
-            self.logger.info("trying to connect...")
+        lines = (self._remainder + data).split(b"\n")
+        self._remainder = lines.pop()
 
-            try:
-                serial_port = serial.Serial(port=dev, baudrate=115200,
-                                            bytesize=8, parity='N', stopbits=1,
-                                            timeout=0.5, xonxoff=True)
-                connected = True
-            except serial.SerialException as e:
-                self.logger.error(e)
-                self.logger.error("Waiting 5 seconds")
-                sleep(5)
+        return [line.strip() for line in lines]
 
-        self.logger.info("Successfully connected to serial port")
+    def _reconnect(self):
+        """
+        Reopen the serial port after an I/O error.
 
-        return serial_port
+        :returns: None
+        """
+        self.logger.error("IOError")
+        self.serial_port.close()
+        self.serial_port = self.get_serial_port()
+        self._remainder = b""
+        # this has to be implemented in the future
+        # for now, we assume that the card does not forget
+        # its settings, only because the USB connection is
+        # broken
+        # self.setup_daq.setup(self.commandqueue)
 
     @abc.abstractmethod
     def read(self):
@@ -118,13 +188,19 @@ class DAQConnection(BaseDAQConnection):
     :param in_queue: queue for incoming data
     :type in_queue: multiprocessing.Queue
     :param out_queue: queue for outgoing data
-    :type out_queue: multiprocessing.Queue
+    :type out_queue: multiprocessing.Queue or SharedRingBuffer
     :param logger: logger object
     :type logger: logging.Logger
+    :param serial_port: serial port to use instead of the detected one
+    :type serial_port: serial.Serial
+    :param polling: poll the serial port with adaptive sleeps instead of
+                    blocking until data arrives
+    :type polling: bool
     """
 
-    def __init__(self, in_queue, out_queue, logger=None):
-        BaseDAQConnection.__init__(self, logger)
+    def __init__(self, in_queue, out_queue, logger=None, serial_port=None,
+                 polling=False):
+        BaseDAQConnection.__init__(self, logger, serial_port, polling)
         self.in_queue = in_queue
         self.out_queue = out_queue
 
@@ -132,6 +208,23 @@ class DAQConnection(BaseDAQConnection):
         """
         Get data from the DAQ. Read it from the provided Queue.
 
+        :returns: None
+        """
+        if self.polling:
+            self._poll()
+            return
+
+        while self.running:
+            try:
+                put_lines(self.out_queue, self.read_lines())
+            except (IOError, OSError):
+                self._reconnect()
+
+    def _poll(self):
+        """
+        Get data from the DAQ, polling the serial port with adaptive
+        sleeps in between.
+
         :returns: None
         """
         min_sleep_time = 0.01  # seconds
@@ -141,21 +234,16 @@ class DAQConnection(BaseDAQConnection):
         while self.running:
             try:
                 if self.serial_port.inWaiting():
+                    lines = []
                     while self.serial_port.inWaiting():
-                        self.out_queue.put(self.serial_port.readline().strip())
+                        lines.append(self.serial_port.readline().strip())
+                    put_lines(self.out_queue, lines)
                     sleep_time = max(sleep_time / 2, min_sleep_time)
                 else:
                     sleep_time = min(1.5 * sleep_time, max_sleep_time)
                 sleep(sleep_time)
             except (IOError, OSError):
-                self.logger.error("IOError")
-                self.serial_port.close()
-                self.serial_port = self.get_serial_port()
-                # this has to be implemented in the future
-                # for now, we assume that the card does not forget
-                # its settings, only because the USB connection is
-                # broken
-                # self.setup_daq.setup(self.commandqueue)
+                self._reconnect()
 
     def write(self):
         """
@@ -194,16 +282,36 @@ class DAQServer(BaseDAQConnection):
     :type port: int
     :param logger: logger object
     :type logger: logging.Logger
+    :param serial_port: serial port to use instead of the detected one
+    :type serial_port: serial.Serial
+    :param polling: poll the serial port with adaptive sleeps instead of
+                    blocking until data arrives
+    :type polling: bool
+    :param broadcast: publish the DAQ lines to any number of subscribers
+                      and receive commands on a separate port
+    :type broadcast: bool
+    :param command_port: TCP port for commands in broadcast mode,
+                         defaults to port + 1
+    :type command_port: int
     :raises: DAQMissingDependencyError
     """
 
-    def __init__(self, address='127.0.0.1', port=5556, logger=None):
-        BaseDAQConnection.__init__(self, logger)
-        try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.bind("tcp://%s:%d" % (address, port))
-        except NameError:
-            raise DAQMissingDependencyError("no zmq installed...")
+    def __init__(self, address='127.0.0.1', port=5556, logger=None,
+                 serial_port=None, polling=False, broadcast=False,
+                 command_port=None):
+        BaseDAQConnection.__init__(self, logger, serial_port, polling)
+        self.publisher = None
+
+        if broadcast:
+            if command_port is None:
+                command_port = port + 1
+            self.publisher = DAQPublisher(address, port, command_port)
+        else:
+            try:
+                self.socket = zmq.Context().socket(zmq.PAIR)
+                self.socket.bind("tcp://%s:%d" % (address, port))
+            except NameError:
+                raise DAQMissingDependencyError("no zmq installed...")
 
     def serve(self):
         """
@@ -211,14 +319,66 @@ class DAQServer(BaseDAQConnection):
 
         :returns: None
         """
+        if self.publisher is not None:
+            self.broadcast()
+            return
+
         while True:
             self.read()
             self.write()
 
+    def broadcast(self):
+        """
+        Publish everything read from the DAQ and pass received commands
+        to the DAQ. Waits for both at the same time.
+
+        :returns: None
+        """
+        poller = zmq.Poller()
+        poller.register(self.publisher.command_socket, zmq.POLLIN)
+        serial_fd = self.serial_port.fileno()
+        poller.register(serial_fd, zmq.POLLIN)
+
+        while self.running:
+            try:
+                events = dict(poller.poll(1000))
+
+                if serial_fd in events:
+                    for line in self.read_lines():
+                        self.publisher.publish(line)
+
+                if self.publisher.command_socket in events:
+                    command = self.publisher.receive_command()
+                    self.serial_port.write((str(command) + "\r").encode(
+                            "ascii", "replace"))
+            except (IOError, OSError):
+                self._reconnect()
+                poller.unregister(serial_fd)
+                serial_fd = self.serial_port.fileno()
+                poller.register(serial_fd, zmq.POLLIN)
+
     def read(self):
         """
         Get data from the DAQ. Read it from the provided Queue.
 
+        :returns: None
+        """
+        if self.polling:
+            self._poll()
+            return
+
+        while self.running:
+            try:
+                for line in self.read_lines():
+                    self.socket.send(line)
+            except (IOError, OSError):
+                self._reconnect()
+
+    def _poll(self):
+        """
+        Get data from the DAQ, polling the serial port with adaptive
+        sleeps in between.
+
         :returns: None
         """
         min_sleep_time = 0.01  # seconds
@@ -234,14 +394,7 @@ class DAQServer(BaseDAQConnection):
                     sleep_time = min(1.5 * sleep_time, max_sleep_time)
                 sleep(sleep_time)
             except (IOError, OSError):
-                self.logger.error("IOError")
-                self.serial_port.close()
-                self.serial_port = self.get_serial_port()
-                # this has to be implemented in the future
-                # for now, we assume that the card does not forget
-                # its settings, only because the USB connection is
-                # broken
-                # self.setup_daq.setup(self.commandqueue)
+                self._reconnect()
 
     def write(self):
         """
@@ -256,6 +409,24 @@ class DAQServer(BaseDAQConnection):
 
 
 if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Serve the DAQ to muonic " +
+                                        "clients started with --port")
+    parser.add_argument("--port", dest="port", type=int, default=5556,
+                        help="TCP port to serve the DAQ on")
+    parser.add_argument("--broadcast", dest="broadcast",
+                        action="store_true", default=False,
+                        help="publish the DAQ lines to any number of " +
+                             "clients started with --subscribe")
+    parser.add_argument("--command-port", dest="command_port", type=int,
+                        default=None,
+                        help="TCP port for commands in broadcast mode, " +
+                             "defaults to port + 1")
+    args = parser.parse_args()
+
     logger = logging.getLogger()
-    server = DAQServer(port=5556, logger=logger)
+    server = DAQServer(port=args.port, logger=logger,
+                       broadcast=args.broadcast,
+                       command_port=args.command_port)
     server.serve()
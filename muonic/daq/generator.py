@@ -0,0 +1,347 @@
+"""
+Synthesizes DAQ trigger lines from a simple detector model. Besides
+feeding the DAQ simulation, the generator serves as a fixture with known
+truth, e.g. to benchmark the triggers of muonic.analysis or to check the
+accuracy of the lifetime fit.
+
+The model knows three kinds of events:
+
+* single pulses in one channel, the channel is chosen according to the
+  channel rates
+* muons passing two channels, the lower channel fires after a normal
+  distributed flight time
+* muons stopping in a channel after passing another one, the stopping
+  channel fires a second time after an exponentially distributed decay
+  time
+
+On top of that, every channel adds uncorrelated pulses to the trigger
+window according to its rate. Channels are numbered 0 to 3 like on the
+card, in the pulses extracted by muonic.analysis.PulseExtractor a channel
+has the index channel + 1.
+"""
+from __future__ import print_function
+import datetime
+
+import numpy as np
+
+__all__ = ["EventGenerator", "format_daq_lines", "SINGLE", "COINCIDENCE",
+           "DECAY"]
+
+# event types
+SINGLE = 0
+COINCIDENCE = 1
+DECAY = 2
+
+FREQUENCY = 25000000
+COUNTER_RANGE = 1 << 32
+
+# one counter tick of the DAQ card is divided into 32 tmc ticks
+COUNTER_TICK = 1.0e9 / FREQUENCY  # nsec
+TMC_TICK = COUNTER_TICK / 32  # nsec
+
+BIT5 = 1 << 5
+BIT7 = 1 << 7
+
+_HEX_CHARS = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+
+
+def _format_edges(edges):
+    """
+    Format the edge bytes of the lines as the eight hex fields of
+    a DAQ message, e.g. "B3 00 31 00 00 00 00 00".
+
+    :param edges: one line per row, eight edge bytes each
+    :type edges: numpy.ndarray
+    :returns: list of str
+    """
+    chars = np.empty((len(edges), 24), dtype=np.uint8)
+    chars[:, 0::3] = _HEX_CHARS[edges >> 4]
+    chars[:, 1::3] = _HEX_CHARS[edges & 15]
+    chars[:, 2::3] = ord(" ")
+
+    text = chars[:, :23].tobytes().decode("ascii")
+    return [text[index:index + 23] for index in range(0, len(text), 23)]
+
+
+def format_daq_lines(events, event_counters, counter_phase, start_time):
+    """
+    Complete the lines of a block of events with the trigger counter, the
+    1PPS counter and the GPS time and date.
+
+    The counters are derived from an absolute count of the 25 MHz clock,
+    wrapped to 32 bit like on the card. The 1PPS counter holds the count
+    of the last full second, seconds start at counter_phase.
+
+    :param events: block of events as returned by EventGenerator.generate
+    :type events: dict
+    :param event_counters: absolute clock count of each trigger
+    :type event_counters: numpy.ndarray
+    :param counter_phase: absolute clock count of the first full second
+    :type counter_phase: int
+    :param start_time: GPS time of the first full second
+    :type start_time: datetime.datetime
+    :returns: list of str
+    """
+    lengths = events["event_lengths"]
+    counters = (np.repeat(np.asarray(event_counters, dtype=np.int64),
+                          lengths) + events["line_offsets"])
+    seconds = (counters - counter_phase) // FREQUENCY
+
+    one_pps = ((seconds * FREQUENCY + counter_phase) %
+               COUNTER_RANGE).tolist()
+    trigger_counts = (counters % COUNTER_RANGE).tolist()
+
+    # GPS time and date of the distinct seconds
+    unique_seconds, second_index = np.unique(seconds, return_inverse=True)
+    time_fields = [
+        (start_time + datetime.timedelta(seconds=second)).strftime(
+                "%H%M%S.000 %d%m%y")
+        for second in unique_seconds.tolist()]
+
+    return ["%08X %s %08X %s A 08 0 +0000" % (trigger_count, edges, pps,
+                                              time_fields[index])
+            for trigger_count, edges, pps, index in zip(
+                trigger_counts, events["line_edges"], one_pps,
+                second_index.tolist())]
+
+
+class EventGenerator(object):
+    """
+    Generates blocks of synthetic events from a detector model.
+
+    Pulse widths are normal distributed, all times are given in ns.
+
+    :param channel_rates: rates of the channels in Hz
+    :type channel_rates: tuple of float
+    :param coincidence_fraction: fraction of events with a muon passing
+                                 the coincidence channels
+    :type coincidence_fraction: float
+    :param decay_fraction: fraction of events with a muon decay
+    :type decay_fraction: float
+    :param coincidence_channels: upper and lower channel of the
+                                 coincidence events
+    :type coincidence_channels: tuple of int
+    :param decay_channels: channel the decaying muon passes and channel
+                           it stops in
+    :type decay_channels: tuple of int
+    :param lifetime: muon lifetime
+    :type lifetime: float
+    :param flight_time: mean and standard deviation of the flight time
+                        between two channels
+    :type flight_time: tuple of float
+    :param pulse_width: mean and standard deviation of the pulse width
+    :type pulse_width: tuple of float
+    :param trigger_window: length of the trigger window
+    :type trigger_window: float
+    :param trigger_rate: rate of triggers in Hz, defaults to the sum of
+                         the channel rates
+    :type trigger_rate: float
+    :param seed: seed of the random generator
+    :type seed: int
+    :raises: ValueError
+    """
+
+    def __init__(self, channel_rates=(20.0, 20.0, 20.0, 20.0),
+                 coincidence_fraction=0.3, decay_fraction=0.1,
+                 coincidence_channels=(0, 1), decay_channels=(1, 2),
+                 lifetime=2197.0, flight_time=(5.0, 1.5),
+                 pulse_width=(40.0, 5.0), trigger_window=10000.0,
+                 trigger_rate=None, seed=None):
+        if len(channel_rates) != 4:
+            raise ValueError("rates of four channels required")
+        if coincidence_fraction + decay_fraction > 1:
+            raise ValueError("fractions of coincidences and decays " +
+                             "exceed 1")
+
+        self.channel_rates = np.array(channel_rates, dtype=np.float64)
+        self.coincidence_fraction = coincidence_fraction
+        self.decay_fraction = decay_fraction
+        self.coincidence_channels = coincidence_channels
+        self.decay_channels = decay_channels
+        self.lifetime = lifetime
+        self.flight_time = flight_time
+        self.pulse_width = pulse_width
+        self.trigger_window = trigger_window
+
+        if trigger_rate is None:
+            trigger_rate = self.channel_rates.sum()
+        self.trigger_rate = trigger_rate
+
+        self.random = np.random.RandomState(seed)
+
+        # state of generate_lines
+        self._counter = int(self.random.randint(0, COUNTER_RANGE,
+                                                dtype=np.int64))
+        self._counter_phase = self._counter
+        self._start_time = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def _generate_pulses(self, event_types):
+        """
+        Generate the rising edges of the pulses of the events.
+
+        :param event_types: type of each event
+        :type event_types: numpy.ndarray
+        :returns: tuple of numpy.ndarray -- event index, channel and
+                  rising edge of each pulse, decay and flight times
+        """
+        event_count = len(event_types)
+        flight_times = np.full(event_count, np.nan)
+        decay_times = np.full(event_count, np.nan)
+        event_index = []
+        channels = []
+        rising_edges = []
+
+        def add(index, channel, times):
+            event_index.append(index)
+            channels.append(np.broadcast_to(channel, index.shape))
+            rising_edges.append(times)
+
+        # pulses of the trigger
+        singles = np.flatnonzero(event_types == SINGLE)
+        add(singles, self.random.choice(
+                4, len(singles), p=self.channel_rates /
+                self.channel_rates.sum()),
+            np.zeros(len(singles)))
+
+        coincidences = np.flatnonzero(event_types == COINCIDENCE)
+        flight_times[coincidences] = self.random.normal(
+                self.flight_time[0], self.flight_time[1], len(coincidences))
+        add(coincidences, self.coincidence_channels[0],
+            np.zeros(len(coincidences)))
+        add(coincidences, self.coincidence_channels[1],
+            flight_times[coincidences])
+
+        decays = np.flatnonzero(event_types == DECAY)
+        stop_times = np.abs(self.random.normal(
+                self.flight_time[0], self.flight_time[1], len(decays)))
+        decay_times[decays] = self.random.exponential(self.lifetime,
+                                                      len(decays))
+        add(decays, self.decay_channels[0], np.zeros(len(decays)))
+        add(decays, self.decay_channels[1], stop_times)
+        add(decays, self.decay_channels[1],
+            stop_times + decay_times[decays])
+
+        # uncorrelated pulses within the trigger window
+        counts = self.random.poisson(self.channel_rates * 1e-9 *
+                                     self.trigger_window, (event_count, 4))
+        noise_index = np.repeat(np.arange(event_count), counts.sum(axis=1))
+        add(noise_index, np.tile(np.arange(4), event_count).repeat(
+                counts.ravel()),
+            self.random.uniform(0, self.trigger_window, len(noise_index)))
+
+        return (np.concatenate(event_index), np.concatenate(channels),
+                np.concatenate(rising_edges), decay_times, flight_times)
+
+    def generate(self, event_count):
+        """
+        Generate a block of events. Returns a dict with the lines of
+        the events without counters and GPS time:
+
+        * line_offsets -- counter ticks of each line after the trigger
+        * line_edges -- edge fields of each line
+        * event_lengths -- number of lines of each event
+        * rising_edges -- number of rising edges per event and channel
+
+        and the truth of the events:
+
+        * event_types -- SINGLE, COINCIDENCE or DECAY
+        * decay_times -- decay time of the muon, NaN for other events
+        * flight_times -- flight time between the coincidence channels,
+          NaN for other events
+
+        Decays later than the trigger window leave no second pulse. Note
+        that muonic.analysis.PulseExtractor takes the edges of a line
+        relative to the counter of the preceding line, not of the
+        trigger, so the decay times found by the decay trigger are
+        shorter than the truth by one or two counter ticks.
+
+        :param event_count: number of events
+        :type event_count: int
+        :returns: dict
+        """
+        event_types = self.random.choice(
+                [SINGLE, COINCIDENCE, DECAY], event_count,
+                p=[1 - self.coincidence_fraction - self.decay_fraction,
+                   self.coincidence_fraction, self.decay_fraction])
+        event_index, channels, rising_edges, decay_times, flight_times = \
+            self._generate_pulses(event_types)
+
+        # the first pulse triggers, it starts anywhere within the
+        # first counter tick
+        first = np.full(event_count, np.inf)
+        np.minimum.at(first, event_index, rising_edges)
+        rising_edges += (self.random.uniform(0, COUNTER_TICK, event_count) -
+                         first)[event_index]
+        falling_edges = rising_edges + np.maximum(self.random.normal(
+                self.pulse_width[0], self.pulse_width[1],
+                len(rising_edges)), TMC_TICK)
+
+        # edges as (event, time, edge field), the card only records
+        # edges within the trigger window
+        edge_index = np.concatenate((event_index, event_index))
+        edge_times = np.concatenate((rising_edges, falling_edges))
+        edge_fields = np.concatenate((2 * channels, 2 * channels + 1))
+        recorded = edge_times < self.trigger_window
+        edge_index = edge_index[recorded]
+        edge_times = edge_times[recorded]
+        edge_fields = edge_fields[recorded]
+
+        ticks = (edge_times // COUNTER_TICK).astype(np.int64)
+        tmc = ((edge_times - ticks * COUNTER_TICK) //
+               TMC_TICK).astype(np.int64)
+
+        # one line per event and counter tick with edges
+        order = np.lexsort((ticks, edge_index))
+        edge_index = edge_index[order]
+        ticks = ticks[order]
+        new_line = np.ones(len(order), dtype=bool)
+        new_line[1:] = ((edge_index[1:] != edge_index[:-1]) |
+                        (ticks[1:] != ticks[:-1]))
+        line_index = np.cumsum(new_line) - 1
+
+        edges = np.zeros((new_line.sum(), 8), dtype=np.uint8)
+        edges[line_index, edge_fields[order]] = BIT5 | tmc[order]
+
+        line_events = edge_index[new_line]
+        event_lengths = np.bincount(line_events, minlength=event_count)
+        first_lines = np.cumsum(event_lengths) - event_lengths
+        edges[first_lines, 0] |= BIT7
+
+        # count the recorded rising edges for the scalars
+        rising_counts = np.zeros((event_count, 4), dtype=np.int64)
+        np.add.at(rising_counts, line_events,
+                  (edges[:, 0::2] & BIT5).astype(bool))
+
+        return {
+            "line_offsets": ticks[new_line],
+            "line_edges": _format_edges(edges),
+            "event_lengths": event_lengths,
+            "rising_edges": rising_counts,
+            "event_types": event_types,
+            "decay_times": decay_times,
+            "flight_times": flight_times
+        }
+
+    def generate_lines(self, event_count):
+        """
+        Generate complete DAQ lines of a block of events, spaced in time
+        according to the trigger rate. Subsequent calls continue the
+        counters and the GPS time.
+
+        :param event_count: number of events
+        :type event_count: int
+        :returns: tuple of list of str and dict -- lines and the block of
+                  events as returned by generate
+        """
+        events = self.generate(event_count)
+
+        min_spacing = int(self.trigger_window // COUNTER_TICK) + 1
+        spacing = np.maximum(self.random.exponential(
+                FREQUENCY / self.trigger_rate, event_count),
+            min_spacing).astype(np.int64)
+        event_counters = self._counter + np.cumsum(spacing)
+        self._counter = int(event_counters[-1])
+
+        return (format_daq_lines(events, event_counters,
+                                 self._counter_phase, self._start_time),
+                events)
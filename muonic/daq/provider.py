@@ -5,10 +5,14 @@ Provides the public interfaces to read from and send to a DAQ card
 from __future__ import print_function
 import abc
 from future.utils import with_metaclass
+from collections import deque
 import logging
 import multiprocessing as mp
 import re
 import queue
+import select
+import socket
+import time
 
 try:
     import zmq
@@ -18,6 +22,9 @@ except ImportError:
 
 from muonic.daq import DAQIOError, DAQMissingDependencyError
 from muonic.daq import DAQSimulationConnection, DAQConnection
+from muonic.daq import SharedRingBuffer
+from muonic.daq.broadcast import unpack_sequence
+from muonic.daq.ringbuffer import get_lines
 
 
 class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
@@ -31,10 +38,14 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
 
     LINE_PATTERN = re.compile("^[a-zA-Z0-9+-.,:()=$/#?!%_@*|~' ]*[\n\r]*$")
 
+    # matches a block of valid lines joined by line breaks
+    BLOCK_PATTERN = re.compile("^[a-zA-Z0-9+-.,:()=$/#?!%_@*|~' \n]*$")
+
     def __init__(self, logger=None):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
+        self.garbage_count = 0
 
     @abc.abstractmethod
     def get(self, *args):
@@ -47,6 +58,21 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
         """
         return
 
+    @abc.abstractmethod
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Get up to max_items validated lines from the DAQ. Invalid lines
+        are dropped and counted in garbage_count.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds,
+                        forever if None
+        :type timeout: float
+        :returns: list of str
+        """
+        return
+
     @abc.abstractmethod
     def put(self, *args):
         """
@@ -84,6 +110,36 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
             return None
         return line
 
+    def _validate_lines(self, lines):
+        """
+        Validate a block of lines. The block is checked as a whole and
+        only if it contains garbage, the lines are checked one by one.
+        Returns the valid lines.
+
+        :param lines: lines to validate
+        :type lines: list of str
+        :returns: list of str
+        """
+        if not lines:
+            return lines
+
+        block = "\n".join(lines)
+
+        if (self.BLOCK_PATTERN.match(block) is not None and
+                block.count("\n") == len(lines) - 1):
+            return lines
+
+        valid_lines = [line for line in lines
+                       if self.LINE_PATTERN.match(line) is not None]
+        garbage = len(lines) - len(valid_lines)
+
+        if garbage:
+            self.garbage_count += garbage
+            self.logger.warning(("Got %d lines of garbage from the DAQ, " +
+                                 "%d in total") % (garbage,
+                                                   self.garbage_count))
+        return valid_lines
+
 
 class DAQProvider(BaseDAQProvider):
     """
@@ -93,16 +149,31 @@ class DAQProvider(BaseDAQProvider):
     :type logger: logging.Logger
     :param sim: enables DAQ simulation if set to True
     :type sim: bool
+    :param ring_buffer: transport the lines read from the DAQ in blocks
+                        through a shared memory ring buffer instead of
+                        a multiprocessing.Queue
+    :type ring_buffer: bool
+    :param sim_rate: number of lines per second to simulate, the default
+                     simulation is used if None
+    :type sim_rate: float
+    :param sim_generator: generator of the simulated events, replays the
+                          simulation file if None
+    :type sim_generator: muonic.daq.generator.EventGenerator
     """
 
-    def __init__(self, logger=None, sim=False):
+    def __init__(self, logger=None, sim=False, ring_buffer=False,
+                 sim_rate=None, sim_generator=None):
         BaseDAQProvider.__init__(self, logger)
-        self.out_queue = mp.Queue()
+        if ring_buffer:
+            self.out_queue = SharedRingBuffer()
+        else:
+            self.out_queue = mp.Queue()
         self.in_queue = mp.Queue()
 
         if sim:
             self.daq = DAQSimulationConnection(self.in_queue, self.out_queue,
-                                               self.logger)
+                                               self.logger, sim_rate,
+                                               sim_generator)
         else:
             self.daq = DAQConnection(self.in_queue, self.out_queue,
                                      self.logger)
@@ -138,6 +209,21 @@ class DAQProvider(BaseDAQProvider):
 
         return self._validate_line(line)
 
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Get up to max_items validated lines from the DAQ. Invalid lines
+        are dropped and counted in garbage_count.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds,
+                        forever if None
+        :type timeout: float
+        :returns: list of str
+        """
+        return self._validate_lines(get_lines(self.out_queue, max_items,
+                                              timeout))
+
     def put(self, *args):
         """
         Send information to the DAQ.
@@ -174,17 +260,79 @@ class DAQClient(BaseDAQProvider):
     :type port: int
     :param logger: logger object
     :type logger: logging.Logger
+    :param subscribe: subscribe to a server in broadcast mode
+    :type subscribe: bool
+    :param command_port: TCP port to send commands to in subscriber mode,
+                         defaults to port + 1
+    :type command_port: int
     :raises: DAQMissingDependencyError
     """
-    
-    def __init__(self, address='127.0.0.1', port=5556, logger=None):
+
+    # time to wait for the server to acknowledge a command in milliseconds
+    COMMAND_TIMEOUT = 2000
+
+    def __init__(self, address='127.0.0.1', port=5556, logger=None,
+                 subscribe=False, command_port=None):
         BaseDAQProvider.__init__(self, logger)
+        self.subscribe = subscribe
+        self.dropped_count = 0
+        self._sequence = None
+
         try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.connect("tcp://%s:%d" % (address, port))
+            self.context = zmq.Context()
         except NameError:
             raise DAQMissingDependencyError("no zmq installed...")
 
+        if subscribe:
+            if command_port is None:
+                command_port = port + 1
+            self.socket = self.context.socket(zmq.SUB)
+            self.socket.connect("tcp://%s:%d" % (address, port))
+            self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+            self._command_address = "tcp://%s:%d" % (address, command_port)
+            self._connect_command_socket()
+        else:
+            self.socket = self.context.socket(zmq.PAIR)
+            self.socket.connect("tcp://%s:%d" % (address, port))
+
+    def _connect_command_socket(self):
+        """
+        (Re)connect the socket commands are sent on in subscriber mode.
+
+        :returns: None
+        """
+        self.command_socket = self.context.socket(zmq.REQ)
+        self.command_socket.setsockopt(zmq.LINGER, 0)
+        self.command_socket.connect(self._command_address)
+
+    def _receive(self, flags=0):
+        """
+        Receive a line from the server. In subscriber mode, lines which
+        were missed are detected by the sequence numbers and counted in
+        dropped_count.
+
+        :param flags: zmq flags
+        :type flags: int
+        :returns: str
+        """
+        if not self.subscribe:
+            return self.socket.recv_string(flags)
+
+        sequence, line = self.socket.recv_multipart(flags)
+        sequence = unpack_sequence(sequence)
+
+        if self._sequence is not None and sequence != self._sequence + 1:
+            dropped = sequence - self._sequence - 1
+            if dropped > 0:
+                self.dropped_count += dropped
+                self.logger.warning("Missed %d lines from the DAQ server" %
+                                    dropped)
+            else:
+                self.logger.info("DAQ server restarted")
+        self._sequence = sequence
+
+        return line.decode("ascii", "replace")
+
     def get(self, *args):
         """
         Get something from the DAQ.
@@ -197,12 +345,40 @@ class DAQClient(BaseDAQProvider):
         :raises: DAQIOError
         """
         try:
-            line = self.socket.recv_string()
+            line = self._receive()
         except Exception:
             raise DAQIOError("Socket error")
         
         return self._validate_line(line)
 
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Get up to max_items validated lines from the DAQ. Invalid lines
+        are dropped and counted in garbage_count.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds,
+                        forever if None
+        :type timeout: float
+        :returns: list of str
+        """
+        if timeout is not None:
+            timeout *= 1000
+
+        lines = []
+
+        if self.socket.poll(timeout):
+            try:
+                while max_items is None or len(lines) < max_items:
+                    lines.append(self._receive(zmq.NOBLOCK))
+            except zmq.Again:
+                pass
+            except Exception:
+                raise DAQIOError("Socket error")
+
+        return self._validate_lines(lines)
+
     def put(self, *args):
         """
         Send information to the DAQ.
@@ -211,7 +387,21 @@ class DAQClient(BaseDAQProvider):
         :type args: list
         :returns: None
         """
-        self.socket.send_string(*args)
+        if not self.subscribe:
+            self.socket.send_string(*args)
+            return
+
+        self.command_socket.send_string(*args)
+
+        if not self.command_socket.poll(self.COMMAND_TIMEOUT):
+            # the socket is stuck waiting for the reply, start over
+            self.logger.error("DAQ server did not acknowledge command " +
+                              "'%s'" % args[0])
+            self.command_socket.close()
+            self._connect_command_socket()
+            return
+
+        self.command_socket.recv_string()
 
     def data_available(self):
         """
@@ -220,3 +410,140 @@ class DAQClient(BaseDAQProvider):
         :returns: int or bool
         """
         return self.socket.poll(200)
+
+
+class DAQStreamClient(BaseDAQProvider):
+    """
+    Client of an AsyncDAQServer. The DAQ lines are received over a plain
+    TCP connection, one line per message terminated by a line break,
+    commands are sent the same way.
+
+    Raises DAQIOError if the server cannot be reached.
+
+    :param address: address to connect to
+    :type address: str
+    :param port: TCP port to connect to
+    :type port: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :raises: DAQIOError
+    """
+
+    # bytes received from the socket at once
+    RECEIVE_SIZE = 65536
+
+    def __init__(self, address='127.0.0.1', port=5558, logger=None):
+        BaseDAQProvider.__init__(self, logger)
+        self._lines = deque()
+        self._remainder = b""
+
+        try:
+            self.socket = socket.create_connection((address, port))
+        except socket.error as e:
+            raise DAQIOError("Could not connect to %s:%d: %s" %
+                             (address, port, e))
+
+    def _receive(self, timeout=0):
+        """
+        Receive the data available on the socket and split it into lines.
+        An incomplete last line is kept until the next call.
+
+        Raises DAQIOError if the server closed the connection.
+
+        :param timeout: time to wait for data in seconds, forever if None
+        :type timeout: float
+        :returns: None
+        :raises: DAQIOError
+        """
+        try:
+            if not select.select([self.socket], [], [], timeout)[0]:
+                return
+            data = self.socket.recv(self.RECEIVE_SIZE)
+        except (socket.error, select.error):
+            raise DAQIOError("Socket error")
+
+        if not data:
+            raise DAQIOError("Connection closed by the DAQ server")
+
+        lines = (self._remainder + data).split(b"\n")
+        self._remainder = lines.pop()
+        self._lines.extend(line.strip().decode("ascii", "replace")
+                           for line in lines)
+
+    def get(self, *args):
+        """
+        Get something from the DAQ.
+
+        Raises DAQIOError if no data is available.
+
+        :param args: ignored, for compatibility with DAQProvider
+        :type args: list
+        :returns: str or None -- next line read from the socket
+        :raises: DAQIOError
+        """
+        if not self._lines:
+            self._receive()
+
+        try:
+            line = self._lines.popleft()
+        except IndexError:
+            raise DAQIOError("Queue is empty")
+
+        return self._validate_line(line)
+
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Get up to max_items validated lines from the DAQ. Invalid lines
+        are dropped and counted in garbage_count.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds,
+                        forever if None
+        :type timeout: float
+        :returns: list of str
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        self._receive(0)
+
+        while not self._lines:
+            if deadline is None:
+                self._receive(None)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._receive(remaining)
+
+        lines = []
+        try:
+            while max_items is None or len(lines) < max_items:
+                lines.append(self._lines.popleft())
+        except IndexError:
+            pass
+
+        return self._validate_lines(lines)
+
+    def put(self, *args):
+        """
+        Send information to the DAQ.
+
+        :param args: command as first argument
+        :type args: list
+        :returns: None
+        """
+        try:
+            self.socket.sendall((str(args[0]) + "\n").encode("ascii",
+                                                             "replace"))
+        except socket.error:
+            raise DAQIOError("Socket error")
+
+    def data_available(self):
+        """
+        Tests if data is available from the DAQ.
+
+        :returns: int
+        """
+        if not self._lines:
+            self._receive(0.2)
+        return len(self._lines)
@@ -0,0 +1,248 @@
+"""
+Provides a shared memory ring buffer to transport lines read from the DAQ
+card between processes in blocks.
+"""
+from __future__ import print_function
+from collections import deque
+import ctypes
+import multiprocessing as mp
+import queue
+import time
+
+
+def put_lines(out_queue, lines):
+    """
+    Put a block of lines into the queue. Uses a single put_many call
+    if the queue supports it and one put per line otherwise.
+
+    :param out_queue: queue for outgoing data
+    :type out_queue: multiprocessing.Queue or SharedRingBuffer
+    :param lines: lines to put into the queue
+    :type lines: list of str
+    :returns: None
+    """
+    if not lines:
+        return
+
+    if isinstance(out_queue, SharedRingBuffer):
+        out_queue.put_many(lines)
+    else:
+        for line in lines:
+            out_queue.put(line)
+
+
+def get_lines(out_queue, max_items=None, timeout=0):
+    """
+    Get up to max_items lines from the queue. Waits up to timeout
+    seconds for the first line, forever if timeout is None. Returns
+    an empty list if no line is available.
+
+    :param out_queue: queue for outgoing data
+    :type out_queue: multiprocessing.Queue or SharedRingBuffer
+    :param max_items: maximum number of lines, no limit if None
+    :type max_items: int
+    :param timeout: time to wait for the first line in seconds
+    :type timeout: float
+    :returns: list of str
+    """
+    if isinstance(out_queue, SharedRingBuffer):
+        return out_queue.get_many(max_items, timeout)
+
+    lines = []
+
+    try:
+        if timeout == 0:
+            lines.append(out_queue.get(False))
+        else:
+            lines.append(out_queue.get(True, timeout))
+
+        while max_items is None or len(lines) < max_items:
+            lines.append(out_queue.get(False))
+    except queue.Empty:
+        pass
+    return lines
+
+
+class SharedRingBuffer(object):
+    """
+    Queue of lines stored in a ring buffer in shared memory, for exactly
+    one producer and one consumer process. The producer appends whole
+    blocks of lines, the consumer takes everything available at once
+    and hands out the lines from a local buffer. Provides the subset of
+    the multiprocessing.Queue interface used by the DAQ connections.
+
+    If the ring buffer is full, the producer waits for the consumer.
+
+    :param size: size of the ring buffer in bytes
+    :type size: int
+    """
+
+    DEFAULT_SIZE = 1 << 24
+    POLL_INTERVAL = 0.005  # seconds
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self._size = size
+        self._buffer = mp.RawArray(ctypes.c_char, size)
+
+        # total number of bytes written and read, the lock serves as
+        # memory barrier between the data and the counters
+        self._written = mp.RawValue(ctypes.c_uint64, 0)
+        self._read = mp.RawValue(ctypes.c_uint64, 0)
+        self._lock = mp.Lock()
+
+        # consumer side
+        self._lines = deque()
+        self._remainder = b""
+
+    def put(self, line, *args):
+        """
+        Put a single line into the buffer.
+
+        :param line: line without line break
+        :type line: str or bytes
+        :param args: ignored, for compatibility with Queue.put
+        :type args: list
+        :returns: None
+        """
+        self.put_many([line])
+
+    def put_many(self, lines):
+        """
+        Put a block of lines into the buffer with a single copy.
+
+        :param lines: lines without line breaks
+        :type lines: list of str or bytes
+        :returns: None
+        """
+        data = b"".join([(line if isinstance(line, bytes) else
+                          line.encode("ascii", "replace")) + b"\n"
+                         for line in lines])
+        offset = 0
+
+        while offset < len(data):
+            with self._lock:
+                written = self._written.value
+                free = self._size - (written - self._read.value)
+
+            if not free:
+                time.sleep(self.POLL_INTERVAL)
+                continue
+
+            chunk = data[offset:offset + free]
+            start = written % self._size
+            first = min(len(chunk), self._size - start)
+
+            self._buffer[start:start + first] = chunk[:first]
+            if first < len(chunk):
+                self._buffer[0:len(chunk) - first] = chunk[first:]
+
+            with self._lock:
+                self._written.value = written + len(chunk)
+
+            offset += len(chunk)
+
+    def _fetch(self):
+        """
+        Move all complete lines from the shared buffer to the local
+        buffer of the consumer.
+
+        :returns: None
+        """
+        with self._lock:
+            written = self._written.value
+            read = self._read.value
+
+        if written == read:
+            return
+
+        start = read % self._size
+        stop = written % self._size
+
+        if start < stop:
+            data = self._buffer[start:stop]
+        else:
+            data = self._buffer[start:self._size] + self._buffer[0:stop]
+
+        with self._lock:
+            self._read.value = written
+
+        lines = (self._remainder + data).split(b"\n")
+        self._remainder = lines.pop()
+
+        if not isinstance(b"", str):
+            lines = [line.decode("ascii", "replace") for line in lines]
+
+        self._lines.extend(lines)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return a line from the buffer.
+
+        Raises queue.Empty if no line is available.
+
+        :param block: wait for a line if none is available
+        :type block: bool
+        :param timeout: maximum time to wait in seconds
+        :type timeout: float
+        :returns: str
+        :raises: queue.Empty
+        """
+        if not self._lines:
+            self._fetch()
+
+        if block and not self._lines:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._lines:
+                if timeout is not None and time.time() >= deadline:
+                    break
+                time.sleep(self.POLL_INTERVAL)
+                self._fetch()
+
+        if not self._lines:
+            raise queue.Empty
+
+        return self._lines.popleft()
+
+    def get_many(self, max_items=None, timeout=0):
+        """
+        Remove and return up to max_items lines from the buffer. Waits up
+        to timeout seconds for the first line, forever if timeout is None.
+        Returns an empty list if no line is available.
+
+        :param max_items: maximum number of lines, no limit if None
+        :type max_items: int
+        :param timeout: time to wait for the first line in seconds
+        :type timeout: float
+        :returns: list of str
+        """
+        try:
+            self._lines.appendleft(self.get(timeout != 0, timeout))
+        except queue.Empty:
+            return []
+
+        self._fetch()
+
+        if max_items is None or max_items >= len(self._lines):
+            lines = list(self._lines)
+            self._lines.clear()
+        else:
+            lines = [self._lines.popleft() for _ in range(max_items)]
+        return lines
+
+    def qsize(self):
+        """
+        Get the number of lines available.
+
+        :returns: int
+        """
+        self._fetch()
+        return len(self._lines)
+
+    def empty(self):
+        """
+        Returns True if no lines are available, False otherwise.
+
+        :returns: bool
+        """
+        return not self.qsize()
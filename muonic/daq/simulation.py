@@ -3,6 +3,8 @@ Provides a simple DAQ card simulation, so that software can be tested.
 """
 from __future__ import print_function
 import abc
+from collections import deque
+import datetime
 from future.utils import with_metaclass
 import logging
 import numpy as np
@@ -18,6 +20,9 @@ except ImportError:
     pass
 
 from muonic.daq import DAQMissingDependencyError
+from muonic.daq.broadcast import DAQPublisher
+from muonic.daq.generator import COUNTER_RANGE, FREQUENCY, format_daq_lines
+from muonic.daq.ringbuffer import put_lines
 
 
 class DAQSimulation(object):
@@ -146,19 +151,259 @@ class DAQSimulation(object):
             return False
 
 
+class HighRateDAQSimulation(DAQSimulation):
+    """
+    Simulates a DAQ card sending trigger lines at a configurable rate,
+    e.g. to load test the analysis and the widgets.
+
+    The events are either synthesized by an EventGenerator or taken from
+    the simulation file, which is kept in memory and replayed over and
+    over. The trigger counter, 1PPS counter and GPS time are generated
+    from a simulated 25 MHz clock, so 1PPS switches and counter rollovers
+    happen like on a real card. The scalars are counted from the
+    generated pulses.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param simulation_file: path to the simulation data file
+    :type simulation_file: str
+    :param rate: number of lines per second
+    :type rate: float
+    :param generator: generator of the events, replays the simulation
+                      file if None
+    :type generator: muonic.daq.generator.EventGenerator
+    """
+
+    DEFAULT_RATE = 50000
+    # maximum number of lines generated at once
+    MAX_BLOCK_SIZE = 100000
+
+    def __init__(self, logger, simulation_file=None, rate=DEFAULT_RATE,
+                 generator=None):
+        DAQSimulation.__init__(self, logger, simulation_file)
+        self.rate = float(rate)
+        self.generator = generator
+
+        if generator is None:
+            self._events = self._load_events(self._daq.readlines())
+            sample = self._events
+        else:
+            sample = generator.generate(1000)
+        self._daq.close()
+
+        self._lines = deque()
+        self._next_event = 0
+        self._generated_lines = 0
+        self._start_time = time.time()
+        self._start_datetime = datetime.datetime.utcnow().replace(
+                microsecond=0)
+
+        # counter value at start and at the full seconds
+        self._counter = int(np.random.randint(0, COUNTER_RANGE,
+                                              dtype=np.int64))
+        self._counter_phase = self._counter
+
+        # mean spacing of the events in counts to reach the rate
+        self._lines_per_event = (len(sample["line_offsets"]) /
+                                 float(len(sample["event_lengths"])))
+        self._event_spacing = FREQUENCY * self._lines_per_event / self.rate
+
+    @staticmethod
+    def _load_events(lines):
+        """
+        Split the simulation file into events, each starting with a line
+        with the trigger flag set. Lines before the first trigger and
+        other messages are skipped. Returns the events in the format of
+        EventGenerator.generate, without the truth.
+
+        :param lines: lines of the simulation file
+        :type lines: list of str
+        :returns: dict
+        """
+        offsets = []
+        edges = []
+        lengths = []
+        rising_edges = []
+        event_start = None
+
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 16 or len(fields[0]) != 8:
+                continue
+
+            try:
+                counter = int(fields[0], 16)
+                edge_values = [int(field, 16) for field in fields[1:9]]
+            except ValueError:
+                continue
+
+            if edge_values[0] & 0x80:
+                event_start = counter
+                lengths.append(0)
+                rising_edges.append([0, 0, 0, 0])
+            elif event_start is None:
+                continue
+
+            offsets.append((counter - event_start) % COUNTER_RANGE)
+            edges.append(" ".join(fields[1:9]))
+            lengths[-1] += 1
+
+            for channel in range(4):
+                if edge_values[2 * channel] & 0x20:
+                    rising_edges[-1][channel] += 1
+
+        return {
+            "line_offsets": np.array(offsets, dtype=np.int64),
+            "line_edges": edges,
+            "event_lengths": np.array(lengths, dtype=np.int64),
+            "rising_edges": np.array(rising_edges, dtype=np.int64)
+        }
+
+    def _replay_events(self, event_count):
+        """
+        Take the next event_count events of the simulation file,
+        starting over at the end of the file.
+
+        :param event_count: number of events
+        :type event_count: int
+        :returns: dict
+        """
+        all_lengths = self._events["event_lengths"]
+        events = (self._next_event + np.arange(event_count)) % \
+            len(all_lengths)
+        self._next_event = int(events[-1] + 1)
+
+        lengths = all_lengths[events]
+        first_lines = np.cumsum(lengths) - lengths
+        all_first_lines = np.cumsum(all_lengths) - all_lengths
+        line_index = (np.repeat(all_first_lines[events], lengths) +
+                      np.arange(lengths.sum()) -
+                      np.repeat(first_lines, lengths))
+
+        all_edges = self._events["line_edges"]
+        return {
+            "line_offsets": self._events["line_offsets"][line_index],
+            "line_edges": [all_edges[index] for index in line_index],
+            "event_lengths": lengths,
+            "rising_edges": self._events["rising_edges"][events]
+        }
+
+    def _generate(self, line_count):
+        """
+        Generate at least line_count trigger lines.
+
+        :param line_count: number of lines
+        :type line_count: int
+        :returns: None
+        """
+        event_count = max(1, int(np.ceil(line_count /
+                                         self._lines_per_event)))
+
+        if self.generator is None:
+            events = self._replay_events(event_count)
+        else:
+            events = self.generator.generate(event_count)
+
+        # events must not overlap
+        spacing = np.maximum(np.random.exponential(self._event_spacing,
+                                                   event_count),
+                             events["line_offsets"].max() + 1).astype(
+                np.int64)
+        event_counters = self._counter + np.cumsum(spacing)
+        self._counter = int(event_counters[-1])
+
+        lines = format_daq_lines(events, event_counters,
+                                 self._counter_phase, self._start_datetime)
+        self._lines.extend(lines)
+        self._generated_lines += len(lines)
+
+        rising_edges = events["rising_edges"].sum(axis=0)
+        for channel in range(4):
+            self._scalars_ch[channel] += int(rising_edges[channel])
+        self._scalars_trigger += event_count
+
+    def _get_due_lines(self):
+        """
+        Get the number of lines which are due to reach the rate.
+
+        :returns: int
+        """
+        due = int((time.time() - self._start_time) * self.rate -
+                  self._generated_lines)
+        return min(due, self.MAX_BLOCK_SIZE)
+
+    def readline(self):
+        """
+        Read the next simulated line.
+
+        :returns: str -- next simulated DAQ output
+        """
+        if self.initial:
+            self.initial = False
+            return "T0=42  T1=42  T2=42  T3=42"
+
+        if self._return_info:
+            self._return_info = False
+            return "DS S0=%08x S1=%08x S2=%08x S3=%08x S4=%08x" % \
+                tuple([scalar % COUNTER_RANGE for scalar in
+                       self._scalars_ch + [self._scalars_trigger]])
+
+        if not self._lines:
+            self._generate(max(self._get_due_lines(), 1))
+
+        line = self._lines.popleft()
+        if not self._lines:
+            # end of the block
+            self._in_waiting = False
+        return line
+
+    def in_waiting(self):
+        """
+        Check if lines are due. Waits a bit if not. Returns False once
+        after each block of lines, so that readers can pass it on.
+
+        :returns: bool
+        """
+        if self.initial or self._return_info or self._lines:
+            return True
+
+        if not self._in_waiting:
+            self._in_waiting = True
+            return False
+
+        due = self._get_due_lines()
+        if due > 0:
+            self._generate(due)
+            return True
+
+        time.sleep(min(0.01, 1.0 / self.rate))
+        return False
+
+
 class BaseDAQSimulationConnection(with_metaclass(abc.ABCMeta, object)):
     """
     Base class for a simulated connection to DAQ card.
 
     :param logger: logger object
     :type logger: logging.Logger
+    :param rate: simulate this many lines per second, see
+                 HighRateDAQSimulation
+    :type rate: float
+    :param generator: generator of the simulated events
+    :type generator: muonic.daq.generator.EventGenerator
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, rate=None, generator=None):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
-        self.serial_port = DAQSimulation(self.logger)
+        if rate is None and generator is None:
+            self.serial_port = DAQSimulation(self.logger)
+        else:
+            if rate is None:
+                rate = HighRateDAQSimulation.DEFAULT_RATE
+            self.serial_port = HighRateDAQSimulation(self.logger, rate=rate,
+                                                     generator=generator)
         self.running = 1
 
     @abc.abstractmethod
@@ -178,13 +423,19 @@ class DAQSimulationConnection(BaseDAQSimulationConnection):
     :param in_queue: queue for incoming data
     :type in_queue: multiprocessing.Queue
     :param out_queue: queue for outgoing data
-    :type out_queue: multiprocessing.Queue
+    :type out_queue: multiprocessing.Queue or SharedRingBuffer
     :param logger: logger object
     :type logger: logging.Logger
+    :param rate: simulate this many lines per second, see
+                 HighRateDAQSimulation
+    :type rate: float
+    :param generator: generator of the simulated events
+    :type generator: muonic.daq.generator.EventGenerator
     """
 
-    def __init__(self, in_queue, out_queue, logger=None):
-        BaseDAQSimulationConnection.__init__(self, logger)
+    def __init__(self, in_queue, out_queue, logger=None, rate=None,
+                 generator=None):
+        BaseDAQSimulationConnection.__init__(self, logger, rate, generator)
         self.in_queue = in_queue
         self.out_queue = out_queue
 
@@ -212,8 +463,10 @@ class DAQSimulationConnection(BaseDAQSimulationConnection):
                     except queue.Empty:
                         pass
 
+            lines = []
             while self.serial_port.in_waiting():
-                self.out_queue.put(self.serial_port.readline().strip())
+                lines.append(self.serial_port.readline().strip())
+            put_lines(self.out_queue, lines)
             time.sleep(0.02)
 
 
@@ -229,16 +482,36 @@ class DAQSimulationServer(BaseDAQSimulationConnection):
     :type port: int
     :param logger: logger object
     :type logger: logging.Logger
+    :param broadcast: publish the DAQ lines to any number of subscribers
+                      and receive commands on a separate port
+    :type broadcast: bool
+    :param command_port: TCP port for commands in broadcast mode,
+                         defaults to port + 1
+    :type command_port: int
+    :param rate: simulate this many lines per second, see
+                 HighRateDAQSimulation
+    :type rate: float
+    :param generator: generator of the simulated events
+    :type generator: muonic.daq.generator.EventGenerator
     :raises: DAQMissingDependencyError
     """
 
-    def __init__(self, address='127.0.0.1', port=5556, logger=None):
-        BaseDAQSimulationConnection.__init__(self, logger)
-        try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.bind("tcp://%s:%d" % (address, port))
-        except NameError:
-            raise DAQMissingDependencyError("no zmq installed...")
+    def __init__(self, address='127.0.0.1', port=5556, logger=None,
+                 broadcast=False, command_port=None, rate=None,
+                 generator=None):
+        BaseDAQSimulationConnection.__init__(self, logger, rate, generator)
+        self.publisher = None
+
+        if broadcast:
+            if command_port is None:
+                command_port = port + 1
+            self.publisher = DAQPublisher(address, port, command_port)
+        else:
+            try:
+                self.socket = zmq.Context().socket(zmq.PAIR)
+                self.socket.bind("tcp://%s:%d" % (address, port))
+            except NameError:
+                raise DAQMissingDependencyError("no zmq installed...")
 
     def serve(self):
         """
@@ -246,9 +519,28 @@ class DAQSimulationServer(BaseDAQSimulationConnection):
 
         :returns: None
         """
+        if self.publisher is not None:
+            self.broadcast()
+            return
+
         while True:
             self.read()
 
+    def broadcast(self):
+        """
+        Simulate DAQ I/O, publish everything read from the simulated DAQ
+        and pass received commands to it.
+
+        :returns: None
+        """
+        while self.running:
+            command = self.publisher.receive_command(20)
+            if command is not None:
+                self.serial_port.write(str(command) + "\r")
+
+            while self.serial_port.in_waiting():
+                self.publisher.publish(self.serial_port.readline().strip())
+
     def read(self):
         """
         Simulate DAQ I/O.
@@ -264,6 +556,24 @@ class DAQSimulationServer(BaseDAQSimulationConnection):
             time.sleep(0.02)
 
 if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Serve the simulated DAQ to muonic " +
+                                        "clients started with --port")
+    parser.add_argument("--port", dest="port", type=int, default=5556,
+                        help="TCP port to serve the DAQ on")
+    parser.add_argument("--broadcast", dest="broadcast",
+                        action="store_true", default=False,
+                        help="publish the DAQ lines to any number of " +
+                             "clients started with --subscribe")
+    parser.add_argument("--command-port", dest="command_port", type=int,
+                        default=None,
+                        help="TCP port for commands in broadcast mode, " +
+                             "defaults to port + 1")
+    args = parser.parse_args()
+
     logger = logging.getLogger()
-    server = DAQSimulationServer(port=5556, logger=logger)
+    server = DAQSimulationServer(port=args.port, logger=logger,
+                                 broadcast=args.broadcast,
+                                 command_port=args.command_port)
     server.serve()
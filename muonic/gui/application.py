@@ -20,9 +20,11 @@ from muonic.gui.dialogs import HelpDialog, AdvancedDialog
 from muonic.gui.widgets import VelocityWidget, PulseAnalyzerWidget
 from muonic.gui.widgets import DecayWidget, DAQWidget, RateWidget
 from muonic.gui.widgets import GPSWidget, StatusWidget
+from muonic.io.catalog import CatalogUpdater, get_run_settings
+from muonic.io.catalog import parse_muonic_filename
 from muonic.util import update_setting, get_setting
 from muonic.util import apply_default_settings, get_muonic_filename
-from muonic.util import get_data_directory
+from muonic.util import get_data_directory, WrappedFile
 
 
 class Application(QtGui.QMainWindow):
@@ -36,6 +38,12 @@ class Application(QtGui.QMainWindow):
     :param opts: command line options
     :type opts: Namespace
     """
+    # interval of the run catalog updates in milliseconds
+    CATALOG_UPDATE_INTERVAL = 5000
+
+    # bytes of earlier runs scanned between the catalog requests
+    CATALOG_SCAN_BYTES = 4 * 1024 * 1024
+
     def __init__(self, daq, logger, opts):
         QtGui.QMainWindow.__init__(self)
 
@@ -73,6 +81,8 @@ class Application(QtGui.QMainWindow):
         # generate filenames
         self.rate_filename = get_muonic_filename(self.start_time,
                                                  "R", opts.user)
+        self.rate_history_filename = path.join(
+                get_data_directory(), "R_HISTORY_%s.npz" % opts.user)
         self.raw_filename = get_muonic_filename(self.start_time,
                                                 "DAQ", opts.user)
         self.decay_filename = get_muonic_filename(self.start_time,
@@ -97,13 +107,20 @@ class Application(QtGui.QMainWindow):
         self.get_configuration_from_daq_card()
 
         # create pulse extractor for direct analysis
-        self.pulse_extractor = PulseExtractor(logger, self.pulse_filename)
+        self.pulse_extractor = PulseExtractor(logger, self.pulse_filename,
+                                              binary=opts.binary_pulses)
 
         if opts.write_pulses:
             # write pulses to file all the time
             self.daq.put('CE')
             self.pulse_extractor.write_pulses(True)
 
+        # catalog of the runs in the data directory, the files are
+        # scanned in a thread, earlier runs while it is idle
+        self.catalog = CatalogUpdater(max_bytes=self.CATALOG_SCAN_BYTES,
+                                      logger=logger)
+        self.catalog.start()
+
         # create tabbed widgets
         self.setup_tab_widgets()
 
@@ -136,6 +153,12 @@ class Application(QtGui.QMainWindow):
                                QtCore.SIGNAL("timeout()"),
                                self.update_dynamic)
 
+        # timer to register the open files in the run catalog
+        self.catalog_updater = QtCore.QTimer()
+        QtCore.QObject.connect(self.catalog_updater,
+                               QtCore.SIGNAL("timeout()"),
+                               self.update_catalog)
+
         self.logger.info("Time window is %4.2f" % opts.time_window)
 
         self.setup_plot_style()
@@ -145,6 +168,7 @@ class Application(QtGui.QMainWindow):
         # start update timers
         self.timer.start(1000)
         self.widget_updater.start(opts.time_window * 1000)
+        self.catalog_updater.start(self.CATALOG_UPDATE_INTERVAL)
 
     def get_configuration_from_daq_card(self):
         """
@@ -186,8 +210,9 @@ class Application(QtGui.QMainWindow):
         :returns: None
         """
         self.add_widget("rate", "Muon Rates",
-                        RateWidget(self.logger, self.rate_filename,
-                                   parent=self))
+                        RateWidget(
+                            self.logger, self.rate_filename, parent=self,
+                            history_filename=self.rate_history_filename))
         self.add_widget("pulse", "Pulse Analyzer",
                         PulseAnalyzerWidget(self.logger, self.pulse_extractor,
                                             parent=self))
@@ -529,7 +554,8 @@ class Application(QtGui.QMainWindow):
         # show dialog
         dialog = AdvancedDialog(get_setting("gate_width"),
                                 get_setting("time_window"),
-                                get_setting("write_daq_status"))
+                                get_setting("write_daq_status"),
+                                get_setting("rate_plot_points", 40))
 
         if dialog.exec_() == 1:
             # update time window
@@ -559,6 +585,13 @@ class Application(QtGui.QMainWindow):
             self.daq.put("WC 03 %s" % gate_width_03)
             self.daq.put("WC 02 %s" % gate_width_02)
 
+            # update the number of points in the rate plot
+            rate_plot_points = int(dialog.get_widget_value(
+                    "rate_plot_points"))
+            update_setting("rate_plot_points", rate_plot_points)
+            self.get_widget("rate").scalars_monitor.set_max_length(
+                    rate_plot_points)
+
             # adjust the update interval
             self.widget_updater.start(time_window * 1000)
 
@@ -567,6 +600,8 @@ class Application(QtGui.QMainWindow):
             self.logger.debug("Setting time window to %.2f " % time_window)
             self.logger.debug("Switching write_daq_status option to %s" %
                               write_daq_status)
+            self.logger.debug("Showing %d points in the rate plot" %
+                              rate_plot_points)
 
         self.daq.put("DC")
 
@@ -751,13 +786,17 @@ class Application(QtGui.QMainWindow):
 
         :returns: None
         """
-        while self.daq.data_available():
-            try:
-                msg = self.daq.get(0)
-            except DAQIOError:
-                self.logger.debug("Queue empty!")
-                return None
+        # all messages are fetched at once, trigger lines are collected
+        # and the pulses extracted in one go
+        pulse_lines = []
+
+        try:
+            messages = self.daq.get_many()
+        except DAQIOError:
+            self.logger.debug("Queue empty!")
+            messages = []
 
+        for msg in messages:
             # make daq msg public for child widgets
             self.last_daq_msg = msg
 
@@ -811,10 +850,14 @@ class Application(QtGui.QMainWindow):
                     self.is_widget_active("pulse") or
                     self.is_widget_active("decay") or
                     self.is_widget_active("velocity")):
-                self.pulses = self.pulse_extractor.extract(msg)
+                pulse_lines.append(msg)
 
-            # trigger calculation on all pulse widgets
-            self.calculate_pulses()
+        if pulse_lines:
+            for pulses in self.pulse_extractor.extract_batch(pulse_lines):
+                self.pulses = pulses
+
+                # trigger calculation on all pulse widgets
+                self.calculate_pulses()
 
     def calculate_pulses(self):
         """
@@ -837,6 +880,42 @@ class Application(QtGui.QMainWindow):
             if widget.active():
                 widget.update()
 
+    def update_catalog(self):
+        """
+        Register the open data files in the run catalog. The data written
+        since the last update is scanned by the catalog thread.
+
+        :returns: None
+        """
+        if self.catalog is None:
+            return
+
+        for filename in list(WrappedFile.get_open_files()):
+            if parse_muonic_filename(filename) is not None:
+                self.catalog.register(filename, get_run_settings())
+
+    def finish_catalog(self):
+        """
+        Register the data files renamed at the end of the measurement in
+        the run catalog and close it.
+
+        :returns: None
+        """
+        self.catalog_updater.stop()
+
+        if self.catalog is None:
+            return
+
+        for filename in [self.rate_filename, self.raw_filename,
+                         self.decay_filename, self.velocity_filename,
+                         self.pulse_filename]:
+            self.catalog.finish_run(filename, get_run_settings())
+
+        # the scan of earlier runs is interrupted, the renamed files
+        # are registered before the thread ends
+        self.catalog.stop()
+        self.catalog = None
+
     def closeEvent(self, ev):
         """
         Is triggered when it is attempted to close the application.
@@ -867,6 +946,9 @@ class Application(QtGui.QMainWindow):
             # rename pulse file
             self.pulse_extractor.finish()
 
+            # register the renamed files in the run catalog
+            self.finish_catalog()
+
             time.sleep(0.5)
 
             self.emit(QtCore.SIGNAL('lastWindowClosed()'))
@@ -6,6 +6,8 @@ from os import path
 
 from PyQt4 import QtCore, QtGui
 
+from muonic.gui.plot_canvases import FitScanCanvas
+
 
 class BaseDialog(QtGui.QDialog):
     """
@@ -247,6 +249,39 @@ class FitRangeConfigDialog(BaseDialog):
         self.show()
 
 
+class FitScanDialog(BaseDialog):
+    """
+    Dialog to show a scan of the fit range
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param scan: result of muonic.analysis.fit_scan.scan_fit_range
+    :type scan: dict
+    :param xlabel: label of the x-axis
+    :type xlabel: str
+    :param ylabel: label of the y-axis
+    :type ylabel: str
+    """
+
+    def __init__(self, logger, scan, xlabel, ylabel):
+        BaseDialog.__init__(self, "Fit Range Scan")
+
+        layout = QtGui.QVBoxLayout(self)
+
+        self.canvas = FitScanCanvas(self, logger, xlabel=xlabel,
+                                    ylabel=ylabel)
+        self.canvas.update_plot(scan)
+
+        box = QtGui.QDialogButtonBox(self)
+        box.setStandardButtons(QtGui.QDialogButtonBox.Close)
+        QtCore.QObject.connect(box, QtCore.SIGNAL('rejected()'), self.reject)
+
+        layout.addWidget(self.canvas)
+        layout.addWidget(box)
+
+        self.show()
+
+
 class VelocityConfigDialog(BaseDialog):
     """
     Dialog to configure the muon velocity
@@ -370,10 +405,12 @@ class AdvancedDialog(BaseDialog):
     :type time_window: float
     :param write_daq_status: write DAQ status to raw file
     :type write_daq_status: bool
+    :param rate_plot_points: number of rates shown in the rate plot
+    :type rate_plot_points: int
     """
     
     def __init__(self, gate_width=100, time_window=5.0,
-                 write_daq_status=False):
+                 write_daq_status=False, rate_plot_points=40):
         BaseDialog.__init__(self, "Advanced Configurations")
 
         layout = QtGui.QGridLayout(self)
@@ -416,7 +453,19 @@ class AdvancedDialog(BaseDialog):
         layout.addWidget(QtGui.QLabel("Write DAQ status lines to RAW file: "),
                          2, 0)
         layout.addWidget(write_status_checkbox, 2, 1)
-        layout.addWidget(self.button_box(left=30, top=300), 3, 0, 1, 2)
+
+        rate_plot_points_box = QtGui.QSpinBox()
+        rate_plot_points_box.setObjectName("rate_plot_points")
+        rate_plot_points_box.setMaximum(10000)
+        rate_plot_points_box.setMinimum(2)
+        rate_plot_points_box.setValue(rate_plot_points)
+        rate_plot_points_box.setToolTip("Number of readout intervals " +
+                                        "shown in the rate plot.")
+
+        layout.addWidget(QtGui.QLabel("Points in the rate plot " +
+                                      "(default: 40): "), 3, 0)
+        layout.addWidget(rate_plot_points_box, 3, 1)
+        layout.addWidget(self.button_box(left=30, top=300), 4, 0, 1, 2)
 
         self.show()
 
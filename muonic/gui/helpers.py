@@ -1,6 +1,11 @@
 """
 Provides helper classes and function needed by the gui
 """
+import multiprocessing as mp
+import signal
+import sys
+import time
+
 from matplotlib.pylab import rc
 
 from PyQt4 import QtGui
@@ -90,4 +95,172 @@ def set_large_plot_style():
     rc("ytick.major", size=7)
     rc("ytick.minor", size=5)
 
+
+def _run_fit(connection, function, args, kwargs):
+    """
+    Run a fit function and send the result or the error through the
+    connection. Runs in the worker process of the FitRunner.
+
+    :param connection: sending end of a pipe
+    :type connection: multiprocessing.Connection
+    :param function: fit function
+    :type function: callable
+    :param args: positional arguments of the fit function
+    :type args: tuple
+    :param kwargs: keyword arguments of the fit function
+    :type kwargs: dict
+    :returns: None
+    """
+    # exit on terminate, so process pools of the fit are cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    try:
+        result = (True, function(*args, **kwargs))
+    except Exception as e:
+        result = (False, "%s: %s" % (type(e).__name__, e))
+    connection.send(result)
+    connection.close()
+
+
+class FitRunner(QtGui.QWidget):
+    """
+    Runs fits in a worker process, so long fits do not block the gui and
+    the acquisition. Shows the state of the running fit and a button to
+    cancel it.
+
+    Emits 'fitFinished' with the result of the fit function, 'fitFailed'
+    with the error message, 'fitCanceled' and 'fitProgress' with the
+    elapsed time in seconds while the fit is running.
+
+    The fit function and its arguments and result have to be picklable.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param parent: parent widget
+    :param poll_interval: time between checks of the fit in milliseconds
+    :type poll_interval: int
+    """
+
+    def __init__(self, logger, parent=None, poll_interval=100):
+        QtGui.QWidget.__init__(self, parent)
+        self.logger = logger
+        self.process = None
+        self.connection = None
+        self.start_time = None
+
+        self.status_label = QtGui.QLabel("")
+        self.cancel_button = QtGui.QPushButton("Cancel Fit")
+        self.cancel_button.setEnabled(False)
+
+        layout = QtGui.QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.status_label)
+        layout.addStretch()
+        layout.addWidget(self.cancel_button)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(poll_interval)
+
+        QtCore.QObject.connect(self.cancel_button,
+                               QtCore.SIGNAL("clicked()"),
+                               self.cancel)
+        QtCore.QObject.connect(self.timer, QtCore.SIGNAL("timeout()"),
+                               self.poll)
+
+    def running(self):
+        """
+        Returns True if a fit is running.
+
+        :returns: bool
+        """
+        return self.process is not None
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Start the fit function with the given arguments in a worker
+        process. A running fit is canceled.
+
+        :param function: fit function
+        :type function: callable
+        :returns: None
+        """
+        if self.running():
+            self.cancel()
+
+        self.connection, child_connection = mp.Pipe(duplex=False)
+        # not daemonic, so the fit function can use a process pool
+        self.process = mp.Process(target=_run_fit,
+                                  args=(child_connection, function,
+                                        args, kwargs))
+        self.process.start()
+        child_connection.close()
+
+        self.start_time = time.time()
+        self.status_label.setText("Fitting...")
+        self.cancel_button.setEnabled(True)
+        self.timer.start()
+
+    def poll(self):
+        """
+        Check if the fit is done and emit its result.
+
+        :returns: None
+        """
+        if not self.running():
+            return
+
+        try:
+            done = self.connection.poll()
+            result = self.connection.recv() if done else None
+        except (EOFError, IOError, OSError):
+            # the worker died without sending a result
+            done = True
+            result = (False, "the fit process exited with code %s" %
+                      self.process.exitcode)
+
+        if not done:
+            elapsed = time.time() - self.start_time
+            self.status_label.setText("Fitting... %d s" % elapsed)
+            self.emit(QtCore.SIGNAL("fitProgress"), elapsed)
+            return
+
+        self._stop()
+        success, value = result
+        if success:
+            self.status_label.setText("Fit done after %.1f s" %
+                                      (time.time() - self.start_time))
+            self.emit(QtCore.SIGNAL("fitFinished"), value)
+        else:
+            self.logger.warning("Fit failed: %s" % value)
+            self.status_label.setText("Fit failed")
+            self.emit(QtCore.SIGNAL("fitFailed"), value)
+
+    def cancel(self):
+        """
+        Stop the running fit.
+
+        :returns: None
+        """
+        if not self.running():
+            return
+
+        self.process.terminate()
+        self._stop()
+        self.logger.info("Fit canceled")
+        self.status_label.setText("Fit canceled")
+        self.emit(QtCore.SIGNAL("fitCanceled"))
+
+    def _stop(self):
+        """
+        Clean up the worker process.
+
+        :returns: None
+        """
+        self.timer.stop()
+        self.process.join()
+        self.connection.close()
+        self.process = None
+        self.connection = None
+        self.cancel_button.setEnabled(False)
+
 # vim: ai ts=4 sts=4 et sw=4
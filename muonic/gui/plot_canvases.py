@@ -1,6 +1,10 @@
 """
 Provides the canvases for plots in muonic
 """
+import datetime
+
+from matplotlib.collections import LineCollection
+from matplotlib.dates import date2num
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt4agg \
     import FigureCanvasQTAgg as FigureCanvas
@@ -13,6 +17,10 @@ except ImportError:
 
 import numpy as np
 
+from muonic.analysis.fit import lifetime_pdf
+from muonic.analysis.histogram import Histogram
+from muonic.util import RingBuffer
+
 
 class BasePlotCanvas(FigureCanvas):
     """
@@ -86,6 +94,11 @@ class BaseHistogramCanvas(BasePlotCanvas):
     """
     A base class for all canvases with a histogram
 
+    The counts are accumulated in a muonic.analysis.Histogram. The bars
+    and error bars are created once and only their geometry is updated.
+    They are blitted onto a cached background of the axes, the whole
+    figure is only redrawn if the y-axis has to grow.
+
     :param parent: parent widget
     :param logger: logger object
     :type logger: logging.Logger
@@ -102,22 +115,92 @@ class BaseHistogramCanvas(BasePlotCanvas):
 
         # setup binning
         self.binning = np.asarray(binning)
-        self.bincontent = np.zeros(len(self.binning))
-        self.hist_patches = self.ax.hist(np.array([self.binning[0] - 1]),
-                                         self.binning, fc=hist_color,
-                                         alpha=0.25)[2]
-        self.heights = []
+        self.histogram = Histogram(self.binning)
         self.dimension = r"$\mu$s"
 
-        # FIXME the current implementation does not know about outliers
-        self.underflow = 0
-        # FIXME the current implementation does not know about outliers
-        self.overflow = 0
+        # the artists are drawn by _draw_histogram only
+        self.hist_patches = self.ax.bar(
+                self.binning[:-1], np.zeros(len(self.binning) - 1),
+                np.diff(self.binning), align="edge", fc=hist_color,
+                alpha=0.25, animated=True).patches
+        self.error_bars = LineCollection(self._get_error_segments(),
+                                         colors="b", animated=True)
+        self.ax.add_collection(self.error_bars)
 
         # fixed xrange for histogram
         self.xmin = self.binning[0]
         self.xmax = (self.binning[-1] +
                      (self.binning[:-1] - self.binning[1:])[-1])
+        self.ax.set_xlim(xmin=self.xmin, xmax=self.xmax)
+
+        # the axes without the histogram, taken after each full redraw
+        self._background = None
+        self.mpl_connect("draw_event", self._on_draw)
+        self.fig.canvas.draw()
+
+    @property
+    def heights(self):
+        """
+        The bin contents
+
+        :returns: numpy.ndarray
+        """
+        return self.histogram.counts
+
+    @property
+    def underflow(self):
+        """
+        Number of values below the binning
+
+        :returns: int
+        """
+        return self.histogram.underflow
+
+    @property
+    def overflow(self):
+        """
+        Number of values above the binning
+
+        :returns: int
+        """
+        return self.histogram.overflow
+
+    def _get_error_segments(self):
+        """
+        Get the lines of the error bars
+
+        :returns: numpy.ndarray
+        """
+        centers = self.histogram.bin_centers
+        counts = self.histogram.counts
+        errors = self.histogram.errors
+
+        segments = np.empty((len(counts), 2, 2))
+        segments[:, :, 0] = centers[:, np.newaxis]
+        segments[:, 0, 1] = counts - errors
+        segments[:, 1, 1] = counts + errors
+        return segments
+
+    def _on_draw(self, event):
+        """
+        Store the background after a full redraw and draw the histogram
+        on top of it.
+
+        :param event: the draw event
+        :returns: None
+        """
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        self._draw_histogram()
+
+    def _draw_histogram(self):
+        """
+        Draw the bars and error bars
+
+        :returns: None
+        """
+        for patch in self.hist_patches:
+            self.ax.draw_artist(patch)
+        self.ax.draw_artist(self.error_bars)
 
     def update_plot(self, data):
         """
@@ -127,62 +210,38 @@ class BaseHistogramCanvas(BasePlotCanvas):
         :type data: list of lists
         :return: None
         """
-        if not data:
+        if not len(data):
             return
 
-        # avoid memory leak
-        self.ax.clear()
-        if self.title is not None:
-            self.ax.set_title(self.title)
-
-        # we have to do some bad hacking here,
-        # because the p histogram is rather
-        # simple and it is not possible to add two of them...
-        # however, since we do not want to run into a memory leak
-        # and we also be not dependent on dashi (but maybe
-        # sometimes in the future?) we have to do it
-        # by manipulating rectangles...
-
-        # we want to find the non-empty bins
-        # tmp_hist is compatible with the decay_time hist...
-        tmp_hist = self.ax.hist(data, self.binning, fc="b", alpha=0.25)[0]
-
-        for hist_bin in enumerate(tmp_hist):
-            if hist_bin[1]:
-                self.hist_patches[hist_bin[0]].set_height(
-                        self.hist_patches[hist_bin[0]].get_height() +
-                        hist_bin[1])
-
-        # we want to get the maximum for the ylims
-        # self.heights contains the bincontent!
-
-        self.heights = []
-        for patch in self.hist_patches:
-            self.heights.append(patch.get_height())
+        changed = self.histogram.fill(data)
+        counts = self.histogram.counts
 
-        self.logger.debug("Histogram patch heights %s" % self.heights)
-        self.ax.set_ylim(ymax=max([h+np.sqrt(h) for h in self.heights]) * 1.1)
-        self.ax.set_ylim(ymin=0)
-        self.ax.set_xlabel(self.xlabel)
-        self.ax.set_ylabel(self.ylabel)
-        self.ax.set_xlim(xmin=self.xmin, xmax=self.xmax)
+        for index in changed.tolist():
+            self.hist_patches[index].set_height(counts[index])
+        self.error_bars.set_segments(self._get_error_segments())
 
-        # always get rid of unused stuff
-        del tmp_hist
+        self.logger.debug("Histogram bin contents %s" % counts)
 
-        # try to add errorbars
-        bincenters = (self.binning[1:]+self.binning[:-1])/2.
-        for i, height in enumerate(self.heights):
-            self.ax.errorbar(bincenters[i], height,
-                     yerr=np.sqrt(height), color='b')
+        redraw = self._background is None
+        ymax = (counts + self.histogram.errors).max()
+        if ymax > self.ax.get_ylim()[1]:
+            self.ax.set_ylim(ymin=0, ymax=ymax * 1.2)
+            redraw = True
 
-        # some beautification
-        self.ax.grid()
+        # a fit does not describe the new data anymore
+        if self.ax.lines:
+            for line in list(self.ax.lines):
+                line.remove()
+            if self.ax.legend_ is not None:
+                self.ax.legend_.remove()
+            redraw = True
 
-        # we now have to pass our new patches
-        # to the figure we created..
-        self.ax.patches = self.hist_patches
-        self.fig.canvas.draw()
+        if redraw:
+            self.fig.canvas.draw()
+        else:
+            self.restore_region(self._background)
+            self._draw_histogram()
+            self.blit(self.ax.bbox)
 
     def show_fit(self, bin_centers, bincontent, fitx, decay, p, covar,
                  chisquare, nbins):
@@ -348,6 +407,12 @@ class ScalarsCanvas(BasePlotCanvas):
     """
     A plot canvas to display scalars
 
+    The rates are kept in a ring buffer of max_length entries. The lines
+    are created once, updates only change their data and blit them onto
+    the cached background of the axes. The axes limits are changed in
+    steps, so the figure only has to be redrawn completely if the rates
+    leave the visible range.
+
     :param parent: parent widget
     :param logger: logger object
     :type logger: logging.Logger
@@ -364,12 +429,49 @@ class ScalarsCanvas(BasePlotCanvas):
                                 xlabel="Time (s)", ylabel="Rate (1/s)")
         self.show_trigger = True
         self.max_length = max_length
-        self.channel_data = [[], [], [], []]
-        self.trigger_data = []
-        self.time_data = []
+
+        # time, four channels and trigger per row
+        self.data = RingBuffer(max_length, 6)
         self.time_window = 0
+
+        # the lines are drawn by _draw_lines only
+        self.lines = []
+        for ch in range(4):
+            self.lines.append(self.ax.plot(
+                    [], [], c=self.CHANNEL_COLORS[ch], label=("ch%d" % ch),
+                    lw=2, marker='v', animated=True)[0])
+        self.lines.append(self.ax.plot([], [], c=self.TRIGGER_COLOR,
+                                       label='trg', lw=2, marker='x',
+                                       animated=True)[0])
+
+        self._visible = None
+        self._pending_text = None
+
+        # the axes without the lines, taken after each full redraw
+        self._background = None
+        self.mpl_connect("draw_event", self._on_draw)
         self.reset()
 
+    def _on_draw(self, event):
+        """
+        Store the background after a full redraw and draw the lines
+        on top of it.
+
+        :param event: the draw event
+        :returns: None
+        """
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        """
+        Draw the lines
+
+        :returns: None
+        """
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
     def reset(self, show_pending=False):
         """
         Reset all cached plot data
@@ -378,39 +480,102 @@ class ScalarsCanvas(BasePlotCanvas):
         :type show_pending: bool
         :returns: None
         """
-        self.ax.clear()
-        self.ax.grid()
-        self.ax.set_xlabel(self.xlabel)
-        self.ax.set_ylabel(self.ylabel)
         self.ax.set_xlim((self.xmin, self.xmax))
         self.ax.set_ylim((self.ymin, self.ymax))
 
-        self.channel_data = [[], [], [], []]
-        self.trigger_data = []
-        self.time_data = []
+        self.data.clear()
         self.time_window = 0
 
-        for ch in range(4):
-            self.ax.plot(self.time_data, self.channel_data[ch],
-                         c=self.CHANNEL_COLORS[ch],
-                         label=("ch%d" % ch), lw=3)
-        if self.show_trigger:
-            self.ax.plot(self.time_data, self.trigger_data, c='g',
-                         label='trigger', lw=3)
+        for line in self.lines:
+            line.set_data([], [])
+
+        if self._pending_text is not None:
+            self._pending_text.remove()
+            self._pending_text = None
 
         if show_pending:
             left, width = .25, .5
             bottom, height = .35, .8
             right = left + width
             top = bottom + height
-            self.ax.text(0.5 * (left + right), 0.5 * (bottom + top),
-                         'Measuring...', horizontalalignment='center',
-                         verticalalignment='center', fontsize=56, color='red',
-                         fontweight="heavy", alpha=.8, rotation=30,
-                         transform=self.fig.transFigure)
+            self._pending_text = self.ax.text(
+                    0.5 * (left + right), 0.5 * (bottom + top),
+                    'Measuring...', horizontalalignment='center',
+                    verticalalignment='center', fontsize=56, color='red',
+                    fontweight="heavy", alpha=.8, rotation=30,
+                    transform=self.fig.transFigure)
 
         self.fig.canvas.draw()
 
+    def set_max_length(self, max_length):
+        """
+        Change the maximum number of values to plot, keeping the newest
+        values.
+
+        :param max_length: maximum number of values to plot
+        :type max_length: int
+        :returns: None
+        """
+        values = np.array(self.data.get()[-max_length:])
+        self.max_length = max_length
+        self.data = RingBuffer(max_length, 6)
+        for row in values:
+            self.data.append(row)
+
+        for index, line in enumerate(self.lines):
+            line.set_data(values[:, 0], values[:, index + 1])
+        if len(values) > 1:
+            self.ax.set_xlim(values[0, 0], self.ax.get_xlim()[1])
+
+        self.fig.canvas.draw()
+
+    def _update_legend(self, visible):
+        """
+        Show the legend for the visible lines
+
+        :param visible: visibility of the lines
+        :type visible: list of bool
+        :returns: None
+        """
+        lines = [line for line, show in zip(self.lines, visible) if show]
+        labels = [line.get_label() for line in lines]
+
+        try:
+            self.ax.legend(lines, labels, bbox_to_anchor=(0., 1.02, 1., .102),
+                           loc=3, ncol=max(len(lines), 1), mode="expand",
+                           borderaxespad=0., handlelength=2)
+        except Exception as e:
+            self.logger.info("An error with the legend occurred: %s" % e)
+            self.ax.legend(lines, labels, loc=2)
+
+    def _update_limits(self, times, maximum):
+        """
+        Adjust the axes limits to the data. The x-axis is moved ahead by
+        a quarter of the time range, the y-axis is adjusted if the rates
+        exceed it or fall below half of it.
+
+        :param times: times of the data
+        :type times: numpy.ndarray
+        :param maximum: maximum rate
+        :type maximum: float
+        :returns: bool -- True if the limits changed
+        """
+        changed = False
+
+        # do not set x-range if time_data consists of only one item to
+        # avoid matlibplot UserWarning
+        if len(times) > 1 and times[-1] > self.ax.get_xlim()[1]:
+            xmax = times[-1] + 0.25 * (times[-1] - times[0])
+            self.ax.set_xlim(times[0], xmax)
+            changed = True
+
+        ymax = self.ax.get_ylim()[1]
+        if maximum > 0 and not 0.5 * ymax <= maximum <= ymax:
+            self.ax.set_ylim(0, maximum * 1.2)
+            changed = True
+
+        return changed
+
     def update_plot(self, data, show_trigger=True,
                     enabled_channels=DEFAULT_CHANNEL_CONFIG):
         """
@@ -424,63 +589,239 @@ class ScalarsCanvas(BasePlotCanvas):
         :type enabled_channels: list of bool
         :returne: None
         """
-        # do a complete redraw of the plot to avoid memory leak!
-        self.ax.clear()
         self.show_trigger = show_trigger
 
-        self.ax.grid()
-        self.ax.set_xlabel(self.xlabel)
-        self.ax.set_ylabel(self.ylabel)
-
         self.logger.debug("result : %s" % data)
 
-        # update lines data using the lists with new data
+        # update lines data using the ring buffer with new data
         self.time_window += data[5]
-        self.time_data.append(self.time_window)
+        self.data.append([self.time_window] + list(data[:5]))
 
-        for ch in range(4):
-            self.channel_data[ch].append(data[ch])
-            if enabled_channels[ch]:
-                self.ax.plot(self.time_data, self.channel_data[ch],
-                             c=self.CHANNEL_COLORS[ch],
-                             label=("ch%d" % ch), lw=2, marker='v')
+        values = self.data.get()
+        for index, line in enumerate(self.lines):
+            line.set_data(values[:, 0], values[:, index + 1])
 
-        self.trigger_data.append(data[4])
+        redraw = self._background is None
+
+        visible = list(enabled_channels) + [show_trigger]
+        if visible != self._visible:
+            for line, show in zip(self.lines, visible):
+                line.set_visible(show)
+            self._update_legend(visible)
+            self._visible = visible
+            redraw = True
+
+        if self._pending_text is not None:
+            self._pending_text.remove()
+            self._pending_text = None
+            redraw = True
+
+        if self._update_limits(values[:, 0], max(self.data.max()[1:])):
+            redraw = True
+
+        if redraw:
+            self.fig.canvas.draw()
+        else:
+            self.restore_region(self._background)
+            self._draw_lines()
+            self.blit(self.ax.bbox)
 
-        if self.show_trigger:
-            self.ax.plot(self.time_data, self.trigger_data,
-                         c=self.TRIGGER_COLOR,
-                         label='trg', lw=2, marker='x')
 
+class RateHistoryCanvas(BasePlotCanvas):
+    """
+    A plot canvas to display the rate history of a
+    muonic.analysis.RateArchive. The mean rates are drawn as lines, the
+    range between minimum and maximum as shaded band.
+
+    The history is queried for the shown time range at a resolution with
+    at most max_points points, so zooming in shows more details. As long
+    as the newest data is visible, the plot follows it.
+
+    :param parent: parent widget
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param archive: the rate archive
+    :type archive: muonic.analysis.RateArchive
+    :param max_points: maximum number of points per line
+    :type max_points: int
+    """
+
+    def __init__(self, parent, logger, archive, max_points=1000):
+        BasePlotCanvas.__init__(self, parent, logger, ymin=0, ymax=20,
+                                xlabel="Time (UTC)", ylabel="Rate (1/s)")
+        self.archive = archive
+        self.max_points = max_points
+
+        # matplotlib date number of the unix epoch
+        self._epoch = date2num(datetime.datetime(1970, 1, 1))
+
+        self.ax.xaxis_date()
+        self.lines = []
+        colors = ScalarsCanvas.CHANNEL_COLORS + [ScalarsCanvas.TRIGGER_COLOR]
+        for index, color in enumerate(colors):
+            self.lines.append(self.ax.plot(
+                    [], [], c=color, lw=2,
+                    label=("ch%d" % index if index < 4 else "trg"))[0])
+        self.bands = []
+        self.visible = [True] * len(self.lines)
+        self.max_rate = 0
+
+        self._follow = True
+        self._updating = False
+        self.ax.callbacks.connect("xlim_changed", self._on_xlim_changed)
+
+    def _to_date(self, times):
+        """
+        Convert seconds since epoch to matplotlib date numbers
+
+        :param times: seconds since epoch
+        :type times: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        return self._epoch + np.asarray(times) / 86400.
+
+    def _from_date(self, dates):
+        """
+        Convert matplotlib date numbers to seconds since epoch
+
+        :param dates: matplotlib date numbers
+        :type dates: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        return (np.asarray(dates) - self._epoch) * 86400.
+
+    def _on_xlim_changed(self, ax):
+        """
+        Query the history for the new time range after zooming or
+        panning.
+
+        :param ax: the axes
+        :returns: None
+        """
+        if self._updating:
+            return
+
+        time_range = self.archive.time_range()
+        stop = self._from_date(self.ax.get_xlim()[1])
+        self._follow = time_range is not None and stop >= time_range[1]
+        self._set_data()
+
+    def _set_data(self):
+        """
+        Query the history for the shown time range and update the lines
+        and bands.
+
+        :returns: None
+        """
+        start, stop = self._from_date(self.ax.get_xlim())
+        resolution, times, minimum, mean, maximum = self.archive.get(
+                start, stop, self.max_points)
+        dates = self._to_date(times + resolution / 2.)
+
+        for band in self.bands:
+            band.remove()
+        self.bands = []
+        self.max_rate = 0
+
+        for index, line in enumerate(self.lines):
+            line.set_data(dates, mean[:, index])
+            line.set_visible(self.visible[index])
+
+            if self.visible[index] and len(dates):
+                self.bands.append(self.ax.fill_between(
+                        dates, minimum[:, index], maximum[:, index],
+                        color=line.get_color(), alpha=0.2, lw=0))
+                self.max_rate = max(self.max_rate, maximum[:, index].max())
+
+    def update_plot(self, show_trigger=True,
+                    enabled_channels=ScalarsCanvas.DEFAULT_CHANNEL_CONFIG):
+        """
+        Update plot
+
+        :param show_trigger: show trigger in plot
+        :type show_trigger: bool
+        :param enabled_channels: enabled channels
+        :type enabled_channels: list of bool
+        :returns: None
+        """
+        time_range = self.archive.time_range()
+        if time_range is None:
+            return
+
+        self.visible = list(enabled_channels) + [show_trigger]
+
+        self._updating = True
         try:
-            # get count of active cannels
-            channels = enabled_channels + [show_trigger]
-            active_count = sum(channels)
+            if self._follow:
+                start, stop = self._to_date(time_range)
+                if stop <= start:
+                    stop = start + 1. / 86400
+                self.ax.set_xlim(start, stop)
+            self._set_data()
+        finally:
+            self._updating = False
+
+        if self.max_rate > 0:
+            self.ax.set_ylim(0, self.max_rate * 1.1)
+
+        self.fig.canvas.draw()
 
-            self.ax.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-                           ncol=active_count, mode="expand", borderaxespad=0.,
-                           handlelength=2)
-        except Exception as e:
-            self.logger.info("An error with the legend occurred: %s" % e)
-            self.ax.legend(loc=2)
 
-        if len(self.channel_data[0]) > self.max_length:
-            for ch in range(4):
-                self.channel_data[ch].remove(self.channel_data[ch][0])
-            self.trigger_data.remove(self.trigger_data[0])
-            self.time_data.remove(self.time_data[0])
+class FitScanCanvas(BasePlotCanvas):
+    """
+    Canvas to display a scan of the fit range as returned by
+    muonic.analysis.fit_scan.scan_fit_range: the fitted value versus the
+    lower limit of the fit range with the confidence band of the
+    bootstrap resamples.
 
-        ma = max(max(self.channel_data[0]), max(self.channel_data[1]),
-                 max(self.channel_data[2]), max(self.channel_data[3]),
-                 max(self.trigger_data))
+    :param parent: parent widget
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param xlabel: label of the x-axis
+    :type xlabel: str
+    :param ylabel: label of the y-axis
+    :type ylabel: str
+    """
 
-        self.ax.set_ylim(0, ma * 1.1)
+    def __init__(self, parent, logger, xlabel="Lower Limit of the Fit",
+                 ylabel="Fitted Value"):
+        BasePlotCanvas.__init__(self, parent, logger, xlabel=xlabel,
+                                ylabel=ylabel)
 
-        # do not set x-range if time_data consists of only one item to
-        # avoid matlibplot UserWarning
-        if len(self.time_data) > 1:
-            self.ax.set_xlim(self.time_data[0], self.time_data[-1])
+    def update_plot(self, scan):
+        """
+        Show a scan of the fit range
 
+        :param scan: result of the scan
+        :type scan: dict
+        :returns: None
+        """
+        self.ax.clear()
+        self.ax.set_xlabel(self.xlabel)
+        self.ax.set_ylabel(self.ylabel)
+        self.ax.grid(True)
+
+        lower_limits = scan["lower_limits"]
+        self.ax.fill_between(lower_limits, scan["lower_band"],
+                             scan["upper_band"], color="b", alpha=0.2,
+                             lw=0, label="Bootstrap band")
+        self.ax.plot(lower_limits, scan["median"], "b--",
+                     label="Bootstrap median")
+        self.ax.errorbar(lower_limits, scan["values"], yerr=scan["errors"],
+                         fmt="ko", label="Fit")
+
+        values = np.concatenate((scan["values"], scan["lower_band"],
+                                 scan["upper_band"]))
+        values = values[np.isfinite(values)]
+        if len(values):
+            margin = max(0.1 * (values.max() - values.min()), 1e-3)
+            self.ax.set_ylim(values.min() - margin, values.max() + margin)
+        if len(lower_limits) > 1:
+            step = lower_limits[1] - lower_limits[0]
+            self.ax.set_xlim(lower_limits[0] - step / 2.,
+                             lower_limits[-1] + step / 2.)
+
+        self.ax.legend(loc=2)
         self.fig.canvas.draw()
 
 
@@ -501,6 +842,44 @@ class LifetimeCanvas(BaseHistogramCanvas):
                 np.linspace(binning[0], binning[1], binning[2]),
                 xlabel="Time between Pulses ($\mu$s)", ylabel="Events")
 
+    def show_likelihood_fit(self, p, covar, decay_count, fitrange):
+        """
+        Plot the result of muonic.analysis.lifetime_likelihood_fit onto
+        the histogram
+
+        :param p: lifetime and background fraction
+        :type p: list
+        :param covar: covariance matrix
+        :type covar: numpy.ndarray
+        :param decay_count: number of decays within the fit range
+        :type decay_count: int
+        :param fitrange: lower and upper limit of the fit
+        :type fitrange: tuple
+        :returns: None
+        """
+        # clears a previous fit from the canvas
+        for line in list(self.ax.lines):
+            line.remove()
+
+        # the expected number of decays per bin
+        fitx = np.linspace(fitrange[0], fitrange[1], 100)
+        bin_width = self.binning[1] - self.binning[0]
+        fit_line = self.ax.plot(fitx, decay_count * bin_width *
+                                lifetime_pdf(p, fitx, fitrange), "b-")[0]
+
+        if covar is not None:
+            label = ("Fit: (%4.2f $\\pm$ %4.2f) %s \n %d decays" %
+                     (p[0], np.sqrt(np.absolute(covar[0][0])),
+                      self.dimension, decay_count))
+        else:
+            self.logger.warning("Covariance Matrix is 'None', could " +
+                                "not calculate fit error!")
+            label = "Fit: (%4.2f) %s \n %d decays" % (p[0], self.dimension,
+                                                      decay_count)
+        self.ax.legend((fit_line,), (label,), loc=1)
+
+        self.fig.canvas.draw()
+
 
 class VelocityCanvas(BaseHistogramCanvas):
     """
@@ -540,9 +919,3 @@ class PulseWidthCanvas(BaseHistogramCanvas):
         self.ax.set_title(self.ax_title)
         self.ax.figure.tight_layout()
         self.fig.canvas.draw()
-
-    def update_plot(self, data):
-        BaseHistogramCanvas.update_plot(self, data)
-        self.ax.set_title(self.ax_title)
-        self.ax.figure.tight_layout()
-        self.fig.canvas.draw()
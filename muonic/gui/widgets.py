@@ -19,16 +19,22 @@ from PyQt4 import QtGui
 from PyQt4 import QtCore
 
 from muonic.daq.provider import BaseDAQProvider
-from muonic.gui.helpers import HistoryAwareLineEdit
+from muonic.gui.helpers import HistoryAwareLineEdit, FitRunner
 from muonic.gui.plot_canvases import ScalarsCanvas, LifetimeCanvas
 from muonic.gui.plot_canvases import PulseCanvas, PulseWidthCanvas
-from muonic.gui.plot_canvases import VelocityCanvas
+from muonic.gui.plot_canvases import VelocityCanvas, RateHistoryCanvas
 from muonic.gui.dialogs import DecayConfigDialog
 from muonic.gui.dialogs import VelocityConfigDialog, FitRangeConfigDialog
-from muonic.analysis import fit, gaussian_fit
+from muonic.gui.dialogs import FitScanDialog
+from muonic.analysis import fit, gaussian_fit, lifetime_likelihood_fit
+from muonic.analysis import LifetimeEstimator
 from muonic.analysis import VelocityTrigger, DecayTriggerThorough
+from muonic.analysis import RateArchive, scan_fit_range, find_cached_scan
+from muonic.analysis import cache_scan
 from muonic.util import rename_muonic_file, get_hours_from_duration
 from muonic.util import get_setting, WrappedFile
+from muonic.io import IndexedRawFile
+from muonic.io.time_index import get_index_filename
 
 
 class BaseWidget(QtGui.QWidget):
@@ -134,6 +140,127 @@ class BaseWidget(QtGui.QWidget):
         pass
 
 
+class BaseFitWidget(BaseWidget):
+    """
+    Base class of the widgets which fit their histogram. The fits run in
+    the worker process of a FitRunner. Subclasses create the fit_button,
+    the fit_scan_button and the plot_canvas, set the kind and the axis
+    labels of the fit range scan and show the result of the other fits
+    in show_fit_result.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param parent: parent widget
+    """
+
+    # kind of the fit range scan, see scan_fit_range
+    FIT_SCAN_KIND = None
+
+    # axis labels of the plot of the fit range scan
+    FIT_SCAN_LABELS = ("", "")
+
+    def __init__(self, logger, parent=None):
+        BaseWidget.__init__(self, logger, parent)
+
+        # fits run in a worker process to keep the gui responsive
+        self.fit_runner = FitRunner(logger, self)
+        self.pending_fit = None
+
+        QtCore.QObject.connect(self.fit_runner,
+                               QtCore.SIGNAL("fitFinished"),
+                               self.on_fit_finished)
+        QtCore.QObject.connect(self.fit_runner, QtCore.SIGNAL("fitFailed"),
+                               self.on_fit_stopped)
+        QtCore.QObject.connect(self.fit_runner,
+                               QtCore.SIGNAL("fitCanceled"),
+                               self.on_fit_stopped)
+
+    def submit_fit(self, kind, function, *args, **kwargs):
+        """
+        Run a fit in the worker process. The fit buttons are disabled
+        until the fit is done.
+
+        :param kind: kind of the fit, selects how the result is shown
+        :type kind: str
+        :param function: fit function
+        :type function: callable
+        :returns: None
+        """
+        self.pending_fit = kind
+        self.fit_button.setEnabled(False)
+        self.fit_scan_button.setEnabled(False)
+        self.fit_runner.submit(function, *args, **kwargs)
+
+    def on_fit_stopped(self, *args):
+        """
+        Enable the fit buttons after a fit failed or was canceled
+
+        :returns: None
+        """
+        self.pending_fit = None
+        self.fit_button.setEnabled(True)
+        self.fit_scan_button.setEnabled(True)
+
+    def on_fit_finished(self, result):
+        """
+        Show the result of the fit
+
+        :param result: result of the fit function
+        :type result: tuple or dict
+        :returns: None
+        """
+        kind = self.pending_fit
+        self.on_fit_stopped()
+
+        if kind == "scan":
+            cache_scan(result)
+            self.show_fit_scan(result)
+        else:
+            self.show_fit_result(kind, result)
+
+    def show_fit_result(self, kind, result):
+        """
+        Show the result of a fit other than the fit range scan
+
+        :param kind: kind of the fit as given to submit_fit
+        :type kind: str
+        :param result: result of the fit function
+        :type result: tuple or dict
+        :returns: None
+        """
+        pass
+
+    def on_fit_scan_clicked(self):
+        """
+        Scan the lower limit of the fit range and show how stable the
+        fit result is
+
+        :returns: None
+        """
+        args = (self.FIT_SCAN_KIND, np.asarray(self.plot_canvas.heights),
+                self.binning, self.fit_range[1])
+        try:
+            scan = find_cached_scan(*args)
+        except ValueError as e:
+            self.logger.warning("Could not scan the fit range: %s" % e)
+            return
+
+        if scan is None:
+            self.submit_fit("scan", scan_fit_range, *args)
+        else:
+            self.show_fit_scan(scan)
+
+    def show_fit_scan(self, scan):
+        """
+        Show the scan of the fit range
+
+        :param scan: scan of the fit range
+        :type scan: dict
+        :returns: None
+        """
+        FitScanDialog(self.logger, scan, *self.FIT_SCAN_LABELS).exec_()
+
+
 class RateWidget(BaseWidget):
     """
     Widget for displaying a rate plot
@@ -143,10 +270,15 @@ class RateWidget(BaseWidget):
     :param filename: filename for the rate data file
     :type filename: str
     :param parent: parent widget
+    :param history_filename: filename for the rate history archive
+    :type history_filename: str
     """
     SCALAR_BUF_SIZE = 5
 
-    def __init__(self, logger, filename, parent=None):
+    # seconds between saves of the rate history
+    HISTORY_SAVE_INTERVAL = 60
+
+    def __init__(self, logger, filename, parent=None, history_filename=None):
         BaseWidget.__init__(self, logger, parent)
 
         # measurement start and duration
@@ -183,7 +315,19 @@ class RateWidget(BaseWidget):
         self.rates = None
 
         # initialize plot canvas
-        self.scalars_monitor = ScalarsCanvas(self, logger)
+        self.scalars_monitor = ScalarsCanvas(
+                self, logger, get_setting("rate_plot_points", 40))
+
+        # rate history of all runs
+        self.rate_archive = RateArchive(history_filename, logger=logger)
+        self.last_history_save = time.time()
+        self.history_monitor = RateHistoryCanvas(self, logger,
+                                                 self.rate_archive)
+        self.history_box = None
+        self.history_checkbox = QtGui.QCheckBox("Show rate history")
+        QtCore.QObject.connect(self.history_checkbox,
+                               QtCore.SIGNAL("clicked()"),
+                               self.on_history_checkbox_clicked)
 
         self.table = QtGui.QTableWidget(5, 2, self)
         self.table.setEnabled(False)
@@ -256,6 +400,15 @@ class RateWidget(BaseWidget):
         plot_layout = QtGui.QGridLayout(plot_box)
         plot_layout.addWidget(self.scalars_monitor, 0, 0, 1, 2)
 
+        # rate history layout, hidden until requested
+        self.history_box = QtGui.QGroupBox("")
+        history_layout = QtGui.QGridLayout(self.history_box)
+        history_layout.addWidget(self.history_monitor, 0, 0)
+        history_layout.addWidget(
+                NavigationToolbar(self.history_monitor, self), 1, 0)
+        self.history_box.setVisible(False)
+        plot_layout.addWidget(self.history_box, 1, 0, 1, 2)
+
         # value table layout
         value_box = QtGui.QGroupBox("")
         value_box.setMaximumWidth(500)
@@ -274,6 +427,7 @@ class RateWidget(BaseWidget):
         bottom_line_layout.addWidget(navigation_toolbar, 4, 0, 1, 3)
         bottom_line_layout.addWidget(self.start_button, 4, 3)
         bottom_line_layout.addWidget(self.stop_button, 4, 4)
+        bottom_line_layout.addWidget(self.history_checkbox, 4, 5)
 
         # put everything in place
         layout.addWidget(value_box, 0, 2)
@@ -367,9 +521,17 @@ class RateWidget(BaseWidget):
         if max_rate > self.max_rate:
             self.max_rate = max_rate
 
-        # write the rates to data file. we have to catch IOErrors, can occur
-        # if program is exited
         if self.active():
+            # add the rates to the history and store it every now and then,
+            # like the data file it only holds the rates of the measurement
+            self.rate_archive.add(self.query_time, self.rates[:5],
+                                  time_window)
+            if (time.time() - self.last_history_save >
+                    self.HISTORY_SAVE_INTERVAL):
+                self.save_rate_history()
+
+            # write the rates to data file. we have to catch IOErrors, can
+            # occur if program is exited
             try:
                 utcdt = datetime.datetime.utcfromtimestamp(self.query_time)
                 self.data_file.write(
@@ -414,6 +576,37 @@ class RateWidget(BaseWidget):
         self.scalars_monitor.update_plot(self.rates, self.show_trigger,
                                          channel_config)
 
+        if self.history_checkbox.isChecked():
+            self.history_monitor.update_plot(self.show_trigger,
+                                             channel_config)
+
+    def on_history_checkbox_clicked(self):
+        """
+        Shows or hides the rate history depending on checkbox state
+
+        :returns: None
+        """
+        show = self.history_checkbox.isChecked()
+        self.history_box.setVisible(show)
+
+        if show:
+            channel_config = [get_setting("active_ch%d" % i)
+                              for i in range(4)]
+            self.history_monitor.update_plot(self.show_trigger,
+                                             channel_config)
+
+    def save_rate_history(self):
+        """
+        Store the rate history in its file.
+
+        :returns: None
+        """
+        self.last_history_save = time.time()
+        try:
+            self.rate_archive.save()
+        except (OSError, IOError) as e:
+            self.logger.warning("Could not save the rate history: %s" % e)
+
     def update_fields(self, channel, enabled, disable_only=False):
         """
         Update table fields for a channel, channel 4 is the trigger channel.
@@ -554,6 +747,8 @@ class RateWidget(BaseWidget):
                              stop_time.strftime("%a %d %b %Y %H:%M:%S UTC"))
         self.data_file.close()
 
+        self.save_rate_history()
+
     def finish(self):
         """
         Cleanup, close and rename data file
@@ -569,6 +764,8 @@ class RateWidget(BaseWidget):
                                  stop_time.strftime("%a %d %b %Y %H:%M:%S UTC"))
             self.data_file.close()
 
+        self.save_rate_history()
+
         # only rename if file actually exists
         if os.path.exists(self.data_file.get_filename()):
             try:
@@ -910,7 +1107,18 @@ class StatusWidget(BaseWidget):
 
         # since we use WrappedFile for opening file, we can
         # easily track the open files
-        open_files = WrappedFile.get_open_files()
+        open_files = sorted(WrappedFile.get_open_files())
+        write_statistics = WrappedFile.get_write_statistics()
+
+        for index, filename in enumerate(open_files):
+            if filename in write_statistics:
+                statistics = write_statistics[filename]
+                open_files[index] += (
+                        " (%d writes queued, %.1f kB pending, " +
+                        "slowest write %.1f ms)") % (
+                        statistics["queue_depth"],
+                        statistics["pending_bytes"] / 1024.,
+                        statistics["max_write_latency"] * 1000.)
 
         self.muonic_stats['open_files'] = "\n".join(open_files)
 
@@ -956,7 +1164,7 @@ class StatusWidget(BaseWidget):
         self.active(False)
 
 
-class VelocityWidget(BaseWidget):
+class VelocityWidget(BaseFitWidget):
     """
     Shows the muon velocity plot
 
@@ -966,8 +1174,11 @@ class VelocityWidget(BaseWidget):
     :type pulse_extractor: muonic.analysis.analyzer.PulseExtractor
     :param parent: parent widget
     """
+    FIT_SCAN_KIND = "velocity"
+    FIT_SCAN_LABELS = ("Lower Limit of the Fit (ns)", "Mean Flight Time (ns)")
+
     def __init__(self, logger, filename, pulse_extractor, parent=None):
-        BaseWidget.__init__(self, logger, parent)
+        BaseFitWidget.__init__(self, logger, parent)
 
         self.pulse_extractor = pulse_extractor
 
@@ -1012,6 +1223,9 @@ class VelocityWidget(BaseWidget):
         self.fit_range_button = QtGui.QPushButton('Fit Range')
         self.fit_range_button.setEnabled(False)
 
+        self.fit_scan_button = QtGui.QPushButton("Scan Fit Range")
+        self.fit_scan_button.setEnabled(False)
+
         QtCore.QObject.connect(self.checkbox,
                                QtCore.SIGNAL("clicked()"),
                                self.on_checkbox_clicked)
@@ -1020,6 +1234,9 @@ class VelocityWidget(BaseWidget):
         QtCore.QObject.connect(self.fit_range_button,
                                QtCore.SIGNAL("clicked()"),
                                self.on_fit_range_clicked)
+        QtCore.QObject.connect(self.fit_scan_button,
+                               QtCore.SIGNAL("clicked()"),
+                               self.on_fit_scan_clicked)
 
         self.running_status = None
         self.muon_counter_label = QtGui.QLabel(self)
@@ -1030,14 +1247,16 @@ class VelocityWidget(BaseWidget):
 
         # add widgets to layout
         layout = QtGui.QGridLayout(self)
-        layout.addWidget(self.checkbox, 0, 0, 1, 3)
+        layout.addWidget(self.checkbox, 0, 0, 1, 4)
         layout.addWidget(self.muon_counter_label, 1, 0)
         layout.addWidget(self.last_event_label, 2, 0)
         layout.addWidget(self.active_since_label, 3, 0)
-        layout.addWidget(self.plot_canvas, 4, 0, 1, 3)
+        layout.addWidget(self.plot_canvas, 4, 0, 1, 4)
         layout.addWidget(navigation_toolbar, 5, 0)
-        layout.addWidget(self.fit_range_button, 5, 1)
-        layout.addWidget(self.fit_button, 5, 2)
+        layout.addWidget(self.fit_scan_button, 5, 1)
+        layout.addWidget(self.fit_range_button, 5, 2)
+        layout.addWidget(self.fit_button, 5, 3)
+        layout.addWidget(self.fit_runner, 6, 0, 1, 4)
 
     def on_fit_clicked(self):
         """
@@ -1046,12 +1265,22 @@ class VelocityWidget(BaseWidget):
         :returns: None
         """
         self.logger.debug("Using fit range of %s" % repr(self.fit_range))
-        fit_results = gaussian_fit(
-                bincontent=np.asarray(self.plot_canvas.heights),
-                binning=self.binning, fitrange=self.fit_range)
+        self.submit_fit("binned", gaussian_fit,
+                        bincontent=np.asarray(self.plot_canvas.heights),
+                        binning=self.binning, fitrange=self.fit_range)
+
+    def show_fit_result(self, kind, result):
+        """
+        Show the result of the fit
 
-        if fit_results is not None:
-            self.plot_canvas.show_fit(*fit_results)
+        :param kind: kind of the fit as given to submit_fit
+        :type kind: str
+        :param result: result of the fit function
+        :type result: tuple
+        :returns: None
+        """
+        if result is not None:
+            self.plot_canvas.show_fit(*result)
 
     def on_fit_range_clicked(self):
         """
@@ -1110,7 +1339,8 @@ class VelocityWidget(BaseWidget):
             return
 
         self.fit_range_button.setEnabled(True)
-        self.fit_button.setEnabled(True)
+        self.fit_scan_button.setEnabled(not self.fit_runner.running())
+        self.fit_button.setEnabled(not self.fit_runner.running())
         self.plot_canvas.update_plot(self.event_data)
 
         self.muon_counter_label.setText("We have detected %d muons " %
@@ -1220,6 +1450,8 @@ class VelocityWidget(BaseWidget):
 
         :returns: None
         """
+        self.fit_runner.cancel()
+
         if not self.mu_file.closed:
             stop_time = datetime.datetime.utcnow()
 
@@ -1243,7 +1475,7 @@ class VelocityWidget(BaseWidget):
                 pass
 
 
-class DecayWidget(BaseWidget):
+class DecayWidget(BaseFitWidget):
     """
     Shows the muon decay plot
 
@@ -1255,8 +1487,12 @@ class DecayWidget(BaseWidget):
     :type pulse_extractor: muonic.analysis.analyzer.PulseExtractor
     :param parent: parent widget
     """
+    FIT_SCAN_KIND = "lifetime"
+    FIT_SCAN_LABELS = ("Lower Limit of the Fit ($\\mu$s)",
+                       "Lifetime ($\\mu$s)")
+
     def __init__(self, logger, filename, pulse_extractor, parent=None):
-        BaseWidget.__init__(self, logger, parent)
+        BaseFitWidget.__init__(self, logger, parent)
 
         self.pulse_extractor = pulse_extractor
 
@@ -1279,6 +1515,10 @@ class DecayWidget(BaseWidget):
         self.fit_range = (1.5, 10.)
 
         self.event_data = []
+        # all decay times for the unbinned fit
+        self.decay_times = []
+        # continuously updated lifetime
+        self.lifetime_estimator = LifetimeEstimator(self.fit_range)
         self.last_event_time = None
         self.active_since = None
 
@@ -1312,6 +1552,9 @@ class DecayWidget(BaseWidget):
         self.fit_range_button = QtGui.QPushButton("Fit Range")
         self.fit_range_button.setEnabled(False)
 
+        self.fit_scan_button = QtGui.QPushButton("Scan Fit Range")
+        self.fit_scan_button.setEnabled(False)
+
         QtCore.QObject.connect(self.checkbox,
                                QtCore.SIGNAL("clicked()"),
                                self.on_checkbox_clicked)
@@ -1320,24 +1563,34 @@ class DecayWidget(BaseWidget):
         QtCore.QObject.connect(self.fit_range_button,
                                QtCore.SIGNAL("clicked()"),
                                self.on_fit_range_clicked)
+        QtCore.QObject.connect(self.fit_scan_button,
+                               QtCore.SIGNAL("clicked()"),
+                               self.on_fit_scan_clicked)
+
+        # the fit range of the running fit
+        self.submitted_fit_range = self.fit_range
 
         self.running_status = None
         self.muon_counter_label = QtGui.QLabel(self)
         self.last_event_label = QtGui.QLabel(self)
         self.active_since_label = QtGui.QLabel(self)
+        self.lifetime_label = QtGui.QLabel(self)
 
         navigation_toolbar = NavigationToolbar(self.plot_canvas, self)
 
         # add widgets to layout
         layout = QtGui.QGridLayout(self)
-        layout.addWidget(self.checkbox, 0, 0, 1, 3)
+        layout.addWidget(self.checkbox, 0, 0, 1, 4)
         layout.addWidget(self.muon_counter_label, 1, 0)
+        layout.addWidget(self.lifetime_label, 1, 1, 1, 2)
         layout.addWidget(self.last_event_label, 2, 0)
         layout.addWidget(self.active_since_label, 3, 0)
-        layout.addWidget(self.plot_canvas, 4, 0, 1, 3)
+        layout.addWidget(self.plot_canvas, 4, 0, 1, 4)
         layout.addWidget(navigation_toolbar, 5, 0)
-        layout.addWidget(self.fit_range_button, 5, 1)
-        layout.addWidget(self.fit_button, 5, 2)
+        layout.addWidget(self.fit_scan_button, 5, 1)
+        layout.addWidget(self.fit_range_button, 5, 2)
+        layout.addWidget(self.fit_button, 5, 3)
+        layout.addWidget(self.fit_runner, 6, 0, 1, 4)
 
     def set_previous_coincidence_times(self, time_03, time_02):
         """
@@ -1354,15 +1607,57 @@ class DecayWidget(BaseWidget):
 
     def on_fit_clicked(self):
         """
-        Fit the muon decay histogram
+        Fit the muon lifetime to the decay times. Falls back to a fit to
+        the histogram if the unbinned fit fails.
+
+        :returns: None
+        """
+        # the fit range may change while fitting
+        self.submitted_fit_range = self.fit_range
+        self.submit_fit("likelihood", lifetime_likelihood_fit,
+                        np.asarray(self.decay_times),
+                        fitrange=self.fit_range)
 
+    def show_fit_result(self, kind, result):
+        """
+        Show the result of the fit
+
+        :param kind: kind of the fit as given to submit_fit
+        :type kind: str
+        :param result: result of the fit function
+        :type result: tuple
         :returns: None
         """
-        fit_results = fit(bincontent=np.asarray(self.plot_canvas.heights),
-                          binning=self.binning, fitrange=self.fit_range)
+        if kind == "likelihood" and result is None:
+            self.submit_fit("binned", fit,
+                            bincontent=np.asarray(self.plot_canvas.heights),
+                            binning=self.binning,
+                            fitrange=self.submitted_fit_range)
+        elif kind == "likelihood":
+            self.plot_canvas.show_likelihood_fit(
+                    *result, fitrange=self.submitted_fit_range)
+        elif result is not None:
+            self.plot_canvas.show_fit(*result)
+
+    def update_lifetime(self):
+        """
+        Update the estimate of the lifetime and show it
 
-        if fit_results is not None:
-            self.plot_canvas.show_fit(*fit_results)
+        :returns: None
+        """
+        if self.lifetime_estimator.update() is None:
+            self.lifetime_label.setText("")
+            return
+
+        if self.lifetime_estimator.lifetime_error is None:
+            self.lifetime_label.setText(
+                    "Lifetime: %.2f microseconds" %
+                    self.lifetime_estimator.lifetime)
+        else:
+            self.lifetime_label.setText(
+                    "Lifetime: (%.2f +- %.2f) microseconds" %
+                    (self.lifetime_estimator.lifetime,
+                     self.lifetime_estimator.lifetime_error))
 
     def on_fit_range_clicked(self):
         """
@@ -1380,6 +1675,11 @@ class DecayWidget(BaseWidget):
             lower_limit = dialog.get_widget_value("lower_limit")
             self.fit_range = (lower_limit, upper_limit)
 
+            # the estimate has to start over with the new fit range
+            self.lifetime_estimator = LifetimeEstimator(self.fit_range)
+            self.lifetime_estimator.extend(self.decay_times)
+            self.update_lifetime()
+
     def on_checkbox_clicked(self):
         """
         Starts or stops the muon decay check depending on checkbox state
@@ -1413,6 +1713,8 @@ class DecayWidget(BaseWidget):
             when = datetime.datetime.utcnow()
             self.event_data.append((decay / 1000, 
                                     when.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]))
+            self.decay_times.append(decay / 1000.)
+            self.lifetime_estimator.add(decay / 1000.)
             self.muon_counter += 1
             self.last_event_time = when
             self.logger.info("We have found a decaying muon with a " +
@@ -1429,12 +1731,14 @@ class DecayWidget(BaseWidget):
 
         decay_times = [decay_time[0] for decay_time in self.event_data]
 
-        self.fit_button.setEnabled(True)
+        self.fit_button.setEnabled(not self.fit_runner.running())
         self.fit_range_button.setEnabled(True)
+        self.fit_scan_button.setEnabled(not self.fit_runner.running())
         self.plot_canvas.update_plot(decay_times)
 
         self.muon_counter_label.setText("We have %d decayed muons " %
                                         self.muon_counter)
+        self.update_lifetime()
         self.last_event_label.setText(
                 "Last detected decay at time %s " %
                 self.last_event_time.strftime("%a %d %b %Y %H:%M:%S UTC"))
@@ -1583,6 +1887,8 @@ class DecayWidget(BaseWidget):
 
         :returns: None
         """
+        self.fit_runner.cancel()
+
         if not self.mu_file.closed:
             stop_time = datetime.datetime.utcnow()
 
@@ -1620,8 +1926,8 @@ class DAQWidget(BaseWidget):
     def __init__(self, logger, filename, parent=None):
         BaseWidget.__init__(self, logger, parent)
 
-        # raw output file
-        self.output_file = WrappedFile(filename)
+        # raw output file, indexed by time while it is written
+        self.output_file = IndexedRawFile(filename, logger=logger)
         self.write_raw_file = False
         self.write_status = None
 
@@ -1759,6 +2065,9 @@ class DAQWidget(BaseWidget):
                                          self.measurement_duration))
                 rename_muonic_file(self.measurement_duration,
                                    self.output_file.get_filename())
+                rename_muonic_file(self.measurement_duration,
+                                   get_index_filename(
+                                       self.output_file.get_filename()))
             except (OSError, IOError):
                 pass
 
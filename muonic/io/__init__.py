@@ -0,0 +1,12 @@
+"""
+Reading of the files written by muonic
+"""
+from .raw_reader import get_compression, open_raw_file, read_line_blocks
+from .raw_reader import read_lines
+from .time_index import IndexedRawFile, build_time_index, load_time_index
+from .time_index import read_raw_range, read_pulse_range
+from .catalog import RunCatalog, CatalogUpdater, get_catalog_filename
+from .catalog import parse_muonic_filename
+from .decode_cache import DecodeCache, decode_raw_file, get_decode_cache
+
+__all__ = ["raw_reader", "time_index", "catalog", "decode_cache"]
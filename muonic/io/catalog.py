@@ -0,0 +1,839 @@
+"""
+Catalog of the runs in the data directory.
+
+Every file named by get_muonic_filename is registered in a SQLite
+database in the data directory with the metadata from its name (start
+time, measurement, duration and user), the DAQ configuration at the time
+the run was registered, the number of events and the times of the first
+and the last event. Files are scanned incrementally, only the data
+appended since the last update is read, so the catalog can be kept up to
+date while the files grow.
+
+The events counted are the trigger events of RAW ('DAQ') and pulse
+('P') files, the decays ('D'), the flight times ('V') and the rate
+samples ('R'). Times are given in seconds since epoch (UTC).
+"""
+from __future__ import print_function
+import calendar
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from muonic.analysis.analyzer import BIT7, decode_daq_lines
+from muonic.analysis.pulse_store import count_day_wraps, is_pulse_file
+from muonic.analysis.pulse_store import read_pulse_file
+from muonic.io.raw_reader import get_compression, read_line_blocks
+from muonic.util import get_data_directory, get_setting
+
+__all__ = ["RunCatalog", "CatalogUpdater", "get_catalog_filename",
+           "parse_muonic_filename", "get_run_settings"]
+
+CATALOG_FILENAME = "muonic_catalog.sqlite"
+
+# the catalog is rebuilt from the files if the schema changes
+SCHEMA_VERSION = 1
+
+# size of the blocks read while scanning text files in bytes
+SCAN_BLOCK_SIZE = 4 * 1024 * 1024
+
+# number of pulse file events scanned at once
+SCAN_EVENTS = 1000000
+
+# filenames written by get_muonic_filename, optionally compressed
+FILENAME_PATTERN = re.compile(
+        r"^(?P<start>\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)_(?P<measurement>[A-Z]+)_"
+        r"(?P<hours>HOURS|\d+(\.\d+)?)_(?P<user>[^.]+?)"
+        r"(?P<extension>\.gz|\.bz2|\.xz)?$")
+
+# DAQ configuration stored with each run
+CONFIG_COLUMNS = [
+    ("veto", "INTEGER"),
+    ("veto_ch0", "INTEGER"),
+    ("veto_ch1", "INTEGER"),
+    ("veto_ch2", "INTEGER"),
+    ("active_ch0", "INTEGER"),
+    ("active_ch1", "INTEGER"),
+    ("active_ch2", "INTEGER"),
+    ("active_ch3", "INTEGER"),
+    ("coincidence0", "INTEGER"),
+    ("coincidence1", "INTEGER"),
+    ("coincidence2", "INTEGER"),
+    ("coincidence3", "INTEGER"),
+    ("threshold_ch0", "INTEGER"),
+    ("threshold_ch1", "INTEGER"),
+    ("threshold_ch2", "INTEGER"),
+    ("threshold_ch3", "INTEGER"),
+    ("gate_width", "REAL"),
+    ("time_window", "REAL")
+]
+
+CONFIG_KEYS = [key for key, _ in CONFIG_COLUMNS]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    measurement TEXT NOT NULL,
+    user TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    hours REAL,
+    compression TEXT,
+    finished INTEGER NOT NULL DEFAULT 0,
+    registered REAL NOT NULL,
+    updated REAL,
+    file_size INTEGER NOT NULL DEFAULT -1,
+    file_mtime REAL NOT NULL DEFAULT -1,
+    scanned_size INTEGER NOT NULL DEFAULT 0,
+    scan_state TEXT,
+    events INTEGER NOT NULL DEFAULT 0,
+    first_time REAL,
+    last_time REAL,
+    %s
+);
+CREATE INDEX IF NOT EXISTS runs_measurement ON runs (measurement, start_time);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+""" % ",\n    ".join("%s %s" % column for column in CONFIG_COLUMNS)
+
+
+def get_catalog_filename():
+    """
+    Get the filename of the catalog in the data directory
+
+    :returns: str
+    """
+    return os.path.join(get_data_directory(), CATALOG_FILENAME)
+
+
+def _to_timestamp(date):
+    """
+    Get the seconds since epoch of a UTC datetime
+
+    :param date: the date
+    :type date: datetime.datetime
+    :returns: float
+    """
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def parse_muonic_filename(filename):
+    """
+    Get the metadata from the name of a file written by muonic: the start
+    time in seconds since epoch ('start_time'), the measurement id
+    ('measurement'), the duration in hours or None if the run is not
+    finished ('hours'), the user initials ('user') and the compression
+    ('compression'). Returns None for other files.
+
+    :param filename: the filename
+    :type filename: str
+    :returns: dict or None
+    """
+    match = FILENAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+
+    try:
+        start = datetime.datetime.strptime(match.group("start"),
+                                           "%Y-%m-%d_%H-%M-%S")
+    except ValueError:
+        return None
+
+    hours = match.group("hours")
+    extension = match.group("extension")
+
+    return {"start_time": _to_timestamp(start),
+            "measurement": match.group("measurement"),
+            "hours": None if hours == "HOURS" else float(hours),
+            "user": match.group("user"),
+            "compression": {None: None, ".gz": "gzip", ".bz2": "bz2",
+                            ".xz": "xz"}[extension]}
+
+
+def get_run_settings():
+    """
+    Get the current DAQ configuration from the settings store as stored
+    with the runs.
+
+    :returns: dict
+    """
+    return dict((key, get_setting(key)) for key in CONFIG_KEYS)
+
+
+def _parse_timestamp(line):
+    """
+    Get the seconds since epoch of the timestamp at the start of a line
+    of a rate, decay or velocity file, None if there is none.
+
+    :param line: the line
+    :type line: bytes
+    :returns: float or None
+    """
+    try:
+        return _to_timestamp(datetime.datetime.strptime(
+                line.lstrip(b"'")[:23].decode("ascii"),
+                "%Y-%m-%d %H:%M:%S.%f"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class _ScanState(object):
+    """
+    Event count and time bounds of a partially scanned file. Times of
+    day, as found in RAW and pulse files, are counted from the day the
+    run started on.
+
+    :param run: the catalog row of the run
+    :type run: sqlite3.Row
+    """
+
+    def __init__(self, run):
+        self.events = run["events"]
+        self.first_time = run["first_time"]
+        self.last_time = run["last_time"]
+
+        state = json.loads(run["scan_state"]) if run["scan_state"] else {}
+        day_start = run["start_time"] - run["start_time"] % 86400
+        self.day_start = state.get("day_start", day_start)
+        self.day = state.get("day", 0)
+        self.last_day_time = state.get("last_day_time",
+                                       run["start_time"] - day_start)
+
+    def to_json(self):
+        """
+        Get the state needed to resume the scan
+
+        :returns: str
+        """
+        return json.dumps({"day_start": self.day_start,
+                           "day": self.day,
+                           "last_day_time": self.last_day_time})
+
+    def add_times(self, times):
+        """
+        Add the ordered times of the scanned events
+
+        :param times: seconds since epoch
+        :type times: list of float
+        :returns: None
+        """
+        if not len(times):
+            return
+        if self.first_time is None:
+            self.first_time = float(times[0])
+        self.last_time = float(times[-1])
+
+    def add_times_of_day(self, times):
+        """
+        Add the times of day of the scanned events
+
+        :param times: seconds since day start
+        :type times: numpy.ndarray
+        :returns: None
+        """
+        if not len(times):
+            return
+        days = self.day + count_day_wraps(times, self.last_day_time)
+        self.add_times(self.day_start + days * 86400. + times)
+        self.day = int(days[-1])
+        self.last_day_time = float(times[-1])
+
+
+def _scan_lines(block, measurement, state):
+    """
+    Count the events in a block of lines and update the time bounds
+
+    :param block: complete lines
+    :type block: bytes
+    :param measurement: the measurement id
+    :type measurement: str
+    :param state: scan state
+    :type state: _ScanState
+    :returns: None
+    """
+    if measurement == "DAQ":
+        data = decode_daq_lines(block)
+        triggers = data[(data["re0"] & BIT7) != 0]
+        state.events += len(triggers)
+        state.add_times_of_day(triggers["gps_time"])
+        return
+
+    lines = [line for line in block.split(b"\n")
+             if line.strip() and not line.startswith(b"#")]
+
+    if measurement == "P":
+        # tuples of the trigger time and the pulses
+        times = []
+        for line in lines:
+            try:
+                times.append(float(line[1:line.find(b",")]))
+            except ValueError:
+                pass
+        state.events += len(times)
+        state.add_times_of_day(np.array(times))
+        return
+
+    times = [timestamp for timestamp in
+             (_parse_timestamp(line) for line in lines)
+             if timestamp is not None]
+    state.events += len(times)
+    state.add_times(times)
+
+
+class RunCatalog(object):
+    """
+    SQLite catalog of the runs in the data directory. The catalog is
+    created if it does not exist.
+
+    :param filename: the catalog file, defaults to CATALOG_FILENAME in
+                     the data directory
+    :type filename: str
+    :param logger: logger object
+    :type logger: logging.Logger
+    :raises: sqlite3.Error
+    """
+
+    def __init__(self, filename=None, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        if filename is None:
+            filename = get_catalog_filename()
+        self.logger = logger
+        self.filename = filename
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self._setup_schema()
+
+    def _setup_schema(self):
+        """
+        Create the tables. A catalog with another schema version is
+        dropped, it is rebuilt from the files.
+
+        :returns: None
+        """
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.logger.info("Creating run catalog %s" % self.filename)
+            self.connection.execute("DROP TABLE IF EXISTS runs")
+        self.connection.executescript(_SCHEMA)
+        self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.connection.commit()
+
+    def close(self):
+        """
+        Close the catalog
+
+        :returns: None
+        """
+        self.connection.close()
+
+    def get_run(self, filename):
+        """
+        Get the catalog entry of a file, None if it is not registered.
+
+        :param filename: the filename
+        :type filename: str
+        :returns: dict or None
+        """
+        run = self._get_row(filename)
+        return None if run is None else dict(run)
+
+    def _get_row(self, filename):
+        """
+        Get the catalog row of a file
+
+        :param filename: the filename
+        :type filename: str
+        :returns: sqlite3.Row or None
+        """
+        return self.connection.execute(
+                "SELECT * FROM runs WHERE path = ?",
+                (os.path.abspath(filename),)).fetchone()
+
+    def register(self, filename, settings=None):
+        """
+        Register a file written by muonic. The DAQ configuration is
+        stored if it is given and the run has none yet. Returns the id
+        of the run.
+
+        Raises ValueError if the filename was not made by
+        get_muonic_filename.
+
+        :param filename: the filename
+        :type filename: str
+        :param settings: DAQ configuration, see get_run_settings
+        :type settings: dict
+        :returns: int
+        :raises: ValueError
+        """
+        run_id = self._register(filename, settings)
+        self.connection.commit()
+        return run_id
+
+    def _register(self, filename, settings=None):
+        """
+        Register a file without committing, see register.
+
+        :param filename: the filename
+        :type filename: str
+        :param settings: DAQ configuration
+        :type settings: dict
+        :returns: int
+        :raises: ValueError
+        """
+        run = self._get_row(filename)
+
+        if run is None:
+            metadata = parse_muonic_filename(filename)
+            if metadata is None:
+                raise ValueError("'%s' is not a muonic data file" % filename)
+
+            cursor = self.connection.execute(
+                    "INSERT INTO runs (path, name, measurement, user, " +
+                    "start_time, hours, compression, finished, registered) " +
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (os.path.abspath(filename), os.path.basename(filename),
+                     metadata["measurement"], metadata["user"],
+                     metadata["start_time"], metadata["hours"],
+                     metadata["compression"],
+                     metadata["hours"] is not None, time.time()))
+            run_id = cursor.lastrowid
+            self.logger.debug("Registered run %s" % filename)
+        else:
+            run_id = run["id"]
+
+        if settings is not None and (run is None or
+                                     run[CONFIG_KEYS[0]] is None):
+            keys = [key for key in CONFIG_KEYS if key in settings]
+            self.connection.execute(
+                    "UPDATE runs SET %s WHERE id = ?" %
+                    ", ".join("%s = ?" % key for key in keys),
+                    [settings[key] for key in keys] + [run_id])
+
+        return run_id
+
+    def update(self, filename, max_bytes=None):
+        """
+        Scan the data appended to a registered file since the last
+        update. At most about max_bytes are scanned at once, compressed
+        files are always scanned completely. Returns True if the file
+        was scanned up to its end.
+
+        :param filename: the filename
+        :type filename: str
+        :param max_bytes: maximum number of bytes to scan
+        :type max_bytes: int
+        :returns: bool
+        :raises: ValueError
+        """
+        run = self._get_row(filename)
+        if run is None:
+            raise ValueError("'%s' is not registered" % filename)
+        complete = self._scan(run, max_bytes)[0]
+        self.connection.commit()
+        return complete
+
+    def _scan(self, run, max_bytes, interrupt=None):
+        """
+        Scan a file from the end of the last scan. Returns whether the
+        file was scanned to its end and the number of bytes scanned.
+
+        :param run: the catalog row of the run
+        :type run: sqlite3.Row
+        :param max_bytes: maximum number of bytes to scan
+        :type max_bytes: int
+        :param interrupt: the scan is stopped when this event is set
+        :type interrupt: threading.Event
+        :returns: tuple
+        """
+        path = run["path"]
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return True, 0
+
+        if (stat.st_size == run["file_size"] and
+                stat.st_mtime == run["file_mtime"]):
+            return True, 0
+
+        scanned = run["scanned_size"]
+        compressed = get_compression(path) is not None
+        if not compressed and stat.st_size < scanned:
+            # the file was replaced, scan it again
+            self.logger.debug("Rescanning %s" % path)
+            run = dict(run)
+            run.update(events=0, first_time=None, last_time=None,
+                       scan_state=None)
+            scanned = 0
+
+        state = _ScanState(run)
+        complete = True
+        consumed = 0
+
+        try:
+            if stat.st_size and is_pulse_file(path):
+                events = read_pulse_file(path)[0]
+                while scanned < len(events):
+                    chunk = events[scanned:scanned + SCAN_EVENTS]
+                    state.events += len(chunk)
+                    state.add_times_of_day(np.asarray(chunk["trigger_time"]))
+
+                    scanned += len(chunk)
+                    consumed += len(chunk) * events.dtype.itemsize
+                    if ((max_bytes is not None and consumed >= max_bytes) or
+                            (interrupt is not None and interrupt.is_set())):
+                        complete = scanned >= len(events)
+                        break
+            else:
+                for block in read_line_blocks(path, SCAN_BLOCK_SIZE,
+                                              processes=1,
+                                              logger=self.logger,
+                                              offset=scanned):
+                    if not compressed:
+                        # the last line may still be written
+                        block = block[:block.rfind(b"\n") + 1]
+                        if not block:
+                            break
+                    _scan_lines(block, run["measurement"], state)
+
+                    scanned += len(block)
+                    consumed += len(block)
+                    if interrupt is not None and interrupt.is_set():
+                        complete = False
+                        break
+                    if (not compressed and max_bytes is not None and
+                            consumed >= max_bytes):
+                        complete = scanned >= stat.st_size
+                        break
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("Could not scan %s: %s" % (path, e))
+
+        # the file size is only stored once the file is scanned, so
+        # the scan is continued on the next update
+        self.connection.execute(
+                "UPDATE runs SET file_size = ?, file_mtime = ?, " +
+                "scanned_size = ?, scan_state = ?, events = ?, " +
+                "first_time = ?, last_time = ?, updated = ? WHERE id = ?",
+                (stat.st_size if complete else -1,
+                 stat.st_mtime if complete else -1, scanned,
+                 state.to_json(), state.events, state.first_time,
+                 state.last_time, time.time(), run["id"]))
+        return complete, consumed
+
+    def finish_run(self, filename, settings=None):
+        """
+        Register a run whose file has been renamed by rename_muonic_file
+        at the end of the measurement and scan the rest of it. Returns
+        the new filename or None if the file does not exist.
+
+        :param filename: the filename before renaming
+        :type filename: str
+        :param settings: DAQ configuration, see get_run_settings
+        :type settings: dict
+        :returns: str or None
+        """
+        path = os.path.abspath(filename)
+        new_path = path
+
+        if not os.path.exists(path):
+            directory, name = os.path.split(path)
+            pattern = re.compile("^%s$" % re.escape(name).replace(
+                    "HOURS", r"\d+(\.\d+)?"))
+            try:
+                candidates = sorted(candidate for candidate
+                                    in os.listdir(directory)
+                                    if pattern.match(candidate))
+            except OSError:
+                candidates = []
+            if not candidates:
+                return None
+            new_path = os.path.join(directory, candidates[-1])
+
+        if new_path != path and self._get_row(path) is not None:
+            metadata = parse_muonic_filename(new_path)
+            self.connection.execute("DELETE FROM runs WHERE path = ?",
+                                    (new_path,))
+            self.connection.execute(
+                    "UPDATE runs SET path = ?, name = ?, hours = ?, " +
+                    "finished = 1 WHERE path = ?",
+                    (new_path, os.path.basename(new_path),
+                     metadata["hours"], path))
+
+        self._register(new_path, settings)
+        self._scan(self._get_row(new_path), None)
+        self.connection.commit()
+        return new_path
+
+    def update_directory(self, directory=None, max_bytes=None,
+                         interrupt=None):
+        """
+        Register all muonic files in a directory and scan their new
+        data. Entries of files which were removed are deleted. At most
+        about max_bytes are scanned at once, compressed files are always
+        scanned completely unless the scan is interrupted. Returns True
+        if all files were scanned up to their end.
+
+        :param directory: the directory, defaults to the data directory
+        :type directory: str
+        :param max_bytes: maximum number of bytes to scan
+        :type max_bytes: int
+        :param interrupt: the scan is stopped when this event is set
+        :type interrupt: threading.Event
+        :returns: bool
+        """
+        if directory is None:
+            directory = get_data_directory()
+        directory = os.path.abspath(directory)
+
+        try:
+            paths = set(os.path.join(directory, name)
+                        for name in os.listdir(directory)
+                        if parse_muonic_filename(name) is not None)
+        except OSError as e:
+            self.logger.warning("Could not list %s: %s" % (directory, e))
+            return True
+
+        runs = dict((run["path"], run) for run in self.connection.execute(
+                "SELECT * FROM runs") if
+                os.path.dirname(run["path"]) == directory)
+
+        removed = [(path,) for path in runs if path not in paths]
+        self.connection.executemany("DELETE FROM runs WHERE path = ?",
+                                    removed)
+
+        budget = max_bytes
+        try:
+            for path in sorted(paths):
+                if budget is not None and budget <= 0:
+                    return False
+                if interrupt is not None and interrupt.is_set():
+                    return False
+                run = runs.get(path)
+                if run is None:
+                    self._register(path)
+                    run = self._get_row(path)
+                complete, consumed = self._scan(run, budget, interrupt)
+                if not complete:
+                    return False
+                if budget is not None:
+                    budget -= consumed
+        finally:
+            self.connection.commit()
+        return True
+
+    def find_runs(self, measurement=None, start=None, stop=None, user=None,
+                  finished=None, **settings):
+        """
+        Find runs by measurement id, user, the time range they overlap
+        with and their DAQ configuration, e.g. all decay runs with veto
+        on channel 2 in March 2016::
+
+            catalog.find_runs("D", start=datetime.datetime(2016, 3, 1),
+                              stop=datetime.datetime(2016, 4, 1),
+                              veto=True, veto_ch2=True)
+
+        Returns the catalog entries ordered by start time.
+
+        Raises KeyError for unknown configuration keys.
+
+        :param measurement: measurement id, e.g. 'DAQ', 'R', 'D', 'V', 'P'
+        :type measurement: str
+        :param start: start of the time range, UTC
+        :type start: datetime.datetime or float
+        :param stop: end of the time range, UTC
+        :type stop: datetime.datetime or float
+        :param user: user initials
+        :type user: str
+        :param finished: only finished or unfinished runs
+        :type finished: bool
+        :param settings: DAQ configuration values
+        :returns: list of dict
+        :raises: KeyError
+        """
+        conditions = []
+        parameters = []
+
+        if isinstance(start, datetime.datetime):
+            start = _to_timestamp(start)
+        if isinstance(stop, datetime.datetime):
+            stop = _to_timestamp(stop)
+
+        if measurement is not None:
+            conditions.append("measurement = ?")
+            parameters.append(measurement)
+        if user is not None:
+            conditions.append("user = ?")
+            parameters.append(user)
+        if finished is not None:
+            conditions.append("finished = ?")
+            parameters.append(bool(finished))
+        if stop is not None:
+            conditions.append("start_time < ?")
+            parameters.append(stop)
+        if start is not None:
+            conditions.append("MAX(start_time, IFNULL(last_time, " +
+                              "start_time + IFNULL(hours, 0) * 3600)) >= ?")
+            parameters.append(start)
+
+        for key, value in sorted(settings.items()):
+            if key not in CONFIG_KEYS:
+                raise KeyError("unknown configuration key '%s'" % key)
+            if value is None:
+                conditions.append("%s IS NULL" % key)
+            else:
+                conditions.append("%s = ?" % key)
+                parameters.append(value)
+
+        query = "SELECT * FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_time"
+
+        return [dict(run) for run in
+                self.connection.execute(query, parameters)]
+
+
+class CatalogUpdater(threading.Thread):
+    """
+    Thread which keeps the run catalog up to date, so scanning large or
+    compressed files does not block the caller, e.g. the gui. The thread
+    has its own connection to the catalog. Requested files are registered
+    and scanned in the order of the requests. The files of earlier runs
+    in the directory are scanned in between, max_bytes at a time, until
+    all of them are up to date.
+
+    :param filename: the catalog file, defaults to CATALOG_FILENAME in
+                     the data directory
+    :type filename: str
+    :param directory: the directory of the earlier runs, defaults to the
+                      data directory
+    :type directory: str
+    :param max_bytes: bytes of earlier runs scanned between the requests
+    :type max_bytes: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, filename=None, directory=None,
+                 max_bytes=SCAN_BLOCK_SIZE, logger=None):
+        threading.Thread.__init__(self)
+        if logger is None:
+            logger = logging.getLogger()
+        if filename is None:
+            filename = get_catalog_filename()
+        if directory is None:
+            directory = get_data_directory()
+        self.daemon = True
+        self.logger = logger
+        self.filename = filename
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._requests = queue.Queue()
+        self._stopped = threading.Event()
+
+    def register(self, filename, settings=None):
+        """
+        Register a file and scan the data written since the last update,
+        see RunCatalog.register and RunCatalog.update.
+
+        :param filename: the filename
+        :type filename: str
+        :param settings: DAQ configuration, see get_run_settings
+        :type settings: dict
+        :returns: None
+        """
+        self._requests.put(("register", filename, settings))
+
+    def finish_run(self, filename, settings=None):
+        """
+        Register a run whose file has been renamed at the end of the
+        measurement, see RunCatalog.finish_run.
+
+        :param filename: the filename before renaming
+        :type filename: str
+        :param settings: DAQ configuration, see get_run_settings
+        :type settings: dict
+        :returns: None
+        """
+        self._requests.put(("finish_run", filename, settings))
+
+    def stop(self, timeout=None):
+        """
+        Stop scanning the earlier runs, handle the pending requests and
+        wait until the thread has finished.
+
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        :returns: None
+        """
+        self._stopped.set()
+        self._requests.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    def _handle(self, catalog, request):
+        """
+        Handle a request of register or finish_run
+
+        :param catalog: the catalog
+        :type catalog: RunCatalog
+        :param request: name of the request, filename and settings
+        :type request: tuple
+        :returns: None
+        """
+        name, filename, settings = request
+        try:
+            if name == "register":
+                catalog.register(filename, settings)
+                catalog.update(filename)
+            else:
+                catalog.finish_run(filename, settings)
+        except ValueError as e:
+            self.logger.warning("Could not catalog %s: %s" % (filename, e))
+
+    def run(self):
+        """
+        Handle the requests and scan the earlier runs until stop is
+        called.
+
+        :returns: None
+        """
+        try:
+            catalog = RunCatalog(self.filename, self.logger)
+        except sqlite3.Error as e:
+            self.logger.warning("Could not open the run catalog: %s" % e)
+            return
+
+        backlog = True
+        try:
+            while True:
+                try:
+                    # wait for requests only if the earlier runs are done
+                    request = self._requests.get(block=not backlog)
+                except queue.Empty:
+                    request = ()
+
+                if request is None:
+                    break
+
+                try:
+                    if request:
+                        self._handle(catalog, request)
+                    else:
+                        backlog = not (catalog.update_directory(
+                                self.directory, self.max_bytes,
+                                self._stopped) or self._stopped.is_set())
+                except sqlite3.Error as e:
+                    self.logger.warning("Could not update the run " +
+                                        "catalog: %s" % e)
+        finally:
+            catalog.close()
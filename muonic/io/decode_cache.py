@@ -0,0 +1,414 @@
+"""
+Cache of decoded RAW files.
+
+The trigger lines of a RAW file decoded by decode_daq_lines are stored
+in a cache file, so later analyses of the same file memory map the
+decoded lines instead of parsing the text again. A cache file belongs to
+the path, the size and the modification time of the RAW file and the
+version of the decoder, a RAW file which changed is decoded again.
+
+The cache directory has a size limit, the least recently used cache
+files are removed when it is exceeded.
+"""
+from __future__ import print_function
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from muonic.analysis.analyzer import DAQ_LINE_DTYPE, DECODER_VERSION
+from muonic.analysis.analyzer import decode_daq_lines
+from muonic.io.raw_reader import read_line_blocks
+from muonic.util import WrappedFile, get_data_directory
+
+__all__ = ["DecodeCache", "DecodedRawFile", "decode_raw_file",
+           "get_decode_cache"]
+
+MAGIC = b"\x89MUONICD"
+VERSION = 1
+
+# name of the cache directory in the data directory
+CACHE_DIRECTORY = "decoded"
+
+# default size limit of the cache directory in bytes
+CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+# extension of the cache files
+CACHE_EXTENSION = ".dec"
+
+# size of the blocks decoded at once in bytes
+DECODE_BLOCK_SIZE = 16 * 1024 * 1024
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u2"),
+    ("record_size", "<u2"),
+    ("decoder_version", "<u2"),
+    ("reserved", "V10")
+])
+
+_default_cache = None
+
+
+class DecodedRawFile(WrappedFile):
+    """
+    Writer of a cache file of decoded DAQ lines
+
+    :param filename: the filename written to
+    :type filename: str
+    :param cache_filename: the cache filename the file is renamed to
+                           when it is complete
+    :type cache_filename: str
+    :raises: ValueError
+    """
+
+    def __init__(self, filename, cache_filename=None):
+        WrappedFile.__init__(self, filename)
+        self.cache_filename = cache_filename
+
+    def open(self, mode='w'):
+        """
+        Open file in binary mode and track it. A header is written
+        if the file is empty.
+
+        :param mode: the file mode
+        :type mode: str
+        :returns: None
+        """
+        WrappedFile.open(self, mode.replace('b', '') + 'b')
+
+        if self._file.tell() == 0:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header["magic"] = MAGIC
+            header["version"] = VERSION
+            header["record_size"] = DAQ_LINE_DTYPE.itemsize
+            header["decoder_version"] = DECODER_VERSION
+            self._file.write(header.tobytes())
+        return self
+
+    def write_lines(self, data):
+        """
+        Append decoded DAQ lines to the file.
+
+        :param data: decoded DAQ lines
+        :type data: numpy.ndarray
+        :returns: None
+        """
+        self._file.write(np.ascontiguousarray(
+                data, dtype=DAQ_LINE_DTYPE).tobytes())
+
+
+def _read_cache_file(filename):
+    """
+    Memory map the decoded lines of a cache file. Returns None if the
+    file is not a valid cache file.
+
+    :param filename: the cache filename
+    :type filename: str
+    :returns: numpy.ndarray or None
+    """
+    header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+
+    if (len(header) == 0 or header["magic"][0] != MAGIC or
+            header["version"][0] != VERSION or
+            header["record_size"][0] != DAQ_LINE_DTYPE.itemsize or
+            header["decoder_version"][0] != DECODER_VERSION):
+        return None
+
+    size = os.path.getsize(filename) - HEADER_DTYPE.itemsize
+    if size % DAQ_LINE_DTYPE.itemsize:
+        return None
+    if size == 0:
+        return np.zeros(0, dtype=DAQ_LINE_DTYPE)
+
+    return np.memmap(filename, dtype=DAQ_LINE_DTYPE, mode='r',
+                     offset=HEADER_DTYPE.itemsize,
+                     shape=(size // DAQ_LINE_DTYPE.itemsize,))
+
+
+class DecodeCache(object):
+    """
+    Directory of cache files of decoded RAW files with a size limit.
+    The directory is created if it does not exist.
+
+    :param directory: the cache directory, defaults to CACHE_DIRECTORY in
+                      the data directory
+    :type directory: str
+    :param max_size: size limit of the cache directory in bytes
+    :type max_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, directory=None, max_size=CACHE_SIZE, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        if directory is None:
+            directory = os.path.join(get_data_directory(), CACHE_DIRECTORY)
+        self.logger = logger
+        self.directory = directory
+        self.max_size = max_size
+
+    def _get_prefix(self, filename):
+        """
+        Get the part of the cache filename which depends on the path
+        of the RAW file only.
+
+        :param filename: the RAW file
+        :type filename: str
+        :returns: str
+        """
+        path = os.path.abspath(filename).encode("utf-8", "replace")
+        return hashlib.sha1(path).hexdigest()[:16]
+
+    def get_cache_filename(self, filename):
+        """
+        Get the cache filename of the current version of a RAW file
+
+        :param filename: the RAW file
+        :type filename: str
+        :returns: str
+        :raises: OSError
+        """
+        stat = os.stat(filename)
+        identity = hashlib.sha1(repr((
+                stat.st_size, stat.st_mtime, DECODER_VERSION,
+                DAQ_LINE_DTYPE.descr)).encode("ascii")).hexdigest()[:16]
+        return os.path.join(self.directory, "%s-%s%s" % (
+                self._get_prefix(filename), identity, CACHE_EXTENSION))
+
+    def _get_cache_files(self):
+        """
+        Get the cache files with their last use time and size, least
+        recently used first.
+
+        :returns: list of tuple
+        """
+        cache_files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return cache_files
+
+        for name in names:
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            cache_files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(cache_files)
+
+    def load(self, filename):
+        """
+        Memory map the cached decoded lines of a RAW file. Returns None
+        if the file is not cached.
+
+        :param filename: the RAW file
+        :type filename: str
+        :returns: numpy.ndarray or None
+        """
+        try:
+            cache_filename = self.get_cache_filename(filename)
+            if not os.path.exists(cache_filename):
+                return None
+            data = _read_cache_file(cache_filename)
+            # the modification time marks the last use
+            os.utime(cache_filename, None)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("Could not read decoded cache of %s: %s" %
+                                (filename, e))
+            return None
+
+        if data is not None:
+            self.logger.debug("Using decoded cache %s of %s" %
+                              (cache_filename, filename))
+        return data
+
+    def create(self, filename):
+        """
+        Open a temporary cache file for a RAW file, to which the decoded
+        lines are appended in the order of the file. The cache file is
+        only used after it has been committed.
+
+        :param filename: the RAW file
+        :type filename: str
+        :returns: DecodedRawFile
+        :raises: IOError, OSError
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o755)
+
+        cache_filename = self.get_cache_filename(filename)
+        cache_file = DecodedRawFile(cache_filename + ".%d.tmp" % os.getpid(),
+                                    cache_filename)
+        return cache_file.open("w")
+
+    def commit(self, filename, cache_file):
+        """
+        Close a cache file opened by create and use it for the RAW file,
+        unless the RAW file changed meanwhile. Replaces older cache
+        files of the same path and evicts the least recently used ones
+        if the size limit is exceeded.
+
+        :param filename: the RAW file
+        :type filename: str
+        :param cache_file: the cache file
+        :type cache_file: DecodedRawFile
+        :returns: numpy.ndarray or None
+        """
+        cache_file.close()
+        temporary = cache_file.get_filename()
+
+        try:
+            if self.get_cache_filename(filename) != cache_file.cache_filename:
+                self.logger.debug("%s changed while decoding, not caching" %
+                                  filename)
+                os.remove(temporary)
+                return None
+
+            prefix = self._get_prefix(filename)
+            for _, _, path in self._get_cache_files():
+                if os.path.basename(path).startswith(prefix):
+                    os.remove(path)
+
+            os.rename(temporary, cache_file.cache_filename)
+            self.evict(keep=cache_file.cache_filename)
+            return _read_cache_file(cache_file.cache_filename)
+        except (IOError, OSError) as e:
+            self.logger.warning("Could not store decoded cache of %s: %s" %
+                                (filename, e))
+            return None
+
+    def discard(self, cache_file):
+        """
+        Close and remove a cache file opened by create, e.g. if decoding
+        was stopped.
+
+        :param cache_file: the cache file
+        :type cache_file: DecodedRawFile
+        :returns: None
+        """
+        if not cache_file.closed:
+            cache_file.close()
+        try:
+            os.remove(cache_file.get_filename())
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used cache files until the cache
+        directory is within its size limit.
+
+        :param keep: cache file which is not removed
+        :type keep: str
+        :returns: None
+        """
+        cache_files = self._get_cache_files()
+        size = sum(cache_size for _, cache_size, _ in cache_files)
+
+        for _, cache_size, path in cache_files:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                size -= cache_size
+                self.logger.debug("Evicted decoded cache %s" % path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Remove all cache files.
+
+        :returns: None
+        """
+        for _, _, path in self._get_cache_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_decode_cache(logger=None):
+    """
+    Get the default cache in the data directory. It is created again if
+    the data directory changed.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: DecodeCache
+    """
+    global _default_cache
+
+    directory = os.path.join(get_data_directory(), CACHE_DIRECTORY)
+    if _default_cache is None or _default_cache.directory != directory:
+        _default_cache = DecodeCache(directory, logger=logger)
+    return _default_cache
+
+
+def decode_raw_file(filename, cache=None, processes=None, logger=None):
+    """
+    Decode the trigger lines of a (compressed) RAW file, see
+    decode_daq_lines. The decoded lines are taken from the cache if the
+    file was decoded before, otherwise they are stored in the cache.
+    Returns a memory mapped array if the cache is used.
+
+    :param filename: the RAW file
+    :type filename: str
+    :param cache: the cache, defaults to the cache in the data directory,
+                  False disables caching
+    :type cache: DecodeCache or bool
+    :param processes: number of worker processes to decompress the file
+    :type processes: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray
+    """
+    if logger is None:
+        logger = logging.getLogger()
+    if cache is None:
+        cache = get_decode_cache(logger)
+
+    if cache:
+        data = cache.load(filename)
+        if data is not None:
+            return data
+
+    cache_file = None
+    if cache:
+        try:
+            cache_file = cache.create(filename)
+        except (IOError, OSError) as e:
+            logger.warning("Could not create decoded cache of %s: %s" %
+                           (filename, e))
+
+    decoded = []
+    try:
+        for block in read_line_blocks(filename, DECODE_BLOCK_SIZE,
+                                      processes, logger=logger):
+            data = decode_daq_lines(block)
+            if cache_file is not None:
+                cache_file.write_lines(data)
+            else:
+                decoded.append(data)
+    except BaseException:
+        if cache_file is not None:
+            cache.discard(cache_file)
+        raise
+
+    if cache_file is not None:
+        data = cache.commit(filename, cache_file)
+        if data is None:
+            return decode_raw_file(filename, False, processes, logger)
+        return data
+
+    if not decoded:
+        return np.zeros(0, dtype=DAQ_LINE_DTYPE)
+    return np.concatenate(decoded)
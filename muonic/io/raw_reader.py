@@ -0,0 +1,549 @@
+"""
+Reader for plain and compressed RAW files.
+
+The compression is detected by the magic bytes at the start of the file,
+gzip, bzip2 and xz are supported. Plain files are memory mapped.
+Compressed files which consist of many members or streams, as written
+e.g. by pbzip2 or by concatenating compressed files, are decompressed in
+parallel by worker processes, all other compressed files are
+decompressed while reading. The file is read in blocks of complete lines,
+so the memory used does not depend on the size of the file.
+"""
+from __future__ import print_function
+import bz2
+from collections import deque
+import gzip
+from io import BytesIO
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import re
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # xz compressed files can not be read without lzma
+    lzma = None
+
+__all__ = ["get_compression", "open_raw_file", "read_line_blocks",
+           "read_lines"]
+
+# default size of the line blocks in bytes, about 200000 DAQ lines
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# size of the pieces read from compressed files
+READ_SIZE = 1024 * 1024
+
+# minimum compressed size of the members decompressed by one worker
+TASK_SIZE = 2 * 1024 * 1024
+
+# maximum size of the data decompressed by one worker, larger members
+# are decompressed while reading
+TASK_OUTPUT_SIZE = 32 * 1024 * 1024
+
+# compressed size decompressed to check the start of a member
+CHECK_SIZE = 64 * 1024
+
+# magic bytes at the start of the file
+MAGIC = [("gzip", b"\x1f\x8b"),
+         ("bz2", b"BZh"),
+         ("xz", b"\xfd7zXZ\x00")]
+
+# start of a member or stream of a compressed file, these may also
+# appear by chance within the compressed data
+MEMBER_PATTERN = {
+    "gzip": re.compile(b"\x1f\x8b\x08"),
+    "bz2": re.compile(b"BZh[1-9]1AY&SY"),
+    "xz": re.compile(b"\xfd7zXZ\x00")
+}
+
+# errors raised by the decompressors on invalid data
+DECOMPRESSION_ERRORS = (IOError, EOFError, ValueError, zlib.error)
+if lzma is not None:
+    DECOMPRESSION_ERRORS += (lzma.LZMAError,)
+
+
+def get_compression(filename):
+    """
+    Get the compression of a file from its magic bytes: 'gzip', 'bz2',
+    'xz' or None for uncompressed files.
+
+    :param filename: the filename
+    :type filename: str
+    :returns: str or None
+    """
+    with open(filename, "rb") as raw_file:
+        start = raw_file.read(6)
+
+    for compression, magic in MAGIC:
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def _get_decompressor(compression):
+    """
+    Get a decompressor object for one member or stream.
+
+    Raises IOError if lzma is not installed for xz files.
+
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :returns: decompressor object
+    :raises: IOError
+    """
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == "bz2":
+        return bz2.BZ2Decompressor()
+
+    if lzma is None:
+        raise IOError("no lzma installed to read xz compressed files")
+    return lzma.LZMADecompressor()
+
+
+def open_raw_file(filename):
+    """
+    Open a plain, gzip, bzip2 or xz compressed RAW file for reading in
+    binary mode. The file is decompressed while reading.
+
+    Raises IOError if lzma is not installed for xz files.
+
+    :param filename: the filename
+    :type filename: str
+    :returns: file
+    :raises: IOError
+    """
+    compression = get_compression(filename)
+
+    if compression == "gzip":
+        return gzip.open(filename, "rb")
+    elif compression == "bz2":
+        return bz2.BZ2File(filename, "rb")
+    elif compression == "xz":
+        if lzma is None:
+            raise IOError("no lzma installed to read xz compressed files")
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def _iter_members(raw_file, compression, start):
+    """
+    Decompress the members of a compressed file from start to the end of
+    the file. Yields the decompressed pieces together with the offset of
+    the compressed data read so far and whether the piece is the last
+    one of a member.
+
+    :param raw_file: the compressed file opened in binary mode
+    :type raw_file: file
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :param start: offset of the first member
+    :type start: int
+    :returns: generator of tuple
+    :raises: IOError
+    """
+    position = start
+
+    while True:
+        raw_file.seek(position)
+        pending = raw_file.read(READ_SIZE)
+        if not pending:
+            break
+
+        decompressor = _get_decompressor(compression)
+
+        while True:
+            piece = decompressor.decompress(pending)
+            position += len(pending) - len(decompressor.unused_data)
+
+            if decompressor.eof:
+                yield piece, position, True
+                break
+
+            yield piece, position, False
+
+            pending = raw_file.read(READ_SIZE)
+            if not pending:
+                raise IOError("compressed file ended early")
+
+
+def _decompress_members(filename, compression, start, stop,
+                        max_size=TASK_OUTPUT_SIZE):
+    """
+    Decompress the members of a compressed file starting at start, up to
+    the first member ending at or after stop. Decompression ends early at
+    the end of the last complete member if a member continues after stop,
+    i.e. stop was found by chance in the compressed data, or if more than
+    max_size bytes were decompressed.
+
+    Returns start, the end of the last complete member and the
+    decompressed data of the complete members, or start, None and the
+    error message if the data is not a valid member.
+
+    :param filename: the filename
+    :type filename: str
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :param start: offset of the first member
+    :type start: int
+    :param stop: offset up to which members are decompressed
+    :type stop: int
+    :param max_size: maximum size of the decompressed data in bytes
+    :type max_size: int
+    :returns: tuple
+    """
+    data = []
+    complete = 0
+    size = 0
+    end = start
+
+    try:
+        with open(filename, "rb") as raw_file:
+            for piece, position, member_end in _iter_members(
+                    raw_file, compression, start):
+                data.append(piece)
+                size += len(piece)
+
+                if member_end:
+                    end = position
+                    complete = len(data)
+                    if end >= stop:
+                        break
+                elif position > stop or size > max_size:
+                    break
+    except DECOMPRESSION_ERRORS as e:
+        return start, None, "%s at offset %d" % (e, start)
+
+    return start, end, b"".join(data[:complete])
+
+
+def _is_member_start(data, position, compression):
+    """
+    Check if a start pattern found in a compressed file is the start of a
+    member: the header has to be valid and the data following it has to
+    decompress without errors.
+
+    :param data: the compressed file
+    :type data: mmap.mmap
+    :param position: offset of the start pattern
+    :type position: int
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :returns: bool
+    """
+    header = data[position:position + 12]
+
+    if compression == "gzip":
+        # the reserved flags are not set
+        if len(header) < 10 or ord(header[3:4]) & 0xe0:
+            return False
+    elif compression == "xz":
+        # the stream flags are followed by their checksum
+        if (len(header) < 12 or zlib.crc32(header[6:8]) & 0xffffffff !=
+                struct.unpack("<I", header[8:12])[0]):
+            return False
+
+    try:
+        _get_decompressor(compression).decompress(
+                data[position:position + CHECK_SIZE])
+    except DECOMPRESSION_ERRORS:
+        return False
+    return True
+
+
+def _find_tasks(filename, compression, task_size):
+    """
+    Split a compressed file into ranges of at least task_size bytes,
+    which start with a member. Start patterns which appear by chance
+    within the compressed data are skipped if their header is not valid
+    or the data can not be decompressed. Whether the previous member
+    really ends there is only known after decompressing it, see
+    _read_parallel.
+
+    :param filename: the filename
+    :type filename: str
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :param task_size: minimum size of a range in bytes
+    :type task_size: int
+    :returns: list of tuple
+    """
+    pattern = MEMBER_PATTERN[compression]
+    size = os.path.getsize(filename)
+    starts = [0]
+
+    if size == 0:
+        return []
+
+    with open(filename, "rb") as raw_file:
+        data = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = task_size
+            while position < size:
+                match = pattern.search(data, position)
+                if match is None:
+                    break
+                position = match.start()
+                if _is_member_start(data, position, compression):
+                    starts.append(position)
+                    position += task_size
+                else:
+                    position += 1
+        finally:
+            data.close()
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _split_lines(pieces, block_size):
+    """
+    Join pieces of data into blocks of about block_size bytes which end
+    with a complete line. The last block ends with the rest of the data.
+
+    :param pieces: pieces of data
+    :type pieces: iterable of bytes
+    :param block_size: size of the blocks in bytes
+    :type block_size: int
+    :returns: generator of bytes
+    """
+    block = []
+    length = 0
+
+    for piece in pieces:
+        block.append(piece)
+        length += len(piece)
+
+        if length < block_size:
+            continue
+
+        # pieces may be much larger than the block size, e.g. whole
+        # decompressed members, so they are cut into several blocks
+        data = b"".join(block)
+        start = 0
+
+        while len(data) - start >= block_size:
+            end = data.rfind(b"\n", start, start + block_size) + 1
+            if end == 0:
+                # a single line longer than the block size
+                end = data.find(b"\n", start + block_size) + 1
+                if end == 0:
+                    break
+            yield data[start:end]
+            start = end
+
+        block = [data[start:]]
+        length = len(block[0])
+
+    if length:
+        yield b"".join(block)
+
+
+def _read_plain_blocks(filename, block_size, offset=0):
+    """
+    Read the line blocks of an uncompressed file through a memory map.
+
+    :param filename: the filename
+    :type filename: str
+    :param block_size: size of the blocks in bytes
+    :type block_size: int
+    :param offset: byte offset to start at
+    :type offset: int
+    :returns: generator of bytes
+    """
+    if os.path.getsize(filename) <= offset:
+        return
+
+    with open(filename, "rb") as raw_file:
+        data = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = offset
+            size = len(data)
+
+            while start < size:
+                end = data.rfind(b"\n", start, start + block_size) + 1
+                if end <= start:
+                    # a single line longer than the block size
+                    end = data.find(b"\n", start + block_size) + 1 or size
+                yield data[start:end]
+                start = end
+        finally:
+            data.close()
+
+
+def _read_parallel(filename, compression, tasks, pool, max_pending):
+    """
+    Decompress ranges of members with a process pool. Yields the
+    decompressed data in the order of the file.
+
+    A range which does not end with a member, because its end was found
+    by chance in the compressed data, or whose members are too large for
+    a worker, is decompressed while reading from the end of its last
+    complete member, up to the next member ending at or after the end of
+    the range. A single member is thus never held in memory as a whole.
+
+    :param filename: the filename
+    :type filename: str
+    :param compression: 'gzip', 'bz2' or 'xz'
+    :type compression: str
+    :param tasks: ranges of the file starting with a member
+    :type tasks: list of tuple
+    :param pool: process pool
+    :type pool: multiprocessing.Pool
+    :param max_pending: maximum number of ranges decompressed at once
+    :type max_pending: int
+    :returns: generator of bytes
+    :raises: IOError
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    expected = 0
+
+    while True:
+        for start, stop in tasks:
+            pending.append((stop, pool.apply_async(
+                    _decompress_members,
+                    (filename, compression, start, stop))))
+            if len(pending) >= max_pending:
+                break
+
+        if not pending:
+            break
+
+        stop, result = pending.popleft()
+        start, end, data = result.get()
+
+        if stop <= expected:
+            # already read with the members of the previous range
+            continue
+
+        if start == expected:
+            if end is None:
+                raise IOError("could not decompress '%s': %s" %
+                              (filename, data))
+            expected = end
+            yield data
+
+            if end >= stop:
+                continue
+
+        # the previous range ended within this one, the start of this
+        # range was found by chance in the compressed data, or this range
+        # ended early
+        try:
+            with open(filename, "rb") as raw_file:
+                for piece, position, member_end in _iter_members(
+                        raw_file, compression, expected):
+                    yield piece
+                    if member_end:
+                        expected = position
+                        if expected >= stop:
+                            break
+        except DECOMPRESSION_ERRORS as e:
+            raise IOError("could not decompress '%s': %s at offset %d" %
+                          (filename, e, expected))
+
+
+def read_line_blocks(filename, block_size=BLOCK_SIZE, processes=None,
+                     pool=None, logger=None, offset=0):
+    """
+    Read a plain or compressed RAW file in blocks of complete lines of
+    about block_size bytes. Uncompressed files are memory mapped,
+    compressed files with many members are decompressed in parallel by
+    worker processes. Reading can start at a byte offset of the
+    uncompressed data, which has to be the start of a line. Compressed
+    files are then decompressed up to the offset while reading.
+
+    Raises IOError if the file can not be decompressed.
+
+    :param filename: the filename
+    :type filename: str
+    :param block_size: size of the blocks in bytes
+    :type block_size: int
+    :param processes: number of worker processes, defaults to the
+                      number of cores
+    :type processes: int
+    :param pool: process pool to use instead of starting one
+    :type pool: multiprocessing.Pool
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param offset: byte offset to start at
+    :type offset: int
+    :returns: generator of bytes
+    :raises: IOError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    compression = get_compression(filename)
+
+    if compression is None:
+        logger.debug("Memory mapping '%s'" % filename)
+        for block in _read_plain_blocks(filename, block_size, offset):
+            yield block
+        return
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    tasks = []
+    if processes > 1 and offset == 0:
+        tasks = _find_tasks(filename, compression, TASK_SIZE)
+
+    if len(tasks) < 2:
+        logger.debug("Decompressing %s file '%s'" % (compression, filename))
+
+        def read_pieces():
+            with open_raw_file(filename) as raw_file:
+                raw_file.seek(offset)
+                while True:
+                    piece = raw_file.read(READ_SIZE)
+                    if not piece:
+                        break
+                    yield piece
+
+        for block in _split_lines(read_pieces(), block_size):
+            yield block
+        return
+
+    logger.debug("Decompressing %d parts of %s file '%s' in parallel" %
+                 (len(tasks), compression, filename))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = mp.Pool(processes)
+
+    try:
+        for block in _split_lines(
+                _read_parallel(filename, compression, tasks, pool,
+                               processes + 2), block_size):
+            yield block
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def read_lines(filename, block_size=BLOCK_SIZE, processes=None,
+               logger=None):
+    """
+    Iterate over the lines of a plain or compressed RAW file.
+
+    :param filename: the filename
+    :type filename: str
+    :param block_size: size of the blocks read at once in bytes
+    :type block_size: int
+    :param processes: number of worker processes, defaults to the
+                      number of cores
+    :type processes: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: generator of bytes
+    """
+    for block in read_line_blocks(filename, block_size, processes,
+                                  logger=logger):
+        for line in BytesIO(block).readlines():
+            yield line
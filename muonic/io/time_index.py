@@ -0,0 +1,602 @@
+"""
+Seekable time index for RAW and binary pulse files.
+
+The index is stored in a sidecar file next to the indexed file. For RAW
+files it holds every INDEX_STRIDE-th trigger line with its byte offset,
+its time and the trigger and 1PPS counter state of the PulseExtractor
+before the line, so the extraction can be resumed at any indexed line.
+For binary pulse files it holds every INDEX_STRIDE-th event with its
+number in the event table and its time.
+
+Times are given in seconds since the start of the first day of the file,
+i.e. the GPS time of day plus 86400 seconds for every midnight passed.
+A query only reads the part of the file between the indexed points
+around the requested time range.
+
+RAW files are indexed while DAQWidget writes them (see IndexedRawFile),
+all other files when they are queried for the first time.
+"""
+from __future__ import print_function
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+
+from muonic.analysis.analyzer import BIT7, COUNTER_STATE, PulseExtractor
+from muonic.analysis.analyzer import decode_daq_lines
+from muonic.analysis.pulse_store import DAY_WRAP, count_day_wraps
+from muonic.analysis.pulse_store import is_pulse_file, read_pulse_file
+from muonic.analysis.pulse_store import slice_events
+from muonic.io.raw_reader import get_compression, read_line_blocks
+from muonic.util import BackgroundWriter, WrappedFile
+
+__all__ = ["IndexedRawFile", "build_time_index", "load_time_index",
+           "read_raw_range", "read_pulse_range", "get_index_filename"]
+
+MAGIC = b"\x89MUONICI"
+VERSION = 1
+
+# kinds of indexed files
+RAW_INDEX = 0
+PULSE_INDEX = 1
+
+# number of trigger lines or events between two indexed points
+INDEX_STRIDE = 2000
+
+# number of written lines which are indexed at once
+INDEX_BUFFER_LINES = 1000
+
+# size of the blocks read by read_raw_range in bytes
+RANGE_BLOCK_SIZE = 256 * 1024
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u2"),
+    ("record_size", "<u2"),
+    ("kind", "<u2"),
+    ("reserved", "V10")
+])
+
+# offset is the byte offset of the line for RAW files and the record
+# number for pulse files. The counter state is only set for RAW files
+INDEX_DTYPE = np.dtype([
+    ("offset", "<i8"),
+    ("day", "<i4"),
+    ("time", "<f8"),
+    ("ini", "u1"),
+    ("trigger_count", "<i8"),
+    ("last_trigger_count", "<i8"),
+    ("last_one_pps", "<i8"),
+    ("prev_last_one_pps", "<i8"),
+    ("last_time", "<f8"),
+    ("passed_one_pps", "<i4"),
+    ("last_one_pps_poll", "<i8"),
+    ("calculated_frequency", "<f8")
+])
+
+
+def get_index_filename(filename):
+    """
+    Get the filename of the sidecar index of a file
+
+    :param filename: the indexed file
+    :type filename: str
+    :returns: str
+    """
+    return filename + ".idx"
+
+
+class TimeIndexFile(WrappedFile):
+    """
+    Writer of the sidecar index file
+
+    :param filename: the index filename
+    :type filename: str
+    :param kind: RAW_INDEX or PULSE_INDEX
+    :type kind: int
+    """
+
+    def __init__(self, filename, kind=RAW_INDEX):
+        WrappedFile.__init__(self, filename)
+        self.kind = kind
+
+    def open(self, mode='w'):
+        """
+        Open file in binary mode and track it. A header is written
+        if the file is empty.
+
+        :param mode: the file mode
+        :type mode: str
+        :returns: None
+        """
+        WrappedFile.open(self, mode.replace('b', '') + 'b')
+
+        if self._file.tell() == 0:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header["magic"] = MAGIC
+            header["version"] = VERSION
+            header["record_size"] = INDEX_DTYPE.itemsize
+            header["kind"] = self.kind
+            self._file.write(header.tobytes())
+        return self
+
+    def write_entries(self, entries):
+        """
+        Append index entries to the file.
+
+        :param entries: index entries
+        :type entries: numpy.ndarray
+        :returns: None
+        """
+        if len(entries):
+            self._file.write(entries.astype(INDEX_DTYPE).tobytes())
+            # a background writer writes the entries soon anyway
+            if not isinstance(self._file, BackgroundWriter):
+                self._file.flush()
+
+
+class RawIndexer(object):
+    """
+    Indexes blocks of subsequent lines of a RAW file.
+
+    :param index_file: opened index file to append the entries to
+    :type index_file: TimeIndexFile
+    :param offset: byte offset of the first block in the RAW file
+    :type offset: int
+    :param stride: number of trigger lines between indexed lines
+    :type stride: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, index_file, offset=0, stride=INDEX_STRIDE,
+                 logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.index_file = index_file
+        self.offset = offset
+        self.stride = stride
+        self.pulse_extractor = PulseExtractor(logger, "")
+        self.trigger_count = 0
+        self.day = 0
+        self.last_gps_time = None
+
+    def add(self, block):
+        """
+        Index a block of complete lines following the lines added so far.
+
+        :param block: lines of the RAW file
+        :type block: bytes
+        :returns: None
+        """
+        data, offsets = decode_daq_lines(block, return_offsets=True)
+        offsets += self.offset
+        self.offset += len(block)
+
+        if not len(data):
+            return
+
+        days = self.day + count_day_wraps(data["gps_time"],
+                                           self.last_gps_time)
+        self.day = int(days[-1])
+        self.last_gps_time = float(data["gps_time"][-1])
+
+        triggers = np.flatnonzero(data["re0"] & BIT7)
+        rows = triggers[(self.trigger_count +
+                         np.arange(len(triggers))) % self.stride == 0]
+        self.trigger_count += len(triggers)
+
+        entries = np.zeros(len(rows), dtype=INDEX_DTYPE)
+        valid = np.zeros(len(rows), dtype=bool)
+        start = 0
+
+        for index, row in enumerate(rows.tolist()):
+            self.pulse_extractor.skip_array(data[start:row])
+            start = row
+
+            # the counters are not reliable before the first trigger
+            state = self.pulse_extractor.get_counter_state()
+            if state["ini"]:
+                continue
+
+            valid[index] = True
+            for name in COUNTER_STATE:
+                entries[name][index] = state[name]
+            entries["offset"][index] = offsets[row]
+            entries["day"][index] = days[row]
+            entries["time"][index] = (
+                    days[row] * 86400. +
+                    self.pulse_extractor.get_line_times(data[row:row + 1])[0])
+
+        self.pulse_extractor.skip_array(data[start:])
+        self.index_file.write_entries(entries[valid])
+
+
+class IndexedRawFile(WrappedFile):
+    """
+    RAW file which writes its time index while it is written. Can be used
+    in place of WrappedFile for RAW files. The written lines are indexed
+    in a thread, so decoding them does not block the writer. The file is
+    written in binary mode with the text encoded as utf-8, the offsets in
+    the index are the ones of the written bytes.
+
+    :param filename: the filename
+    :type filename: str
+    :param stride: number of trigger lines between indexed lines
+    :type stride: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, filename, stride=INDEX_STRIDE, logger=None):
+        WrappedFile.__init__(self, filename)
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.stride = stride
+        self.index_file = TimeIndexFile(get_index_filename(filename))
+        self.indexer = None
+        self.lines = []
+        self.blocks = None
+        self.index_thread = None
+
+    def open(self, mode='w'):
+        """
+        Open the file in binary mode and its index and track them.
+        Appended lines are indexed after the existing ones.
+
+        :param mode: the file mode
+        :type mode: str
+        :returns: None
+        """
+        WrappedFile.open(self, mode.replace('b', '') + 'b')
+        offset = os.fstat(self._file.fileno()).st_size
+
+        if offset == 0 or self.indexer is None:
+            # lines written by another run are not indexed
+            self.index_file.open("w" if offset == 0 else "a")
+            self.indexer = RawIndexer(self.index_file, offset, self.stride,
+                                      self.logger)
+        else:
+            # continue the index of the previous run
+            self.index_file.open("a")
+
+        self.blocks = queue.Queue()
+        self.index_thread = threading.Thread(target=self._index_blocks)
+        self.index_thread.daemon = True
+        self.index_thread.start()
+        return self
+
+    def _index_blocks(self):
+        """
+        Index the queued blocks of lines until None is queued. Runs in
+        the index thread.
+
+        :returns: None
+        """
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            try:
+                self.indexer.add(block)
+            except (IOError, OSError, ValueError) as e:
+                self.logger.warning("Could not write time index of '%s': %s" %
+                                    (self.get_filename(), e))
+
+    def write(self, text):
+        """
+        Write text to the file and index it.
+
+        :param text: complete lines
+        :type text: str
+        :returns: None
+        """
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        self._file.write(text)
+        self.lines.append(text)
+
+        if len(self.lines) >= INDEX_BUFFER_LINES:
+            self.flush_index()
+
+    def flush_index(self):
+        """
+        Queue the lines written so far to be indexed.
+
+        :returns: None
+        """
+        if not self.lines:
+            return
+
+        self.blocks.put(b"".join(self.lines))
+        self.lines = []
+
+    def close(self):
+        """
+        Index the remaining lines and close the file and its index.
+
+        :returns: None
+        """
+        if self._file is not None:
+            self.flush_index()
+        if self.index_thread is not None:
+            self.blocks.put(None)
+            self.index_thread.join()
+            self.index_thread = None
+        if not self.index_file.closed:
+            self.index_file.close()
+        WrappedFile.close(self)
+
+
+def _build_raw_index(filename, index_file, stride, logger):
+    """
+    Index a RAW file.
+
+    :param filename: the RAW file
+    :type filename: str
+    :param index_file: opened index file
+    :type index_file: TimeIndexFile
+    :param stride: number of trigger lines between indexed lines
+    :type stride: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: None
+    """
+    indexer = RawIndexer(index_file, 0, stride, logger)
+    for block in read_line_blocks(filename, processes=1, logger=logger):
+        indexer.add(block)
+
+
+def _build_pulse_index(filename, index_file, stride):
+    """
+    Index a binary pulse file.
+
+    :param filename: the pulse file
+    :type filename: str
+    :param index_file: opened index file
+    :type index_file: TimeIndexFile
+    :param stride: number of events between indexed events
+    :type stride: int
+    :returns: None
+    """
+    events = read_pulse_file(filename)[0]
+    chunk_size = 1000000
+    day = 0
+    last_time = None
+
+    for start in range(0, len(events), chunk_size):
+        trigger_time = np.asarray(
+                events["trigger_time"][start:start + chunk_size])
+        days = day + count_day_wraps(trigger_time, last_time)
+        rows = np.arange(-start % stride, len(trigger_time), stride)
+
+        entries = np.zeros(len(rows), dtype=INDEX_DTYPE)
+        entries["offset"] = start + rows
+        entries["day"] = days[rows]
+        entries["time"] = days[rows] * 86400. + trigger_time[rows]
+        index_file.write_entries(entries)
+
+        day = int(days[-1])
+        last_time = float(trigger_time[-1])
+
+
+def build_time_index(filename, stride=INDEX_STRIDE, logger=None):
+    """
+    Build the sidecar time index of a RAW or binary pulse file, replacing
+    an existing one. Returns the index entries.
+
+    :param filename: the RAW or pulse file
+    :type filename: str
+    :param stride: number of trigger lines or events between indexed points
+    :type stride: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    kind = PULSE_INDEX if is_pulse_file(filename) else RAW_INDEX
+    index_filename = get_index_filename(filename)
+
+    logger.info("Building time index of '%s'" % filename)
+
+    # the index is built in a temporary file, so it is always complete
+    index_file = TimeIndexFile(index_filename + ".tmp", kind)
+    with index_file.open():
+        if kind == PULSE_INDEX:
+            _build_pulse_index(filename, index_file, stride)
+        else:
+            _build_raw_index(filename, index_file, stride, logger)
+
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    os.rename(index_filename + ".tmp", index_filename)
+
+    return _read_index_file(index_filename, kind)
+
+
+def _read_index_file(index_filename, kind):
+    """
+    Read the entries of an index file. Returns None if the file is not
+    an index of the given kind.
+
+    :param index_filename: the index filename
+    :type index_filename: str
+    :param kind: RAW_INDEX or PULSE_INDEX
+    :type kind: int
+    :returns: numpy.ndarray or None
+    """
+    header = np.fromfile(index_filename, dtype=HEADER_DTYPE, count=1)
+
+    if (len(header) == 0 or header["magic"][0] != MAGIC or
+            header["version"][0] != VERSION or
+            header["record_size"][0] != INDEX_DTYPE.itemsize or
+            header["kind"][0] != kind):
+        return None
+
+    # an incomplete entry at the end is ignored
+    count = ((os.path.getsize(index_filename) - HEADER_DTYPE.itemsize) //
+             INDEX_DTYPE.itemsize)
+    with open(index_filename, 'rb') as index_file:
+        index_file.seek(HEADER_DTYPE.itemsize)
+        return np.fromfile(index_file, dtype=INDEX_DTYPE, count=count)
+
+
+def load_time_index(filename, build=True, logger=None):
+    """
+    Load the sidecar time index of a RAW or binary pulse file. A missing
+    or invalid index is built if build is True, otherwise None is
+    returned.
+
+    :param filename: the RAW or pulse file
+    :type filename: str
+    :param build: build a missing index
+    :type build: bool
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray or None
+    """
+    kind = PULSE_INDEX if is_pulse_file(filename) else RAW_INDEX
+    index_filename = get_index_filename(filename)
+    index = None
+
+    if os.path.exists(index_filename):
+        index = _read_index_file(index_filename, kind)
+
+    if index is not None and len(index):
+        # entries beyond the end of the file belong to another file
+        if kind == PULSE_INDEX:
+            size = len(read_pulse_file(filename)[0])
+        elif get_compression(filename) is None:
+            size = os.path.getsize(filename)
+        else:
+            size = None
+        if size is not None and index["offset"][-1] >= size:
+            index = None
+
+    if index is None and build:
+        index = build_time_index(filename, logger=logger)
+    return index
+
+
+def read_raw_range(filename, start, stop, index=None, logger=None):
+    """
+    Extract the pulses of the events of a RAW file with trigger times
+    from start to stop. The extraction starts at the last indexed line
+    before start and ends at the first indexed line after stop, as the
+    times are not strictly ordered around midnight. Yields the extracted
+    pulses like PulseExtractor.extract.
+
+    :param filename: the RAW file
+    :type filename: str
+    :param start: start time in seconds since the start of the first day
+    :type start: float
+    :param stop: stop time in seconds since the start of the first day
+    :type stop: float
+    :param index: time index of the file, loaded if not given
+    :type index: numpy.ndarray
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: generator of tuples
+    """
+    if logger is None:
+        logger = logging.getLogger()
+    if index is None:
+        index = load_time_index(filename, logger=logger)
+
+    pulse_extractor = PulseExtractor(logger, "")
+    offset = 0
+    day = 0
+    last_time = None
+    skip_first = False
+
+    position = np.searchsorted(index["time"], start, side="right") - 1
+    if position >= 0:
+        entry = index[position]
+        pulse_extractor.set_counter_state(
+                dict((name, entry[name].item()) for name in COUNTER_STATE))
+        offset = int(entry["offset"])
+        day = int(entry["day"])
+        last_time = float(entry["time"]) - day * 86400.
+        # the first trigger closes an event of the previous lines
+        skip_first = True
+
+    position = np.searchsorted(index["time"], stop, side="left")
+    stop_offset = index["offset"][position] if position < len(index) \
+        else None
+
+    for block in read_line_blocks(filename, RANGE_BLOCK_SIZE, processes=1,
+                                  logger=logger, offset=offset):
+        events = pulse_extractor.extract_array(decode_daq_lines(block))
+        offset += len(block)
+
+        if skip_first and events:
+            events = events[1:]
+            skip_first = False
+
+        for event in events:
+            if last_time is not None and event[0] < last_time - DAY_WRAP:
+                day += 1
+            last_time = event[0]
+
+            if start <= day * 86400. + event[0] < stop:
+                yield event
+
+        if stop_offset is not None and offset > stop_offset:
+            break
+
+
+def read_pulse_range(filename, start, stop, index=None, logger=None):
+    """
+    Get the events of a binary pulse file with trigger times from start
+    to stop and their pulses. The tables are memory mapped.
+
+    :param filename: the pulse file
+    :type filename: str
+    :param start: start time in seconds since the start of the first day
+    :type start: float
+    :param stop: stop time in seconds since the start of the first day
+    :type stop: float
+    :param index: time index of the file, loaded if not given
+    :type index: numpy.ndarray
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: tuple of numpy.ndarray (events, pulses)
+    """
+    if index is None:
+        index = load_time_index(filename, logger=logger)
+
+    events, pulses = read_pulse_file(filename)
+
+    first = np.searchsorted(index["time"], start, side="right") - 1
+    last = np.searchsorted(index["time"], stop, side="right")
+
+    lower = int(index["offset"][first]) if first >= 0 else 0
+    upper = int(index["offset"][last]) if last < len(index) else \
+        len(events)
+    day = int(index["day"][first]) if first >= 0 else 0
+
+    trigger_time = np.asarray(events["trigger_time"][lower:upper])
+    times = (day + count_day_wraps(trigger_time, None)) * 86400. + \
+        trigger_time
+
+    selected = np.flatnonzero((times >= start) & (times < stop))
+    if not len(selected):
+        return events[:0], pulses[:0]
+
+    # the times are ordered except around midnight
+    if selected[-1] - selected[0] + 1 == len(selected):
+        return slice_events(events, pulses, lower + selected[0],
+                            lower + selected[-1] + 1)
+
+    # gather the pulses of the selected events
+    events = events[lower + selected]
+    pulse_count = events["pulse_count"].astype(np.int64)
+    rows = (np.repeat(events["first_pulse"] - np.cumsum(pulse_count) +
+                      pulse_count, pulse_count) +
+            np.arange(pulse_count.sum()))
+    return events, pulses[rows]
@@ -2,8 +2,13 @@
 Utility functions
 """
 from __future__ import print_function
+from collections import deque
 import os
 import shutil
+import threading
+import time
+
+import numpy as np
 
 from muonic import DATA_PATH
 
@@ -121,9 +126,222 @@ def format_date(date, fmt="%Y-%m-%d_%H-%M-%S"):
     return date.strftime(fmt)
 
 
+class BackgroundWriter(object):
+    """
+    Writes to a file in a dedicated thread, so slow storage does not
+    block the caller. Written data is queued and written in batches as
+    soon as flush_size bytes are queued or the oldest queued data is
+    flush_interval seconds old. If max_pending bytes are queued, write
+    blocks until the writer thread caught up, which bounds the memory
+    used. Errors of the writer thread are raised by the next call of
+    write, flush or close.
+
+    :param file_object: the file opened for writing
+    :type file_object: file
+    :param flush_size: bytes queued before they are written
+    :type flush_size: int
+    :param flush_interval: seconds data is queued at most
+    :type flush_interval: float
+    :param max_pending: maximum number of queued bytes
+    :type max_pending: int
+    """
+
+    def __init__(self, file_object, flush_size=64 * 1024, flush_interval=1.,
+                 max_pending=8 * 1024 * 1024):
+        self._file = file_object
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._condition = threading.Condition()
+        # queued data and the time the oldest data was queued
+        self._queue = []
+        self._queued_since = None
+        # queued bytes including the batch which is being written
+        self._pending = 0
+        self._flush_requested = False
+        self._closing = False
+        self._error = None
+
+        self.max_write_latency = 0.
+        self.blocked_writes = 0
+        self.written_bytes = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """
+        Write the queued data in batches until the writer is closed.
+
+        :returns: None
+        """
+        while True:
+            with self._condition:
+                while not (self._closing or self._flush_requested or
+                           self._pending >= self.flush_size):
+                    if self._queued_since is None:
+                        self._condition.wait()
+                        continue
+                    timeout = (self._queued_since + self.flush_interval -
+                               time.time())
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+                batch = self._queue
+                self._queue = []
+                self._queued_since = None
+                self._flush_requested = False
+                closing = self._closing
+
+            size = sum(len(data) for data in batch)
+            if batch:
+                start = time.time()
+                try:
+                    self._file.write(batch[0][:0].join(batch))
+                    self._file.flush()
+                except (IOError, OSError, ValueError) as e:
+                    with self._condition:
+                        self._error = e
+                        self._pending = 0
+                        self._condition.notify_all()
+                    return
+                latency = time.time() - start
+
+            with self._condition:
+                self._pending -= size
+                if batch:
+                    self.written_bytes += size
+                    self.max_write_latency = max(self.max_write_latency,
+                                                 latency)
+                self._condition.notify_all()
+                if closing and not self._queue:
+                    return
+
+    def _raise_error(self):
+        """
+        Raise the error of the writer thread, if any.
+
+        :raises: IOError
+        :returns: None
+        """
+        if self._error is not None:
+            raise IOError("writing '%s' failed: %s" %
+                          (getattr(self._file, "name", "file"), self._error))
+
+    def write(self, data):
+        """
+        Queue data to be written.
+
+        Raises IOError if the writer thread failed or the writer is
+        closed.
+
+        :param data: the data
+        :type data: str or bytes
+        :raises: IOError
+        :returns: None
+        """
+        if not data:
+            return
+
+        with self._condition:
+            self._raise_error()
+            if self._closing:
+                raise IOError("writer is closed")
+
+            while (self._pending and
+                   self._pending + len(data) > self.max_pending):
+                self.blocked_writes += 1
+                self._flush_requested = True
+                self._condition.notify_all()
+                self._condition.wait()
+                self._raise_error()
+
+            self._queue.append(data)
+            self._pending += len(data)
+            if self._queued_since is None:
+                # the writer thread starts waiting for flush_interval
+                self._queued_since = time.time()
+                self._condition.notify_all()
+            elif self._pending >= self.flush_size:
+                self._condition.notify_all()
+
+    def flush(self):
+        """
+        Write all queued data and wait until it is written.
+
+        Raises IOError if the writer thread failed.
+
+        :raises: IOError
+        :returns: None
+        """
+        with self._condition:
+            while self._pending and self._error is None:
+                self._flush_requested = True
+                self._condition.notify_all()
+                self._condition.wait()
+            self._raise_error()
+
+    def tell(self):
+        """
+        Get the file position after all queued data was written.
+
+        :returns: int
+        """
+        self.flush()
+        return self._file.tell()
+
+    def close(self):
+        """
+        Write all queued data, stop the writer thread and close the file.
+
+        Raises IOError if the writer thread failed.
+
+        :raises: IOError
+        :returns: None
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._file.close()
+        self._raise_error()
+
+    def get_statistics(self):
+        """
+        Get the number of queued writes and bytes ('queue_depth',
+        'pending_bytes'), the longest time a batch took to write in
+        seconds ('max_write_latency'), the number of writes which had to
+        wait for the writer thread ('blocked_writes') and the number of
+        bytes written ('written_bytes').
+
+        :returns: dict
+        """
+        with self._condition:
+            return {"queue_depth": len(self._queue),
+                    "pending_bytes": self._pending,
+                    "max_write_latency": self.max_write_latency,
+                    "blocked_writes": self.blocked_writes,
+                    "written_bytes": self.written_bytes}
+
+    def __getattr__(self, attr):
+        """
+        Proxy all other attributes of the file.
+
+        :param attr: attribute name
+        :type attr: str
+        :returns: mixed
+        """
+        return getattr(self._file, attr)
+
+
 class WrappedFile(object):
     """
-    A file wrapper which keeps track of open files.
+    A file wrapper which keeps track of open files. Files opened for
+    writing can be written by a BackgroundWriter thread, see
+    set_background_writes.
 
     Raises ValueError if filename is None.
 
@@ -133,6 +351,12 @@ class WrappedFile(object):
     """
     open_files = set()
 
+    # background writers of the open files
+    writers = dict()
+
+    # keyword arguments of BackgroundWriter, None to write directly
+    background_writes = None
+
     def __init__(self, filename):
         if filename is None:
             raise ValueError("filename cannot be of 'NoneType'")
@@ -148,15 +372,26 @@ class WrappedFile(object):
         """
         return self._filename
 
-    def open(self, mode='w'):
+    def open(self, mode='w', background=None):
         """
-        Open file and track it.
+        Open file and track it. Files opened for writing or appending
+        are written by a BackgroundWriter thread if background is True,
+        or if it is None and background writes are enabled.
 
         :param mode: the file mode
         :type mode: str
+        :param background: write the file in a background thread
+        :type background: bool
         :returns: None
         """
+        options = WrappedFile.background_writes
+        if background is None:
+            background = options is not None
+
         self._file = open(self._filename, mode)
+        if background and mode[0] in "wa" and "+" not in mode:
+            self._file = BackgroundWriter(self._file, **(options or {}))
+            WrappedFile.writers[self._filename] = self._file
         WrappedFile.open_files.add(self._filename)
         return self
 
@@ -182,9 +417,12 @@ class WrappedFile(object):
         """
         if self._file is None:
             raise IOError("file '%s' is not open" % self._filename)
-        self._file.close()
-        self._file = None
-        WrappedFile.open_files.remove(self._filename)
+        try:
+            self._file.close()
+        finally:
+            self._file = None
+            WrappedFile.open_files.remove(self._filename)
+            WrappedFile.writers.pop(self._filename, None)
 
     def __enter__(self):
         """
@@ -242,3 +480,131 @@ class WrappedFile(object):
         :returns: set of str
         """
         return WrappedFile.open_files
+
+    @staticmethod
+    def set_background_writes(enabled, **options):
+        """
+        Enable or disable writing files opened afterwards in background
+        threads. The options are passed to BackgroundWriter.
+
+        :param enabled: write files in background threads
+        :type enabled: bool
+        :param options: flush_size, flush_interval and max_pending
+        :returns: None
+        """
+        WrappedFile.background_writes = options if enabled else None
+
+    @staticmethod
+    def get_write_statistics():
+        """
+        Get the statistics of the background writers of the open files,
+        see BackgroundWriter.get_statistics.
+
+        :returns: dict of dict
+        """
+        return dict((filename, writer.get_statistics())
+                    for filename, writer in
+                    list(WrappedFile.writers.items()))
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity buffer of rows of numbers. If the buffer is full, the
+    oldest row is dropped when a new one is appended. The maximum of each
+    column is tracked while rows are appended and dropped.
+
+    The rows are stored twice in a row, so the content can always be
+    returned as view without copying.
+
+    :param capacity: maximum number of rows
+    :type capacity: int
+    :param columns: number of columns
+    :type columns: int
+    :raises: ValueError
+    """
+
+    def __init__(self, capacity, columns=1):
+        if capacity < 1:
+            raise ValueError("capacity has to be positive")
+
+        self.capacity = capacity
+        self.columns = columns
+        self._data = np.zeros((2 * capacity, columns))
+        self._start = 0
+        self._length = 0
+        self._count = 0
+
+        # candidates for the maximum of each column as (row count, value)
+        # with decreasing values
+        self._maxima = [deque() for _ in range(columns)]
+
+    def __len__(self):
+        """
+        Number of rows in the buffer
+
+        :returns: int
+        """
+        return self._length
+
+    def append(self, row):
+        """
+        Append a row, dropping the oldest one if the buffer is full.
+
+        :param row: one value per column
+        :type row: list or tuple or numpy.ndarray
+        :returns: None
+        """
+        if self._length == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._length += 1
+
+        index = (self._start + self._length - 1) % self.capacity
+        self._data[index] = row
+        self._data[index + self.capacity] = row
+
+        # drop candidates which left the buffer or are exceeded
+        oldest = self._count - self._length + 1
+        for maxima, value in zip(self._maxima, self._data[index].tolist()):
+            while maxima and maxima[0][0] < oldest:
+                maxima.popleft()
+            while maxima and maxima[-1][1] <= value:
+                maxima.pop()
+            maxima.append((self._count, value))
+
+        self._count += 1
+
+    def get(self):
+        """
+        Get the rows in the order they were appended. The returned
+        array is a view which is only valid until the next append.
+
+        :returns: numpy.ndarray
+        """
+        return self._data[self._start:self._start + self._length]
+
+    def max(self):
+        """
+        Get the maximum of each column, NaN if the buffer is empty.
+
+        :returns: list of float
+        """
+        oldest = self._count - self._length
+        result = []
+
+        for maxima in self._maxima:
+            while maxima and maxima[0][0] < oldest:
+                maxima.popleft()
+            result.append(maxima[0][1] if maxima else float("nan"))
+        return result
+
+    def clear(self):
+        """
+        Remove all rows.
+
+        :returns: None
+        """
+        self._start = 0
+        self._length = 0
+        for maxima in self._maxima:
+            maxima.clear()
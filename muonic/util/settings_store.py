@@ -11,6 +11,7 @@ _default_settings = {
     "write_pulses": False,
     "write_daq_status": False,
     "time_window": 5.0,
+    "rate_plot_points": 40,
     "gate_width": 0.0,
     "veto": False,
     "veto_ch0": False,
@@ -34,7 +34,7 @@ setup(name=muonic.__name__,
       platforms=["Ubuntu 12.04"],
       scripts=["bin/muonic", "bin/which_tty_daq"],
       packages=["muonic", "muonic.analysis", "muonic.daq",
-                "muonic.gui", "muonic.util"],
+                "muonic.gui", "muonic.io", "muonic.util"],
       package_data={"muonic": ["daq/simdaq.txt", "gui/daq_commands_help.txt",
                               "gui/muonic.xpm"]},
       classifiers=[